@@ -0,0 +1,109 @@
+""" Shared set up for the benchmarks. Run them from the top of the checkout,
+for example::
+
+    python -m benchmarks.read_ahead
+"""
+import re
+import time
+
+from django.conf import settings
+
+if not settings.configured:
+    settings.configure(
+        DATABASES={
+            'default': {
+                'ENGINE': 'simpledb',
+                'NAME': 'benchmarks',
+                'AWS_ACCESS_KEY_ID': 'benchmark',
+                'AWS_SECRET_ACCESS_KEY': 'benchmark',
+            },
+            # Answered by simpledb.emulator, for end to end benchmarks
+            'emulated': {
+                'ENGINE': 'simpledb',
+                'NAME': 'benchmarks',
+                'AWS_ACCESS_KEY_ID': 'benchmark',
+                'AWS_SECRET_ACCESS_KEY': 'benchmark',
+                'EMULATOR': 'benchmarks',
+                'RATE_LIMIT': None,
+            },
+        },
+        INSTALLED_APPS=['simpledb'],
+    )
+
+from django.db import models
+
+from boto.resultset import ResultSet
+from boto.sdb.db.manager.sdbmanager import SDBManager
+from boto.sdb.domain import Domain
+from boto.sdb.item import Item
+
+
+class Entry(models.Model):
+    title = models.CharField(max_length=100)
+    count = models.IntegerField()
+    created = models.DateTimeField()
+    published = models.DateField()
+    live = models.BooleanField()
+
+    class Meta:
+        app_label = 'benchmarks'
+
+
+ENTRY_ATTRIBUTES = {
+    '__type__': 'benchmarks_entry',
+    'title': 'A benchmark entry',
+    'count': '12345',
+    'created': '2011-03-01T12:30:45.123456',
+    'published': '2011-03-01',
+    'live': '1',
+}
+
+
+class StubSDB(object):
+    """ Stands in for a boto SDBConnection, answering selects from `size`
+    identical items after sleeping for `latency` seconds, as a remote
+    SimpleDB endpoint would.
+    """
+    converter = None
+
+    def __init__(self, size, latency=0.02):
+        self.size = size
+        self.latency = latency
+        self.requests = 0
+
+    def select(self, domain, query, next_token=None, consistent_read=False):
+        time.sleep(self.latency)
+        self.requests += 1
+        match = re.search(r'limit (\d+)', query)
+        limit = match and int(match.group(1)) or 100
+        start = int(next_token or 0)
+        end = min(start + limit, self.size)
+        rs = ResultSet()
+        for i in xrange(start, end):
+            item = Item(domain, str(i))
+            item.update(ENTRY_ATTRIBUTES)
+            rs.append(item)
+        rs.next_token = end < self.size and str(end) or None
+        return rs
+
+    def close(self):
+        pass
+
+
+def stub_manager(sdb, domain_name='benchmarks_entry'):
+    """ Return a real SDBManager, wired up to a stub connection
+    """
+    manager = SDBManager(cls=None, db_name=domain_name, db_user=None,
+        db_passwd=None, db_host=None, db_port=None, db_table=None,
+        ddl_dir=None, enable_ssl=True)
+    manager._sdb = sdb
+    manager._domain = Domain(sdb, domain_name)
+    return manager
+
+
+def timed(func, *args, **kwargs):
+    """ Call func, returning its result and the seconds it took
+    """
+    start = time.time()
+    result = func(*args, **kwargs)
+    return result, time.time() - start
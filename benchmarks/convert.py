@@ -0,0 +1,81 @@
+""" Convert rows of entities into result rows, comparing the old if/elif
+conversion chain with the precompiled per-field converters.
+
+    python -m benchmarks.convert [rows]
+"""
+import datetime
+import sys
+
+from benchmarks.common import ENTRY_ATTRIBUTES, Entry, timed
+
+from django.db import connection
+from django.db.models.fields import NOT_PROVIDED
+
+from simpledb.compiler import DATE_ISO8601, DATETIME_ISO8601, SQLCompiler
+
+ROWS = 1000000
+
+
+def legacy_convert_value_from_db(db_type, value):
+    """ convert_value_from_db as it was before converters were precompiled
+    """
+    if isinstance(value, (list, tuple)) and len(value) and \
+            db_type.startswith('ListField:'):
+        db_sub_type = db_type.split(':', 1)[1]
+        value = [legacy_convert_value_from_db(db_sub_type, subvalue)
+                 for subvalue in value]
+    elif db_type == 'long':
+        value = long(value)
+    elif db_type == 'int':
+        value = int(value)
+    elif db_type == 'date':
+        value = datetime.datetime.strptime(value, DATE_ISO8601).date()
+    elif db_type == 'datetime':
+        value = datetime.datetime.strptime(value, DATETIME_ISO8601)
+    elif db_type == 'bool':
+        if value == '0':
+            value = False
+        else:
+            value = True
+    elif isinstance(value, str):
+        value = value.decode('utf-8')
+    return value
+
+
+def legacy_make_result(entity, fields):
+    """ djangotoolbox's NonrelCompiler._make_result, with the old chain
+    """
+    result = []
+    for field in fields:
+        value = entity.get(field.column, NOT_PROVIDED)
+        if value is NOT_PROVIDED:
+            value = field.get_default()
+        else:
+            value = legacy_convert_value_from_db(
+                field.db_type(connection=connection), value)
+        result.append(value)
+    return result
+
+
+def run(make_result, rows, entity, fields):
+    for i in xrange(rows):
+        make_result(entity, fields)
+    return rows
+
+
+def main(rows=ROWS):
+    entity = dict(ENTRY_ATTRIBUTES, id='123456')
+    fields = Entry._meta.fields
+    compiler = SQLCompiler(None, connection, 'default')
+    print 'Converting %s rows of %s fields' % (rows, len(fields))
+    results = []
+    for name, make_result in [('before', legacy_make_result),
+                              ('after', compiler._make_result)]:
+        count, seconds = timed(run, make_result, rows, entity, fields)
+        results.append(count / seconds)
+        print '%-6s: %8.0f rows/s (%.2fs)' % (name, count / seconds, seconds)
+    print 'speedup: %.2fx' % (results[1] / results[0])
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,61 @@
+""" Parse and format datetimes, comparing strptime and strftime with
+simpledb.encoding, with and without the date cache.
+
+    python -m benchmarks.datetimes [values]
+"""
+import datetime
+import sys
+
+from benchmarks.common import timed
+
+from simpledb import encoding
+from simpledb.encoding import DATETIME_ISO8601
+
+VALUES = 200000
+
+
+def strptime(value):
+    return datetime.datetime.strptime(value, DATETIME_ISO8601)
+
+
+def strftime(value):
+    return value.strftime(DATETIME_ISO8601)
+
+
+def run(func, values):
+    for value in values:
+        func(value)
+    return len(values)
+
+
+def report(name, func, values):
+    count, seconds = timed(run, func, values)
+    print '%-22s: %9.0f values/s (%.2fs)' % (name, count / seconds, seconds)
+    return count / seconds
+
+
+def main(values=VALUES):
+    start = datetime.datetime(2011, 1, 1)
+    datetimes = [start + datetime.timedelta(seconds=i * 7.3)
+        for i in xrange(values)]
+    unique = [dt.strftime(DATETIME_ISO8601) for dt in datetimes]
+    # The same thousand timestamps over and over
+    repeated = unique[:1000] * (values // 1000)
+
+    print 'Parsing %s datetimes' % values
+    before = report('strptime', strptime, unique)
+    after = report('parse_datetime', encoding.parse_datetime, unique)
+    print 'speedup: %.2fx' % (after / before)
+    encoding.set_date_cache_size(1000)
+    report('cached, unique', encoding.decode_datetime, unique)
+    report('cached, repeated', encoding.decode_datetime, repeated)
+    encoding.set_date_cache_size(0)
+
+    print 'Formatting %s datetimes' % values
+    before = report('strftime', strftime, datetimes)
+    after = report('format_datetime', encoding.format_datetime, datetimes)
+    print 'speedup: %.2fx' % (after / before)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
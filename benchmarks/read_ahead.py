@@ -0,0 +1,46 @@
+""" Compare streaming a large scan with and without read-ahead, against a
+stub endpoint with a fixed per-request latency. Each entity is converted by
+the compiler as it arrives, so there's consumer work to overlap with.
+"""
+from benchmarks.common import Entry, StubSDB, stub_manager, timed
+
+from django.db import connection
+
+from simpledb.compiler import SQLCompiler
+from simpledb.query import SimpleDBQuery
+
+ROWS = 25000
+LATENCY = 0.05
+DEPTHS = (0, 1, 2, 4)
+
+
+def scan(depth):
+    sdb = StubSDB(ROWS, LATENCY)
+    manager = stub_manager(sdb)
+    query = SimpleDBQuery(manager, Entry,
+        manager_factory=lambda domain_name: manager, read_ahead=depth)
+    compiler = SQLCompiler(None, None, None)
+    fields = [(f.column, f.db_type(connection=connection))
+        for f in Entry._meta.fields
+        if f.column in ('title', 'count', 'created', 'published', 'live')]
+    rows = 0
+    for entity in query.iterate():
+        for column, db_type in fields:
+            compiler.convert_value_from_db(db_type, entity[column])
+        rows += 1
+    return rows
+
+
+def main():
+    print 'Scanning %s rows, %sms per select' % (ROWS, int(LATENCY * 1000))
+    baseline = None
+    for depth in DEPTHS:
+        rows, seconds = timed(scan, depth)
+        rate = rows / seconds
+        baseline = baseline or rate
+        print 'read_ahead=%s: %8.0f rows/s (%.2fx)' % (depth, rate,
+            rate / baseline)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,256 @@
+""" Time the main read and write paths end to end, against the in-process
+emulator (see simpledb.emulator), at several data sizes. Each benchmark
+reports rows per second, latency percentiles of its operations, and the
+requests and box usage they took. Results are printed as JSON, so runs can
+be saved and compared over time:
+
+    python -m benchmarks.run [--sizes 100,1000,10000] [--latency SECONDS]
+        [--output FILE] [benchmark ...]
+"""
+import argparse
+import datetime
+import json
+import math
+import platform
+import random
+import subprocess
+import sys
+import time
+
+from benchmarks.common import ENTRY_ATTRIBUTES, Entry
+
+from django.db import connections
+from django.db.models.sql.subqueries import InsertQuery
+
+from simpledb.compiler import SQLCompiler
+
+DATABASE = 'emulated'
+SIZES = (100, 1000, 10000)
+# Single inserts and pk gets are timed this many times at most, whatever
+# the size
+SAMPLES = 500
+# Rows per bulk_insert() call
+BULK_SIZE = 500
+# Pages fetched at random offsets, and rows in each
+PAGES = 100
+PAGE_SIZE = 20
+# Times whole scans, counts and conversions are repeated
+REPEAT = 5
+
+
+def percentile(timings, fraction):
+    """ The nearest-rank percentile of sorted timings
+    """
+    return timings[max(0, int(math.ceil(fraction * len(timings))) - 1)]
+
+
+class Recorder(object):
+    """ Times the operations of one benchmark, counting the rows they
+    handle and the emulator requests they make.
+    """
+
+    def __init__(self, name, size, emulator):
+        self.name = name
+        self.size = size
+        self.emulator = emulator
+        self.timings = []
+        self.rows = 0
+        self.requests = sum(emulator.requests.values())
+        self.box_usage = emulator.box_usage
+
+    def time(self, rows, func, *args, **kwargs):
+        """ Call func as one operation handling rows rows, returning its
+        result
+        """
+        start = time.time()
+        result = func(*args, **kwargs)
+        self.timings.append(time.time() - start)
+        self.rows += rows
+        return result
+
+    def result(self):
+        timings = sorted(self.timings)
+        seconds = sum(timings)
+        return {
+            'benchmark': self.name,
+            'size': self.size,
+            'operations': len(timings),
+            'rows': self.rows,
+            'seconds': round(seconds, 6),
+            'rows_per_second': seconds and round(self.rows / seconds, 1),
+            'latency_ms': {
+                'mean': round(seconds / len(timings) * 1000, 3),
+                'p50': round(percentile(timings, 0.5) * 1000, 3),
+                'p90': round(percentile(timings, 0.9) * 1000, 3),
+                'p99': round(percentile(timings, 0.99) * 1000, 3),
+                'max': round(timings[-1] * 1000, 3),
+            },
+            'requests': sum(self.emulator.requests.values()) - self.requests,
+            'box_usage': round(self.emulator.box_usage - self.box_usage, 10),
+        }
+
+
+def entry(i):
+    created = datetime.datetime(2011, 3, 1, 12, 30, 45) + \
+        datetime.timedelta(minutes=i)
+    return Entry(title='Entry %08d' % i, count=i, created=created,
+        published=created.date(), live=i % 2 == 0)
+
+
+def reset(connection):
+    """ Empty the emulator, and create Entry's domain again
+    """
+    connection.emulator.reset()
+    connection.creation.sql_create_model(Entry, None)
+
+
+def insert(recorder, objects, size):
+    """ Save new entries one at a time
+    """
+    for i in xrange(min(size, SAMPLES)):
+        recorder.time(1, entry(i).save, using=DATABASE)
+
+
+def bulk_insert(recorder, objects, size):
+    """ Save entries with SQLInsertCompiler.bulk_insert()
+    """
+    compiler = InsertQuery(Entry).get_compiler(using=DATABASE)
+    for start in xrange(0, size, BULK_SIZE):
+        entries = [entry(i) for i in xrange(start, min(start + BULK_SIZE,
+            size))]
+        recorder.time(len(entries), compiler.bulk_insert, entries)
+
+
+def fetch(recorder, objects, size):
+    """ Stream every entry, a page of selects at a time
+    """
+    for i in xrange(REPEAT):
+        recorder.time(size, lambda: list(objects.all()))
+
+
+def page(recorder, objects, size):
+    """ Fetch ordered pages at random offsets, as paginated views do
+    """
+    rng = random.Random(size)
+    query = objects.order_by('title')
+    for i in xrange(PAGES):
+        offset = rng.randrange(max(1, size - PAGE_SIZE))
+        recorder.time(PAGE_SIZE, lambda: list(
+            query[offset:offset + PAGE_SIZE]))
+
+
+def get(recorder, objects, size):
+    """ Get entries by pk
+    """
+    pks = list(objects.values_list('pk', flat=True))
+    random.Random(size).shuffle(pks)
+    for pk in pks[:SAMPLES]:
+        recorder.time(1, objects.get, pk=pk)
+
+
+def count(recorder, objects, size):
+    for i in xrange(REPEAT):
+        recorder.time(size, objects.count)
+        recorder.time(size // 2, objects.filter(live=True).count)
+
+
+def delete(recorder, objects, size):
+    """ Delete every entry with one queryset
+    """
+    recorder.time(size, objects.all().delete)
+
+
+def convert(recorder, objects, size):
+    """ Convert entities into rows, without any requests
+    """
+    fields = Entry._meta.fields
+    compiler = SQLCompiler(None, connections[DATABASE], DATABASE)
+    entities = [dict(ENTRY_ATTRIBUTES, id=str(i)) for i in xrange(size)]
+    def run():
+        for entity in entities:
+            compiler._make_result(entity, fields)
+    for i in xrange(REPEAT):
+        recorder.time(size, run)
+
+
+# In the order they run - later ones use the entries bulk_insert saves
+BENCHMARKS = [insert, bulk_insert, fetch, page, get, count, delete, convert]
+
+
+def revision():
+    """ The git commit being benchmarked, if there is one
+    """
+    try:
+        return subprocess.Popen(['git', 'rev-parse', 'HEAD'],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE).communicate()[0].strip() or None
+    except OSError:
+        return None
+
+
+def main(argv=None):
+    names = [benchmark.__name__ for benchmark in BENCHMARKS]
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('benchmarks', nargs='*', metavar='benchmark',
+        help='one of %s; all of them by default' % ', '.join(names))
+    parser.add_argument('--sizes', default=','.join(map(str, SIZES)),
+        help='comma separated numbers of rows')
+    parser.add_argument('--latency', type=float, default=0.0,
+        help='seconds each request takes (default 0)')
+    parser.add_argument('--output', help='file to write the JSON to')
+    args = parser.parse_args(argv)
+    for name in args.benchmarks:
+        if name not in names:
+            parser.error('unknown benchmark %r' % name)
+    selected = [benchmark for benchmark in BENCHMARKS
+        if not args.benchmarks or benchmark.__name__ in args.benchmarks]
+    sizes = [int(size) for size in args.sizes.split(',')]
+
+    connections.databases[DATABASE]['EMULATOR_LATENCY'] = args.latency
+    connection = connections[DATABASE]
+    objects = Entry.objects.using(DATABASE)
+    results = []
+    for size in sizes:
+        populated = False
+        for benchmark in selected:
+            if benchmark in (insert, bulk_insert):
+                reset(connection)
+                populated = benchmark is bulk_insert
+            elif benchmark is not convert and not populated:
+                # Benchmarks reading entries need bulk_insert's
+                reset(connection)
+                bulk_insert(Recorder(None, size, connection.emulator),
+                    objects, size)
+                populated = True
+            recorder = Recorder(benchmark.__name__, size,
+                connection.emulator)
+            benchmark(recorder, objects, size)
+            if benchmark is delete:
+                populated = False
+            result = recorder.result()
+            results.append(result)
+            print >> sys.stderr, '%-12s %8d rows: %10.1f rows/s, ' \
+                'p50 %.3fms, p99 %.3fms' % (result['benchmark'], size,
+                    result['rows_per_second'], result['latency_ms']['p50'],
+                    result['latency_ms']['p99'])
+
+    report = json.dumps({
+        'timestamp': datetime.datetime.utcnow().isoformat(),
+        'revision': revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'latency': args.latency,
+        'results': results,
+    }, indent=2, sort_keys=True)
+    if args.output:
+        output = open(args.output, 'w')
+        try:
+            output.write(report + '\n')
+        finally:
+            output.close()
+    else:
+        print report
+
+
+if __name__ == '__main__':
+    main()
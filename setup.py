@@ -21,7 +21,7 @@ setup(name='django-simpledb',
       author_email='dan@fezconsulting.com',
       url='http://github.com/danfairs/django-simpledb',
       license='BSD',
-      packages=find_packages(exclude=['ez_setup']),
+      packages=find_packages(exclude=['ez_setup', 'benchmarks']),
       namespace_packages=[],
       include_package_data=True,
       zip_safe=False,
@@ -11,17 +11,22 @@ from boto.sdb.db import model
 from boto.sdb.db.manager.sdbmanager import SDBManager
 import boto
 
-from simpledb.utils import domain_for_model
+from simpledb.cache import IdentityMap, LocalResultCache, result_cache
+from simpledb.emulator import EmulatedSDBConnection, EmulatedSDBManager, \
+    get_emulator
+from simpledb.encoding import set_date_cache_size
+from simpledb.pool import ManagerPool
+from simpledb.retry import RetryingSDBConnection, RetryingSDBManager, \
+    retry_policy
+from simpledb.utils import LRUCache, domain_for_model, shard_count, \
+    shard_domains
 
 class HasConnection(object):
 
     @property
     def sdb(self):
         if not hasattr(self, '_sdb'):
-            settings = self.connection.settings_dict
-            self._sdb = boto.connect_sdb(
-                aws_access_key_id=settings['AWS_ACCESS_KEY_ID'],
-                aws_secret_access_key=settings['AWS_SECRET_ACCESS_KEY'])
+            self._sdb = self.connection.new_connection()
         return self._sdb
 
 # TODO: You can either use the type mapping defined in NonrelDatabaseCreation
@@ -36,7 +41,7 @@ class DatabaseCreation(NonrelDatabaseCreation, HasConnection):
         'PositiveSmallIntegerField':    'int',
         'BigIntegerField':              'long',
         'AutoField':                    'long',
-        'DecimalField':                 'unicode',
+        'DecimalField':                 'decimal:%(max_digits)s,%(decimal_places)s',
         'ForeignKey':                   'long',
         'DateField':                    'date',
         'DateTimeField':                'datetime',
@@ -44,10 +49,12 @@ class DatabaseCreation(NonrelDatabaseCreation, HasConnection):
 
     def sql_create_model(self, model, style, known_models=set()):
         """ We don't actually return any SQL here, but we do go right ahead
-        and create a domain for the model.
+        and create a domain for the model - or one for each of its shards.
         """
         domain_name = domain_for_model(model)
-        self.sdb.create_domain(domain_name)
+        shards = shard_count(self.connection, domain_name)
+        for shard in shard_domains(domain_name, shards):
+            self.sdb.create_domain(shard)
         return [], {}
 
     def create_test_db(self, verbosity=1, autoclobber=False):
@@ -89,10 +96,71 @@ class DatabaseWrapper(NonrelDatabaseWrapper):
         self.creation = DatabaseCreation(self)
         self.validation = DatabaseValidation(self)
         self.introspection = DatabaseIntrospection(self)
+        settings = self.settings_dict
+        # Failed requests are retried with backoff, and requests to each
+        # domain rate limited, adapting to throttling
+        self.retry_policy = retry_policy(settings)
+        # EMULATOR sends every request to an in-process SimpleDB instead -
+        # see simpledb.emulator
+        self.emulator = None
+        if settings.get('EMULATOR'):
+            name = settings['EMULATOR']
+            self.emulator = get_emulator(name is True and 'default' or name)
+        self.manager_pool = ManagerPool(self._new_manager,
+            size=settings.get('POOL_SIZE', 10),
+            max_idle=settings.get('POOL_MAX_IDLE', 300),
+            check_interval=settings.get('POOL_HEALTH_CHECK_INTERVAL', 0))
+        # The date cache is process wide, so databases without the setting
+        # leave it alone
+        if 'DATE_CACHE_SIZE' in settings:
+            set_date_cache_size(settings['DATE_CACHE_SIZE'])
+        # NextTokens found skipping offsets, kept until their domain is
+        # written to
+        self.offset_cache = None
+        if settings.get('OFFSET_CACHE_SIZE', 1000):
+            self.offset_cache = LocalResultCache(
+                size=settings.get('OFFSET_CACHE_SIZE', 1000),
+                ttl=settings.get('OFFSET_CACHE_TTL', 300))
+        # Counts can be cached for a few seconds, for pages that count the
+        # same thing again and again. Off unless COUNT_CACHE_TTL is set.
+        self.count_cache = None
+        if settings.get('COUNT_CACHE_TTL'):
+            self.count_cache = LRUCache(settings.get('COUNT_CACHE_SIZE', 100),
+                settings['COUNT_CACHE_TTL'])
+        self.result_cache = result_cache(settings)
+        # Entities fetched by pk are kept for the rest of the request, unless
+        # IDENTITY_MAP is False
+        self.identity_map = None
+        if settings.get('IDENTITY_MAP', True):
+            self.identity_map = IdentityMap()
 
     def create_manager(self, domain_name):
-        return SDBManager(cls=None, db_name=domain_name,
+        """ Return an SDBManager for domain_name. Managers are pooled per
+        thread, so repeated queries against a domain reuse one connection.
+        """
+        return self.manager_pool.get(domain_name)
+
+    def new_connection(self):
+        """ Return a new SDBConnection for this database
+        """
+        settings = self.settings_dict
+        if self.emulator is not None:
+            return EmulatedSDBConnection(self.emulator, self.retry_policy,
+                aws_access_key_id=settings['AWS_ACCESS_KEY_ID'],
+                aws_secret_access_key=settings['AWS_SECRET_ACCESS_KEY'],
+                latency=settings.get('EMULATOR_LATENCY', 0))
+        return RetryingSDBConnection(self.retry_policy,
+            aws_access_key_id=settings['AWS_ACCESS_KEY_ID'],
+            aws_secret_access_key=settings['AWS_SECRET_ACCESS_KEY'])
+
+    def _new_manager(self, domain_name):
+        kwargs = dict(cls=None, db_name=domain_name,
             db_user=self.settings_dict['AWS_ACCESS_KEY_ID'],
             db_passwd=self.settings_dict['AWS_SECRET_ACCESS_KEY'],
             db_host=None, db_port=None, db_table=None, ddl_dir=None,
-            enable_ssl=True)
+            enable_ssl=True, policy=self.retry_policy)
+        if self.emulator is not None:
+            return EmulatedSDBManager(emulator=self.emulator,
+                latency=self.settings_dict.get('EMULATOR_LATENCY', 0),
+                **kwargs)
+        return RetryingSDBManager(**kwargs)
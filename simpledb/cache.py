@@ -0,0 +1,190 @@
+""" Caches of query results, invalidated a domain at a time.
+
+Results are stored under a key that includes a generation number for their
+domain. Writing to a domain moves it on to a new generation, so its old
+results are never read again, and age out of the cache on their own.
+
+IdentityMap keeps the items fetched by pk during a request.
+"""
+import hashlib
+import threading
+import time
+
+from django.core.signals import request_finished, request_started
+from django.utils.importlib import import_module
+
+from simpledb.utils import LRUCache
+
+
+class ResultCache(object):
+    """ Base class for result caches. Subclasses store values with _get()
+    and _set().
+    """
+
+    def __init__(self, ttl=60, max_rows=1000):
+        # Seconds results are kept for
+        self.ttl = ttl
+        # Results with more rows than this aren't cached
+        self.max_rows = max_rows
+
+    def key(self, domain_name, signature):
+        """ The key to cache results of the query identified by signature
+        under. Look it up before running the query: if the domain is written
+        to while the query runs, its results are then cached under a key
+        that's already out of date.
+        """
+        return 'simpledb:results:%s:%s:%s' % (domain_name,
+            self._generation(domain_name),
+            hashlib.md5(signature.encode('utf-8')).hexdigest())
+
+    def get(self, key):
+        """ Return the entities cached under key, or None
+        """
+        return self._get(key)
+
+    def set(self, key, entities):
+        self._set(key, entities)
+
+    def invalidate(self, domain_name):
+        """ Forget every result cached for domain_name
+        """
+        self._set(self._generation_key(domain_name),
+            self._generation(domain_name) + 1)
+
+    def _generation_key(self, domain_name):
+        return 'simpledb:generation:%s' % domain_name
+
+    def _generation(self, domain_name):
+        generation = self._get(self._generation_key(domain_name))
+        if generation is None:
+            # Start somewhere no earlier generation of this domain can
+            # have reached, in case the old number was evicted
+            generation = int(time.time() * 1000000)
+            self._set(self._generation_key(domain_name), generation)
+        return generation
+
+    def _get(self, key):
+        raise NotImplementedError
+
+    def _set(self, key, value):
+        raise NotImplementedError
+
+
+class LocalResultCache(ResultCache):
+    """ Results cached in this process, least recently used first out
+    """
+
+    def __init__(self, size=1000, **kwargs):
+        super(LocalResultCache, self).__init__(**kwargs)
+        self._cache = LRUCache(size, self.ttl)
+        # Generations are kept apart, so they're never evicted
+        self._generations = {}
+
+    def _get(self, key):
+        if key.startswith('simpledb:generation:'):
+            return self._generations.get(key)
+        return self._cache.get(key)
+
+    def _set(self, key, value):
+        if key.startswith('simpledb:generation:'):
+            self._generations[key] = value
+        else:
+            self._cache.set(key, value)
+
+
+class DjangoResultCache(ResultCache):
+    """ Results cached with Django's cache framework, so processes sharing
+    a cache (such as memcached) share results and invalidations.
+    """
+
+    def __init__(self, backend=None, **kwargs):
+        super(DjangoResultCache, self).__init__(**kwargs)
+        if backend is None:
+            from django.core.cache import cache
+        else:
+            from django.core.cache import get_cache
+            cache = get_cache(backend)
+        self._cache = cache
+
+    def _get(self, key):
+        return self._cache.get(key)
+
+    def _set(self, key, value):
+        if key.startswith('simpledb:generation:'):
+            # Generations have to outlive the results they cover
+            self._cache.set(key, value, self.ttl * 10)
+        else:
+            self._cache.set(key, value, self.ttl)
+
+
+class IdentityMap(object):
+    """ Entities fetched by pk during the current request, so fetching one
+    again doesn't go back to SimpleDB - missing items included. Each thread
+    has its own map, which is only kept between request_started and
+    request_finished. Writes to a domain drop its entities from the current
+    thread's map.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+        request_started.connect(self.start)
+        request_finished.connect(self.finish)
+
+    def start(self, **kwargs):
+        self._local.entities = {}
+
+    def finish(self, **kwargs):
+        self._local.entities = None
+
+    def _entities(self):
+        return getattr(self._local, 'entities', None)
+
+    def get(self, domain_name, item_name):
+        """ Return (True, entity) if item_name has been fetched during this
+        request, with entity None if it didn't exist, or (False, None).
+        """
+        entities = self._entities()
+        if entities is None or (domain_name, item_name) not in entities:
+            return False, None
+        return True, entities[domain_name, item_name]
+
+    def set(self, domain_name, item_name, entity):
+        entities = self._entities()
+        if entities is not None:
+            entities[domain_name, item_name] = entity
+
+    def invalidate(self, domain_name):
+        entities = self._entities()
+        if entities:
+            for key in entities.keys():
+                if key[0] == domain_name:
+                    del entities[key]
+
+
+BACKENDS = {
+    'local': LocalResultCache,
+    'django': DjangoResultCache,
+}
+
+def result_cache(settings):
+    """ Build the result cache configured by a database's settings, or
+    return None if there isn't one. RESULT_CACHE names a backend, or is the
+    dotted path of a ResultCache subclass.
+    """
+    backend = settings.get('RESULT_CACHE')
+    if not backend:
+        return None
+    if backend in BACKENDS:
+        cls = BACKENDS[backend]
+    else:
+        module, name = backend.rsplit('.', 1)
+        cls = getattr(import_module(module), name)
+    kwargs = {
+        'ttl': settings.get('RESULT_CACHE_TTL', 60),
+        'max_rows': settings.get('RESULT_CACHE_MAX_ROWS', 1000),
+    }
+    if cls is LocalResultCache:
+        kwargs['size'] = settings.get('RESULT_CACHE_SIZE', 1000)
+    elif cls is DjangoResultCache:
+        kwargs['backend'] = settings.get('RESULT_CACHE_BACKEND')
+    return cls(**kwargs)
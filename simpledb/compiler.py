@@ -1,8 +1,11 @@
 import datetime
+import inspect
+import itertools
 import logging
 import sys
 import uuid
 
+from django.db.models.fields import NOT_PROVIDED
 from django.db.models.sql.constants import LOOKUP_SEP, MULTI, SINGLE
 from django.db.models.sql.where import AND, OR
 from django.db.utils import DatabaseError, IntegrityError
@@ -17,14 +20,23 @@ from boto.sdb.domain import Domain
 from djangotoolbox.db.basecompiler import NonrelQuery, NonrelCompiler, \
     NonrelInsertCompiler, NonrelUpdateCompiler, NonrelDeleteCompiler
 
+from simpledb.encoding import DATE_ISO8601, DATETIME_ISO8601, \
+    decimal_codec, decode_date, decode_datetime, decode_int, decode_long, \
+    encode_int, encode_long, format_date, format_datetime
 from simpledb.query import SimpleDBQuery
-from simpledb.utils import domain_for_model
+from simpledb.utils import AWS_MAX_BATCH_ITEMS, AWS_MAX_COMPARISONS, \
+    AWS_MAX_RESULT_SIZE, attribute_name, batches, chunks, concurrent_map, \
+    domain_for_item, domain_for_model, group_by_domain, quote, shard_count, \
+    shard_domains
 
 logger = logging.getLogger('simpledb')
-AWS_MAX_RESULT_SIZE = 2500
 
-# TODO: Change this to match your DB
-# Valid query types (a dictionary is used for speedy lookups).
+# Comparisons a select can need besides its filters: boto's `__type__` one,
+# the one sorting adds and parallel_scan's itemName() range
+RESERVED_COMPARISONS = 4
+
+# Valid query types (a dictionary is used for speedy lookups). Callables
+# take the lookup type and value, and return the operator and value to use.
 OPERATORS_MAP = {
     'exact': '=',
     'gt': '>',
@@ -32,10 +44,11 @@ OPERATORS_MAP = {
     'lt': '<',
     'lte': '<=',
     'isnull': lambda lookup_type, value: ('=' if value else '!=', None),
-
-    #'startswith': lambda lookup_type, value: ...,
-    #'range': lambda lookup_type, value: ...,
-    #'year': lambda lookup_type, value: ...,
+    'in': 'in',
+    'startswith': 'like',
+    'range': 'between',
+    # Year lookups are given the first moment of the year and of the next
+    'year': 'year',
 }
 
 NEGATION_MAP = {
@@ -45,16 +58,69 @@ NEGATION_MAP = {
     'lt': '>=',
     'lte': '>',
     'isnull': lambda lookup_type, value: ('!=' if value else '=', None),
-
-    #'startswith': lambda lookup_type, value: ...,
-    #'range': lambda lookup_type, value: ...,
-    #'year': lambda lookup_type, value: ...,
+    'in': 'not in',
+    'startswith': 'not like',
+    'range': 'not between',
+    'year': 'not year',
 }
 
-DATETIME_ISO8601 = '%Y-%m-%dT%H:%M:%S.%f'
-DATE_ISO8601 = '%Y-%m-%d'
+# Negated operators that have to hold for every value of a multi-valued
+# attribute, rather than any one of them
+EVERY_OPERATORS = set(['!=', '<=', '<', '>=', '>', 'not like'])
+
+def like_prefix(value):
+    """ A like pattern matching strings that start with value
+    """
+    return quote(value.replace('\\', '\\\\').replace('%', '\\%') + '%')
+
+def join_predicates(parts, connector):
+    """ Combine predicates with AND or OR, or None if there are none
+    """
+    if len(parts) > 1:
+        return '(%s)' % (' %s ' % connector.lower()).join(parts)
+    if parts:
+        return parts[0]
+    return None
+
+def predicate(name, op, value):
+    """ Build a select expression predicate comparing the attribute name with
+    an encoded value, or a list of them for in, between and year.
+    """
+    if value is None:
+        if op == '=':
+            return '%s is null' % name
+        return '%s is not null' % name
+    if op.startswith('not ') and op != 'not like':
+        return 'not (%s)' % predicate(name, op[4:], value)
+    if op == 'in':
+        if not value:
+            # Matches nothing - every item has a name
+            return 'itemName() is null'
+        return '%s in (%s)' % (name, ', '.join([quote(v) for v in value]))
+    if op == 'between':
+        return '%s between %s and %s' % (name, quote(value[0]),
+            quote(value[1]))
+    if op == 'year':
+        return '(%s >= %s and %s < %s)' % (name, quote(value[0]), name,
+            quote(value[1]))
+    if op in ('like', 'not like'):
+        return '%s %s %s' % (name, op, like_prefix(value))
+    return '%s %s %s' % (name, op, quote(value))
 
 def safe_call(func):
+    if inspect.isgeneratorfunction(func):
+        # Generators don't do any work until they're iterated, so errors
+        # need catching around the iteration rather than the call.
+        @wraps(func)
+        def _gen(*args, **kwargs):
+            try:
+                for value in func(*args, **kwargs):
+                    yield value
+            except (BotoClientError, SDBPersistenceError,
+                BotoServerError), e:
+                raise DatabaseError, DatabaseError(*tuple(e)), sys.exc_info()[2]
+        return _gen
+
     @wraps(func)
     def _func(*args, **kwargs):
         try:
@@ -64,29 +130,342 @@ def safe_call(func):
             raise DatabaseError, DatabaseError(*tuple(e)), sys.exc_info()[2]
     return _func
 
-def save_entity(connection, model, data):
-    domain_name = domain_for_model(model)
-    manager = connection.create_manager(domain_name)
+class BatchPutError(DatabaseError):
+    """ Raised by save_entities() when some of the items couldn't be saved.
+    ``ids`` holds the item name of every row, in order, and ``errors`` maps
+    the index of each failed row to the exception raised for it.
+    """
+    def __init__(self, ids, errors):
+        super(BatchPutError, self).__init__(
+            '%s of %s items failed to save' % (len(errors), len(ids)))
+        self.ids = ids
+        self.errors = errors
+
+def entity_attributes(domain_name, data):
+    """ Return the item name and attributes to store for a row of data.
+    SimpleDB has no nulls, so columns set to None aren't stored.
+    """
     attrs = {
         '__type__': domain_name,
     }
-    attrs.update(data)
+    for name, value in data.items():
+        if value is not None:
+            attrs[name] = value
     if not attrs.has_key('_id'):
-        # New item. Generate an ID.
-        attrs['_id'] = uuid.uuid4().int
-    domain = Domain(name=domain_name, connection=manager.sdb)
-    domain.put_attributes(attrs['_id'], attrs, replace=True)
-    return attrs['_id']
+        # New item. Generate an ID, encoded like any other long.
+        attrs['_id'] = encode_long(uuid.uuid4().int)
+    return attrs['_id'], attrs
+
+def invalidate_results(connection, domain_name):
+    """ Forget cached results, offsets and entities for a domain that's been
+    written to
+    """
+    if connection.result_cache is not None:
+        connection.result_cache.invalidate(domain_name)
+    if connection.offset_cache is not None:
+        connection.offset_cache.invalidate(domain_name)
+    if connection.identity_map is not None:
+        connection.identity_map.invalidate(domain_name)
+
+def save_entity(connection, model, data):
+    """ Save a row of data, returning its item name. Items fetched earlier
+    in the request are updated, writing only the attributes that changed.
+    Otherwise every attribute is put, and if the item might already exist,
+    those set to None are deleted.
+    """
+    domain_name = domain_for_model(model)
+    if '_id' in data and connection.identity_map is not None:
+        entity = connection.identity_map.get(domain_name, data['_id'])[1]
+        if entity is not None:
+            attrs = dict(data)
+            item_name = attrs.pop('_id')
+            update_changed(connection, model, [item_name], attrs)
+            return item_name
+    manager = connection.create_manager(domain_name)
+    # Items with generated names are new, so have no values to replace
+    replace = '_id' in data
+    item_name, attrs = entity_attributes(domain_name, data)
+    domain = Domain(name=domain_for_item(domain_name, item_name,
+        shard_count(connection, domain_name)), connection=manager.sdb)
+    try:
+        domain.put_attributes(item_name, attrs, replace=replace)
+        deleted = [name for name, value in data.items() if value is None]
+        if replace and deleted:
+            domain.delete_attributes(item_name, deleted)
+    finally:
+        invalidate_results(connection, domain_name)
+    return item_name
+
+def save_entities(connection, model, rows):
+    """ Save many rows with BatchPutAttributes, returning their ids in order.
+    Rows with ids might replace existing items, so as in save_entity, their
+    attributes set to None are deleted. If any rows fail, BatchPutError is
+    raised once every batch has been attempted, saying exactly which ones.
+    """
+    domain_name = domain_for_model(model)
+    manager = connection.create_manager(domain_name)
+    items = [entity_attributes(domain_name, data) for data in rows]
+    # Items with generated names are new, so have no values to delete
+    deleted = [[name for name, value in data.items()
+            if value is None and '_id' in data]
+        for data in rows]
+    # Each shard's items are saved separately, so group their indexes
+    shards = shard_count(connection, domain_name)
+    groups = {}
+    for index, (item_name, attrs) in enumerate(items):
+        groups.setdefault(domain_for_item(domain_name, item_name, shards),
+            []).append(index)
+    errors = {}
+    try:
+        for shard, indexes in groups.items():
+            domain = Domain(name=shard, connection=manager.sdb)
+            try:
+                _save_entities(domain, [items[index] for index in indexes],
+                    [deleted[index] for index in indexes])
+            except BatchPutError, e:
+                for index, error in e.errors.items():
+                    errors[indexes[index]] = error
+    finally:
+        invalidate_results(connection, domain_name)
+    ids = [item_name for item_name, attrs in items]
+    if errors:
+        raise BatchPutError(ids, errors)
+    return ids
+
+def _save_entities(domain, items, deleted):
+    errors = {}
+    # Batches are contiguous runs of items, so track the index of the first
+    # item in each.
+    offset = 0
+    for batch in batches(items):
+        try:
+            domain.batch_put_attributes(dict(batch), replace=True)
+        except BotoServerError:
+            # SimpleDB rejects a batch as a whole without saying which item
+            # was at fault, so retry the items one at a time to find out.
+            for index, (item_name, attrs) in enumerate(batch):
+                try:
+                    domain.put_attributes(item_name, attrs, replace=True)
+                except (BotoClientError, SDBPersistenceError,
+                        BotoServerError), e:
+                    errors[offset + index] = e
+        offset += len(batch)
+    # Items that failed to save keep their old attributes too
+    deletes = [index for index in range(len(items))
+        if deleted[index] and index not in errors]
+    offset = 0
+    for batch in batches([(items[index][0], dict.fromkeys(deleted[index]))
+            for index in deletes]):
+        try:
+            batch_delete_names(domain, [(item_name, names.keys())
+                for item_name, names in batch])
+        except BotoServerError:
+            for index, (item_name, names) in enumerate(batch):
+                try:
+                    domain.delete_attributes(item_name, names.keys())
+                except (BotoClientError, BotoServerError), e:
+                    errors[deletes[offset + index]] = e
+        offset += len(batch)
+    ids = [item_name for item_name, attrs in items]
+    if errors:
+        raise BatchPutError(ids, errors)
+    return ids
+
+def batch_delete_names(domain, items):
+    """ Delete every value of the named attributes of up to 25 items, given
+    as (item name, attribute names) pairs, with one BatchDeleteAttributes
+    request. boto's batch_delete_attributes() only deletes the values it's
+    given, so the request is built here.
+    """
+    params = {'DomainName': domain.name}
+    for i, (item_name, names) in enumerate(items):
+        params['Item.%d.ItemName' % i] = item_name
+        for j, name in enumerate(names):
+            params['Item.%d.Attribute.%d.Name' % (i, j)] = name
+    return domain.connection.get_status('BatchDeleteAttributes', params,
+        verb='POST')
+
+
+def same_value(stored, value):
+    """ Whether an encoded value is what's stored in an attribute, which is
+    None if it's missing. Multiple values are compared in any order.
+    """
+    if stored is None or value is None:
+        return stored is value
+    if not isinstance(stored, list):
+        stored = [stored]
+    if not isinstance(value, (list, tuple)):
+        value = [value]
+    return sorted(map(unicode, stored)) == sorted(map(unicode, value))
+
+def changed_attributes(connection, domain_name, item_name, attrs):
+    """ The attrs that differ from the item as it was fetched during this
+    request, or all of them if it wasn't.
+    """
+    if connection.identity_map is None:
+        return attrs
+    entity = connection.identity_map.get(domain_name, item_name)[1]
+    if entity is None:
+        return attrs
+    return dict([(name, value) for name, value in attrs.items()
+        if not same_value(entity.get(name), value)])
+
+def update_changed(connection, model, item_names, attrs, expected=None):
+    """ update_entities(), writing each item's changed attributes only.
+    Items with nothing changed aren't written, but are counted as updated.
+    """
+    domain_name = domain_for_model(model)
+    groups = {}
+    for item_name in item_names:
+        changed = changed_attributes(connection, domain_name, item_name,
+            attrs)
+        groups.setdefault(tuple(sorted(changed)), []).append(item_name)
+    updated = len(groups.pop((), ()))
+    for names, group in groups.items():
+        updated += update_entities(connection, model, group,
+            dict([(name, attrs[name]) for name in names]), expected)
+    return updated
+
+def update_entities(connection, model, item_names, attrs, expected=None):
+    """ Set attrs on every named item, returning how many were updated.
+    Attributes set to None are deleted. Chunks of items are written with
+    BatchPutAttributes, up to BATCH_CONCURRENCY at a time. Given an expected
+    (name, value) pair, items are put one at a time on condition that they
+    still have that value, and those that don't aren't counted.
+    """
+    domain_name = domain_for_model(model)
+    values = dict([(name, value) for name, value in attrs.items()
+        if value is not None])
+    deleted = [name for name, value in attrs.items() if value is None]
+
+    def update((shard, chunk)):
+        manager = connection.create_manager(domain_name)
+        domain = Domain(name=shard, connection=manager.sdb)
+        if expected is None:
+            if values:
+                domain.batch_put_attributes(
+                    dict([(item_name, values) for item_name in chunk]),
+                    replace=True)
+            if deleted:
+                batch_delete_names(domain,
+                    [(item_name, deleted) for item_name in chunk])
+            return len(chunk)
+        updated = 0
+        for item_name in chunk:
+            try:
+                if values:
+                    domain.put_attributes(item_name, values, replace=True,
+                        expected_value=expected)
+                    if deleted:
+                        domain.delete_attributes(item_name, deleted)
+                else:
+                    domain.delete_attributes(item_name, deleted,
+                        expected_values=expected)
+            except BotoServerError, e:
+                if e.error_code not in ('ConditionalCheckFailed',
+                        'AttributeDoesNotExist'):
+                    raise
+            else:
+                updated += 1
+        return updated
+
+    workers = connection.settings_dict.get('BATCH_CONCURRENCY', 1)
+    shard_chunks = [(shard, chunk) for shard, names in group_by_domain(
+            domain_name, item_names, shard_count(connection, domain_name))
+        for chunk in chunks(names, AWS_MAX_BATCH_ITEMS)]
+    try:
+        return sum(concurrent_map(update, shard_chunks, workers))
+    finally:
+        invalidate_results(connection, domain_name)
+
+def reencode_value(db_type, value):
+    """ Decode a stored value and encode it again, in the current format
+    """
+    if db_type.startswith('ListField:') and not isinstance(value, list):
+        # Lists of one item come back from SimpleDB as plain values
+        value = [value]
+    return for_db_converter(db_type)(from_db_converter(db_type)(value))
+
+def reencode(connection, model):
+    """ Rewrite every item of model's domain whose values (or name) aren't
+    stored in the current format, such as numbers saved before they were
+    encoded. Items are handled a page at a time; renamed items are written
+    under their new name before the old one is deleted. Returns the number
+    of items rewritten. Running it again does nothing.
+    """
+    domain_name = domain_for_model(model)
+    shards = shard_count(connection, domain_name)
+    rewritten = 0
+    for shard in shard_domains(domain_name, shards):
+        rewritten += _reencode(connection, model, shard, shards)
+    return rewritten
+
+def _reencode(connection, model, shard, shards):
+    domain_name = domain_for_model(model)
+    manager = connection.create_manager(domain_name)
+    domain = Domain(name=shard, connection=manager.sdb)
+    meta = model._meta
+    pk_type = meta.pk.db_type(connection=connection)
+    columns = [(f.column, f.db_type(connection=connection))
+        for f in meta.fields if not f.primary_key] + [('_id', pk_type)]
+    query = 'select * from `%s`' % shard
+    rewritten = 0
+    next_token = None
+    while True:
+        rs = manager.sdb.select(domain, query, next_token=next_token)
+        # Renamed items can belong in another shard
+        puts, renamed = {}, []
+        for item in rs:
+            changed = {}
+            for column, db_type in columns:
+                if column in item:
+                    value = reencode_value(db_type, item[column])
+                    if value != item[column]:
+                        changed[column] = value
+            item_name = reencode_value(pk_type, item.name)
+            if item_name != item.name:
+                attrs = dict(item)
+                attrs.update(changed)
+                puts.setdefault(domain_for_item(domain_name, item_name,
+                    shards), []).append((item_name, attrs))
+                renamed.append(item.name)
+            elif changed:
+                puts.setdefault(shard, []).append((item_name, changed))
+        for target, items in puts.items():
+            target_domain = Domain(name=target, connection=manager.sdb)
+            for batch in batches(items):
+                target_domain.batch_put_attributes(dict(batch), replace=True)
+            rewritten += len(items)
+        for batch in chunks(renamed, AWS_MAX_BATCH_ITEMS):
+            domain.batch_delete_attributes(
+                dict([(item_name, None) for item_name in batch]))
+        if puts:
+            invalidate_results(connection, domain_name)
+        next_token = rs.next_token
+        if not next_token:
+            return rewritten
 
 
 class BackendQuery(NonrelQuery):
+    # How many values of a long in list go in each select
+    chunk_size = AWS_MAX_COMPARISONS
 
     def __init__(self, compiler, fields):
         super(BackendQuery, self).__init__(compiler, fields)
         # TODO: add your initialization code here
         domain = domain_for_model(self.query.model)
+        settings = self.connection.settings_dict
         self.db_query = SimpleDBQuery(
-            self.connection.create_manager(domain), self.query.model)
+            self.connection.create_manager(domain), self.query.model,
+            manager_factory=self.connection.create_manager,
+            workers=settings.get('BATCH_CONCURRENCY', 1),
+            offset_cache=self.connection.offset_cache,
+            read_ahead=settings.get('READ_AHEAD', 0),
+            count_cache=self.connection.count_cache,
+            columns=fields and [f.column for f in fields],
+            result_cache=self.connection.result_cache,
+            identity_map=self.connection.identity_map,
+            shards=shard_count(self.connection, domain))
 
     # This is needed for debugging
     def __repr__(self):
@@ -95,33 +474,26 @@ class BackendQuery(NonrelQuery):
 
     @safe_call
     def fetch(self, low_mark=None, high_mark=None):
-        reslice = 0
-        if high_mark > AWS_MAX_RESULT_SIZE:
-            logger.warn('Requested result size %s, assuming infinite' % (
-                high_mark))
-            reslice = high_mark
-            high_mark = None
-        # TODO: run your low-level query here
-        #low_mark, high_mark = self.limits
+        # Results are streamed from SimpleDB a page at a time, and no more
+        # pages are requested than are needed to reach high_mark.
+        low_mark = low_mark or 0
         if high_mark is None:
             # Infinite fetching
             results = self.db_query.fetch_infinite(offset=low_mark)
-            if reslice:
-                results = list(results)[:reslice]
         elif high_mark > low_mark:
             # Range fetching
             results = self.db_query.fetch_range(high_mark - low_mark, low_mark)
         else:
             results = ()
 
+        pk_column = self.query.get_meta().pk.column
         for entity in results:
-            entity[self.query.get_meta().pk.column] = entity['_id']
+            entity[pk_column] = entity['_id']
             del entity['_id']
             yield entity
 
     @safe_call
     def count(self, limit=None):
-        # TODO: implement this
         return self.db_query.count(limit)
 
     @safe_call
@@ -140,50 +512,371 @@ class BackendQuery(NonrelQuery):
                 column = '_id'
             self.db_query.add_ordering(column, direction)
 
-    # This function is used by the default add_filters() implementation which
-    # only supports ANDed filter rules and simple negation handling for
-    # transforming OR filters to AND filters:
-    # NOT (a OR b) => (NOT a) AND (NOT b)
+    @safe_call
+    def add_filters(self, filters):
+        """ Compile the where tree into the select expression. ANDed filters
+        at the top are added one by one, so long in lists can be split into
+        separate selects; groups become parenthesized predicates, with
+        negations pushed down to the lookups, and are split into several
+        selects too if they hold long in lists. Queries on nothing but the
+        pk are served with GetAttributes instead.
+        """
+        if self.connection.settings_dict.get('GET_BY_PK', True):
+            keys = self._pk_values(filters)
+            if keys is not None:
+                self.db_query.keys = keys
+                return
+        self.chunk_size = self._chunk_size(filters)
+        if filters.negated or filters.connector != AND:
+            children = [filters]
+        else:
+            children = self._get_children(filters.children)
+        for child in children:
+            negated, lookup = self._negated_lookup(child)
+            if lookup is not None:
+                column, lookup_type, db_type, value = lookup
+                self.add_filter(column, lookup_type, negated, db_type, value)
+            else:
+                self.db_query.add_split(self._alternatives(child, False),
+                    overlapping=True)
+
+    def _lookup(self, node):
+        """ The column, lookup type, db_type and value of the only lookup in
+        a where tree node, if it's not negated, otherwise None.
+        """
+        while isinstance(node, Node):
+            children = self._get_children(node.children)
+            if node.negated or len(children) != 1:
+                return None
+            node = children[0]
+        return self._decode_child(node)
+
+    def _leaves(self, node, negated):
+        """ Generate whether each lookup in a where tree node is negated, and
+        its column, lookup type, db_type and value.
+        """
+        if node.negated:
+            negated = not negated
+        for child in self._get_children(node.children):
+            if isinstance(child, Node):
+                for leaf in self._leaves(child, negated):
+                    yield leaf
+            else:
+                yield negated, self._decode_child(child)
+
+    def _chunk_size(self, filters):
+        """ How many values of each in list fit in one select, sharing
+        SimpleDB's limit on comparisons with the rest of the filters.
+        """
+        fixed, lists, values = RESERVED_COMPARISONS, 0, 0
+        for negated, lookup in self._leaves(filters, False):
+            column, lookup_type, db_type, value = lookup
+            if lookup_type == 'in' and not negated:
+                lists += 1
+                values += len(value)
+            elif lookup_type == 'in':
+                fixed += len(value)
+            elif lookup_type in ('range', 'year'):
+                fixed += 2
+            else:
+                fixed += 1
+        if not lists or fixed + values <= AWS_MAX_COMPARISONS:
+            return AWS_MAX_COMPARISONS
+        return max(1, (AWS_MAX_COMPARISONS - fixed) // lists)
+
+    def _negated_lookup(self, node):
+        """ Whether the only lookup in a where tree node is negated, and the
+        lookup's column, lookup type, db_type and value - or None instead of
+        the lookup, if the node holds several.
+        """
+        negated = False
+        while isinstance(node, Node):
+            children = self._get_children(node.children)
+            if len(children) != 1:
+                return negated, None
+            if node.negated:
+                negated = not negated
+            node = children[0]
+        return negated, self._decode_child(node)
+
+    def _pk_values(self, filters):
+        """ The encoded item names, if the where tree is a single exact or in
+        lookup on the pk, otherwise None.
+        """
+        lookup = self._lookup(filters)
+        if lookup is None:
+            return None
+        column, lookup_type, db_type, value = lookup
+        if column != self.query.get_meta().pk.column:
+            return None
+        if lookup_type == 'exact':
+            value = [value]
+        elif lookup_type != 'in':
+            return None
+        return [self.convert_value_for_db(db_type, v) for v in value]
+
+    def expected_value(self):
+        """ An (attribute name, encoded value) pair that every matching item
+        has, from an exact filter ANDed at the top of the where tree, or None
+        if there isn't one.
+        """
+        filters = self.query.where
+        if filters.negated or filters.connector != AND:
+            return None
+        pk_column = self.query.get_meta().pk.column
+        for child in self._get_children(filters.children):
+            lookup = self._lookup(child)
+            if lookup is None:
+                continue
+            column, lookup_type, db_type, value = lookup
+            if (lookup_type == 'exact' and column != pk_column and
+                    value is not None and not db_type.startswith('ListField:')):
+                return column, self.convert_value_for_db(db_type, value)
+        return None
+
+    def _add_expression(self, expression):
+        if expression:
+            self.db_query.add_predicate(expression)
+
+    def _alternatives(self, node, negated):
+        """ Predicates for a where tree node that match what it does when
+        ORed, each small enough for one select. They're only split up where
+        long in lists would put too many comparisons in a single select:
+        (a in (...) or b) and c => (a in (<chunk>) and c) or ... or (b and c)
+        """
+        if node.negated:
+            negated = not negated
+        connector = node.connector
+        if negated:
+            connector = connector == AND and OR or AND
+        groups = []
+        for child in self._get_children(node.children):
+            if isinstance(child, Node):
+                group = self._alternatives(child, negated)
+            else:
+                column, lookup_type, db_type, value = self._decode_child(child)
+                name, op, db_value = self._compile_filter(column, lookup_type,
+                    negated, db_type, value)
+                if op == 'in' and len(db_value) > self.chunk_size:
+                    group = [predicate(name, op, values)
+                        for values in chunks(db_value, self.chunk_size)]
+                else:
+                    group = [predicate(name, op, db_value)]
+            group = [part for part in group if part]
+            if group:
+                groups.append(group)
+        if not groups:
+            return []
+        if connector == OR:
+            # ORed groups that fit in one select stay together
+            single = [group[0] for group in groups if len(group) == 1]
+            split = [part for group in groups if len(group) > 1
+                for part in group]
+            if single:
+                split.insert(0, join_predicates(single, OR))
+            return split
+        return [join_predicates(list(parts), AND)
+            for parts in itertools.product(*groups)]
+
     @safe_call
     def add_filter(self, column, lookup_type, negated, db_type, value):
-        # TODO: implement this or the add_filters() function (see the base
-        # class for a sample implementation)
+        name, op, db_value = self._compile_filter(column, lookup_type,
+            negated, db_type, value)
+        if op == 'in' and len(db_value) > self.chunk_size:
+            # Too many values for one select, so run a select per chunk of
+            # them and merge the results. Lists can have values from several
+            # chunks, so match more than one.
+            self.db_query.add_split([predicate(name, op, values)
+                for values in chunks(db_value, self.chunk_size)],
+                overlapping=db_type.startswith('ListField:'))
+        else:
+            self.db_query.add_predicate(predicate(name, op, db_value))
 
+    def _compile_filter(self, column, lookup_type, negated, db_type, value):
+        """ Return the attribute name, operator and encoded value to compare
+        for a filter.
+        """
         # Emulated/converted lookups
         if column == self.query.get_meta().pk.column:
             column = '_id'
 
-        # Special-case IN
-        if lookup_type == 'in':
-            if negated:
-                # XXX needs testing, error for now.
-                raise NotImplementedError
-                #op = '!='
-            else:
-                op = '='
-            # boto needs IN queries' values to be lists of lists.
-            db_value = [[self.convert_value_for_db(db_type, v)] for v in value]
+        if negated:
+            try:
+                op = NEGATION_MAP[lookup_type]
+            except KeyError:
+                raise DatabaseError("Lookup type %r can't be negated" % lookup_type)
         else:
-            if negated:
-                try:
-                    op = NEGATION_MAP[lookup_type]
-                except KeyError:
-                    raise DatabaseError("Lookup type %r can't be negated" % lookup_type)
-            else:
-                try:
-                    op = OPERATORS_MAP[lookup_type]
-                except KeyError:
-                    raise DatabaseError("Lookup type %r isn't supported" % lookup_type)
+            try:
+                op = OPERATORS_MAP[lookup_type]
+            except KeyError:
+                raise DatabaseError("Lookup type %r isn't supported" % lookup_type)
+
+        # Handle special-case lookup types
+        if callable(op):
+            op, value = op(lookup_type, value)
+
+        name = attribute_name(column)
+        if db_type.startswith('ListField:'):
+            # Lookups on lists compare their items
+            db_type = db_type.split(':', 1)[1]
+            if negated and op in EVERY_OPERATORS and value is not None:
+                name = 'every(%s)' % name
+        if lookup_type == 'year' and db_type == 'date':
+            value = [v.date() for v in value]
+        if lookup_type in ('in', 'range', 'year'):
+            db_value = [self.convert_value_for_db(db_type, v) for v in value]
+        else:
+            db_value = self.convert_value_for_db(db_type, value)
+        if op == 'not in' and \
+                len(db_value) > AWS_MAX_COMPARISONS - RESERVED_COMPARISONS:
+            # Every excluded value has to be compared in the same select,
+            # so there's no splitting them up
+            raise DatabaseError("Can't exclude more than %d values at once" %
+                (AWS_MAX_COMPARISONS - RESERVED_COMPARISONS))
+        return name, op, db_value
+
+@safe_call
+def parallel_scan(queryset, segments=16, ordered=False, points=None):
+    """ Iterate over the model instances in queryset with
+    SimpleDBQuery.parallel_scan, scanning itemName() ranges of the domain
+    concurrently. Up to the BATCH_CONCURRENCY setting ranges run at once.
+    """
+    compiler = queryset.query.get_compiler(using=queryset.db)
+    fields = compiler.get_fields()
+    query = compiler.build_query(fields)
+    pk_column = queryset.model._meta.pk.column
+    for entity in query.db_query.parallel_scan(segments, ordered, points):
+        entity[pk_column] = entity.pop('_id')
+        yield queryset.model(*compiler._make_result(entity, fields))
+
+# Converters are built once per db_type, so converting a value is a dict
+# lookup and a call rather than a walk down a chain of comparisons.
+
+def _decode_str(value):
+    # Always retrieve strings as unicode
+    if isinstance(value, str):
+        return value.decode('utf-8')
+    return value
+
+def _decode_bool(value):
+    return value != '0'
+
+_FROM_DB = {
+    # Numbers are encoded to sort as strings
+    'long': decode_long,
+    'int': decode_int,
+    # Dates and datetimes are encoded as ISO 8601
+    'date': decode_date,
+    'datetime': decode_datetime,
+    'bool': _decode_bool,
+}
 
-            # Handle special-case lookup types
-            if callable(op):
-                op, value = op(lookup_type, value)
+def _build_from_db(db_type):
+    if db_type.startswith('ListField:'):
+        # Handle list types
+        convert_item = from_db_converter(db_type.split(':', 1)[1])
+        def convert(value):
+            if isinstance(value, (list, tuple)) and len(value):
+                return [convert_item(v) for v in value]
+            return _decode_str(value)
+        return convert
+    if db_type.startswith('decimal:'):
+        return _decimal_codec(db_type)[1]
+    return _FROM_DB.get(db_type, _decode_str)
+
+_from_db_converters = {}
+
+def from_db_converter(db_type):
+    """ Return a function converting values of db_type read from SimpleDB
+    """
+    try:
+        return _from_db_converters[db_type]
+    except KeyError:
+        converter = _from_db_converters[db_type] = _build_from_db(db_type)
+        return converter
+
+def _encode_bool(value):
+    if value:
+        return u'1'
+    return u'0'
+
+def _encode_int(value):
+    return str(value).decode('ascii')
+
+def _decimal_codec(db_type):
+    # db_type is 'decimal:<max_digits>,<decimal_places>'
+    max_digits, decimal_places = db_type.split(':', 1)[1].split(',')
+    return decimal_codec(int(max_digits), int(decimal_places))
+
+def _nullable(encode):
+    def convert(value):
+        if value is None:
+            return None
+        return encode(value)
+    return convert
+
+# Encoders for db_types that decide how a value is stored
+_FOR_DB = {
+    'bool': _encode_bool,
+    'long': _nullable(encode_long),
+    'int': _nullable(encode_int),
+}
 
-            db_value = self.convert_value_for_db(db_type, value)
+# Encoders for values whose db_type doesn't decide, by exact type
+_FOR_DB_BY_TYPE = {
+    # Always store strings as unicode
+    str: _decode_str,
+    datetime.datetime: format_datetime,
+    datetime.date: format_date,
+    int: _encode_int,
+    long: _encode_int,
+}
+
+def _encode_value(value):
+    try:
+        encode = _FOR_DB_BY_TYPE[type(value)]
+    except KeyError:
+        # Subclasses of the types above, including bool
+        if isinstance(value, str):
+            return _decode_str(value)
+        elif isinstance(value, datetime.datetime):
+            return format_datetime(value)
+        elif isinstance(value, datetime.date):
+            return format_date(value)
+        elif isinstance(value, (int, long)):
+            return _encode_int(value)
+        return value
+    return encode(value)
+
+def _build_for_db(db_type):
+    if db_type in _FOR_DB:
+        return _FOR_DB[db_type]
+    if db_type.startswith('decimal:'):
+        return _nullable(_decimal_codec(db_type)[0])
+    if db_type.startswith('ListField:'):
+        convert_item = for_db_converter(db_type.split(':', 1)[1])
+        def convert(value):
+            if isinstance(value, (list, tuple)) and len(value):
+                return [convert_item(v) for v in value]
+            return _encode_value(value)
+        return convert
+    return _encode_value
+
+_for_db_converters = {}
+
+def for_db_converter(db_type):
+    """ Return a function converting values of db_type for storage
+    """
+    try:
+        return _for_db_converters[db_type]
+    except KeyError:
+        converter = _for_db_converters[db_type] = _build_for_db(db_type)
+        return converter
+
+# Per-(connection, fields) lists of (field, column, converter), used to turn
+# entities into result rows in a single pass.
+_result_converters = {}
 
-        # XXX check this is right
-        self.db_query.filter('%s %s' % (column, op), db_value)
-        #self.db_query.filter(column, op, db_value)
 
 class SQLCompiler(NonrelCompiler):
     query_class = BackendQuery
@@ -191,57 +884,35 @@ class SQLCompiler(NonrelCompiler):
     # This gets called for each field type when you fetch() an entity.
     # db_type is the string that you used in the DatabaseCreation mapping
     def convert_value_from_db(self, db_type, value):
-        # Handle list types
-        if isinstance(value, (list, tuple)) and len(value) and \
-                db_type.startswith('ListField:'):
-            db_sub_type = db_type.split(':', 1)[1]
-            value = [self.convert_value_from_db(db_sub_type, subvalue)
-                     for subvalue in value]
-        elif db_type == 'long':
-            value = long(value)
-        elif db_type == 'int':
-            value = int(value)
-        # Dates and datetimes are encoded as ISO 8601
-        elif db_type == 'date':
-            value = datetime.datetime.strptime(value, DATE_ISO8601).date()
-        elif db_type == 'datetime':
-            value = datetime.datetime.strptime(value, DATETIME_ISO8601)
-        elif db_type == 'bool':
-            if value == '0':
-                value = False
-            else:
-                value = True
-        elif isinstance(value, str):
-            # Always retrieve strings as unicode
-            value = value.decode('utf-8')
-        return value
+        return from_db_converter(db_type)(value)
 
     # This gets called for each field type when you insert() an entity.
     # db_type is the string that you used in the DatabaseCreation mapping
     def convert_value_for_db(self, db_type, value):
-        # TODO: implement this
-        if db_type == 'bool':
-            if value:
-                value = u'1'
-            else:
-                value = u'0'
-        elif isinstance(value, str):
-            # Always store strings as unicode
-            value = value.decode('utf-8')
-        elif isinstance(value, (list, tuple)) and len(value) and \
-                db_type.startswith('ListField:'):
-            db_sub_type = db_type.split(':', 1)[1]
-            value = [self.convert_value_for_db(db_sub_type, subvalue)
-                     for subvalue in value]
-        elif isinstance(value, datetime.datetime):
-            value = value.strftime(DATETIME_ISO8601)
-        elif isinstance(value, datetime.date):
-            value = value.strftime(DATE_ISO8601)
-        elif isinstance(value, (int, long)):
-            value = str(value).decode('ascii')
-
         # XXX string quoting rules
-        return value
+        return for_db_converter(db_type)(value)
+
+    def _make_result(self, entity, fields):
+        key = (self.connection.alias, tuple(fields))
+        try:
+            converters = _result_converters[key]
+        except KeyError:
+            converters = _result_converters[key] = [
+                (f, f.column, from_db_converter(
+                    f.db_type(connection=self.connection)))
+                for f in fields]
+        result = []
+        for field, column, convert in converters:
+            value = entity.get(column, NOT_PROVIDED)
+            if value is NOT_PROVIDED:
+                value = field.get_default()
+            else:
+                value = convert(value)
+            if value is None and not field.null:
+                raise IntegrityError("Non-nullable field %s can't be None!" %
+                    field.name)
+            result.append(value)
+        return result
 
 # This handles both inserts and updates of individual entities
 class SQLInsertCompiler(NonrelInsertCompiler, SQLCompiler):
@@ -251,11 +922,98 @@ class SQLInsertCompiler(NonrelInsertCompiler, SQLCompiler):
         if pk_column in data:
             data['_id'] = data[pk_column]
             del data[pk_column]
-        pk = save_entity(self.connection, self.query.model, data)
-        return pk
+        item_name = save_entity(self.connection, self.query.model, data)
+        return self.convert_pk_from_db(item_name)
+
+    def convert_pk_from_db(self, item_name):
+        pk = self.query.get_meta().pk
+        return self.convert_value_from_db(
+            pk.db_type(connection=self.connection), item_name)
+
+    @safe_call
+    def insert_many(self, rows):
+        """ Multi-row version of insert(). Each row is a dict of converted
+        values, as passed to insert(). Returns the pks in the same order.
+        """
+        pk_column = self.query.get_meta().pk.column
+        for data in rows:
+            if pk_column in data:
+                data['_id'] = data[pk_column]
+                del data[pk_column]
+        item_names = save_entities(self.connection, self.query.model, rows)
+        return [self.convert_pk_from_db(name) for name in item_names]
+
+    def bulk_insert(self, objs):
+        """ Insert many model instances at once, setting the pk of any that
+        didn't have one.
+        """
+        meta = self.query.get_meta()
+        rows = []
+        for obj in objs:
+            data = {}
+            for field in meta.local_fields:
+                value = field.pre_save(obj, True)
+                if field.primary_key and value is None:
+                    continue
+                value = field.get_db_prep_save(value,
+                    connection=self.connection)
+                if not field.null and value is None:
+                    raise IntegrityError("You can't set %s (a non-nullable "
+                                         "field) to None!" % field.name)
+                data[field.column] = self.convert_value_for_db(
+                    field.db_type(connection=self.connection), value)
+            rows.append(data)
+        pks = self.insert_many(rows)
+        for obj, pk in zip(objs, pks):
+            if obj.pk is None:
+                setattr(obj, meta.pk.attname, pk)
+        return pks
 
 class SQLUpdateCompiler(NonrelUpdateCompiler, SQLCompiler):
-    pass
+    @safe_call
+    def execute_sql(self, result_type=MULTI):
+        """ Update the matching items in place, returning how many were
+        updated. Only their names are selected, and only the updated
+        attributes are written - just the changed ones, for items fetched
+        earlier in the request. With CONDITIONAL_UPDATES, an exact filter is
+        checked again as each item is written, so items changed since the
+        select are left alone.
+        """
+        meta = self.query.get_meta()
+        attrs = {}
+        for field, model, value in self.query.values:
+            if field.primary_key:
+                raise DatabaseError("Primary keys can't be updated")
+            if hasattr(value, 'evaluate'):
+                raise DatabaseError("F() expressions can't be used in updates")
+            if hasattr(value, 'prepare_database_save'):
+                value = value.prepare_database_save(field)
+            else:
+                value = field.get_db_prep_save(value,
+                    connection=self.connection)
+            if not field.null and value is None:
+                raise IntegrityError("You can't set %s (a non-nullable "
+                                     "field) to None!" % field.name)
+            attrs[field.column] = self.convert_value_for_db(
+                field.db_type(connection=self.connection), value)
+
+        query = self.build_query([meta.pk])
+        expected = None
+        if self.connection.settings_dict.get('CONDITIONAL_UPDATES'):
+            expected = query.expected_value()
+        # Names are all read before writing, so the writes can't move items
+        # in or out of the select being paged through.
+        item_names = list(query.db_query.item_names())
+        if self.query.related_updates:
+            # Fields of parent models are updated on the same pks
+            pk_db_type = meta.pk.db_type(connection=self.connection)
+            self.query.related_ids = [
+                self.convert_value_from_db(pk_db_type, item_name)
+                for item_name in item_names]
+            for related in self.query.get_related_updates():
+                related.get_compiler(self.using).execute_sql(result_type)
+        return update_changed(self.connection, self.query.model, item_names,
+            attrs, expected)
 
 class SQLDeleteCompiler(NonrelDeleteCompiler, SQLCompiler):
     pass
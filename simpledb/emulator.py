@@ -0,0 +1,1093 @@
+"""
+An in-process stand-in for SimpleDB, for tests and benchmarks.
+
+Setting ``EMULATOR`` on a database - to True, or to a name, so that several
+databases can share an emulator or keep apart - sends its requests to an
+Emulator instead of AWS. Requests still go through boto, so signing,
+retries and XML parsing all happen as usual; only the HTTP round trip is
+replaced, by a call into the Emulator and ``EMULATOR_LATENCY`` seconds of
+sleep.
+
+The Emulator keeps its domains in memory, with every attribute indexed by
+value, so equality, range and prefix predicates look their items up instead
+of scanning the domain. It implements the select grammar, NextToken paging,
+SimpleDB's request limits and error codes, and adds up a rough box usage for
+every request. Unlike SimpleDB, it's always consistent.
+"""
+import base64
+import bisect
+import httplib
+import json
+import operator
+import re
+import threading
+import time
+import urlparse
+import uuid
+
+from xml.sax.saxutils import escape
+
+from simpledb.retry import RetryingSDBConnection, RetryingSDBManager
+from simpledb.utils import AWS_MAX_BATCH_ITEMS, AWS_MAX_COMPARISONS, \
+    AWS_MAX_RESULT_SIZE, LRUCache, attributes_size
+
+# Name/value pairs an item can have, and a single put can send
+MAX_ATTRIBUTES = 256
+# Longest item name, attribute name or value, in bytes
+MAX_VALUE_BYTES = 1024
+# Selects stop adding items to a response once it's this big
+MAX_RESPONSE_BYTES = 1024 * 1024
+# Items a select returns when it has no limit clause
+DEFAULT_LIMIT = 100
+
+# Box usage of each request, in machine hours, roughly as SimpleDB charges
+# small requests. Writes are charged per item, plus ATTRIBUTE_BOX_USAGE for
+# each attribute value sent, and selects ITEM_BOX_USAGE for each item
+# returned or counted. Good for comparing workloads, not predicting bills.
+BOX_USAGE = {
+    'CreateDomain': 0.0055590278,
+    'DeleteDomain': 0.0055590278,
+    'ListDomains': 0.0000071759,
+    'DomainMetadata': 0.0000071759,
+    'GetAttributes': 0.0000093282,
+    'PutAttributes': 0.0000219907,
+    'BatchPutAttributes': 0.0000219907,
+    'DeleteAttributes': 0.0000219907,
+    'BatchDeleteAttributes': 0.0000219907,
+    'Select': 0.0000137200,
+}
+ATTRIBUTE_BOX_USAGE = 0.0000000340
+ITEM_BOX_USAGE = 0.0000000160
+
+DOMAIN_NAME = re.compile(r'^[a-zA-Z0-9_.-]{3,255}$')
+# Characters XML can't carry, which SimpleDB sends base64 encoded. Carriage
+# returns are included, as XML parsers turn them into newlines.
+UNSAFE_XML = re.compile(u'[^\t\n\x20-\ud7ff\ue000-\ufffd]')
+
+class SimpleDBError(Exception):
+    """ An error response, as SimpleDB would send it
+    """
+
+    def __init__(self, status, code, message):
+        Exception.__init__(self, status, code, message)
+        self.status = status
+        self.code = code
+        self.message = message
+
+def no_such_domain(domain_name):
+    return SimpleDBError(400, 'NoSuchDomain',
+        'The specified domain does not exist: %s' % domain_name)
+
+def invalid_query(message):
+    return SimpleDBError(400, 'InvalidQueryExpression', message)
+
+# Select expressions
+
+TOKEN = re.compile(r"""\s*(?:
+    (?P<name>`(?:[^`]|``)*`) |
+    (?P<string>'(?:[^']|'')*'|"(?:[^"]|"")*") |
+    (?P<symbol>!=|<=|>=|[=<>(),*]) |
+    (?P<word>[A-Za-z_$][\w$]*) |
+    (?P<number>\d+))""", re.X | re.U)
+
+def tokenize(expression):
+    """ Split a select expression into (kind, value, offset) tuples
+    """
+    tokens = []
+    position = 0
+    expression = expression.rstrip()
+    while position < len(expression):
+        match = TOKEN.match(expression, position)
+        if match is None:
+            raise invalid_query('Invalid select expression near: %s' %
+                expression[position:position + 20])
+        kind = match.lastgroup
+        value = match.group(kind)
+        if kind == 'name':
+            value = value[1:-1].replace('``', '`')
+        elif kind == 'string':
+            value = value[1:-1].replace(value[0] * 2, value[0])
+        tokens.append((kind, value, match.start(kind)))
+        position = match.end()
+    return tokens
+
+def like_pattern(pattern):
+    """ Compile a like pattern, where % matches any characters and a
+    backslash escapes the next one. Returns the regex, the literal prefix
+    before the first wildcard, and whether there are no wildcards at all.
+    """
+    regex, prefix = [], None
+    chars = iter(pattern)
+    literal = []
+    for char in chars:
+        if char == '\\':
+            char = next(chars, '\\')
+        elif char == '%':
+            if prefix is None:
+                prefix = u''.join(literal)
+            regex.append('.*')
+            continue
+        literal.append(char)
+        regex.append(re.escape(char))
+    exact = prefix is None
+    if exact:
+        prefix = u''.join(literal)
+    return re.compile(u'(?s)%s$' % u''.join(regex), re.U), prefix, exact
+
+class Select(object):
+    """ A parsed select expression. where is a tree of tuples:
+
+    ('and', [node, ...]), ('or', [node, ...]), ('not', node),
+    ('compare', operand, op, value), ('like', operand, negated, pattern),
+    ('in', operand, values), ('between', operand, low, high) and
+    ('null', operand, is_null)
+
+    where operands are ('attr', name), ('every', name) or ('item', None), and
+    like patterns are what like_pattern() returns.
+    """
+
+    def __init__(self, output, domain_name, where=None, where_text='',
+            order=None, limit=None):
+        # '*', 'itemName()', 'count(*)' or a list of attribute names
+        self.output = output
+        self.domain_name = domain_name
+        self.where = where
+        # The where clause as written, identifying it for caching
+        self.where_text = where_text
+        # (operand, reverse) or None
+        self.order = order
+        self.limit = limit
+
+class SelectParser(object):
+    """ Recursive descent parser for select expressions
+    """
+
+    def __init__(self, expression):
+        self.text = expression
+        self.tokens = tokenize(expression)
+        self.position = 0
+        self.comparisons = 0
+
+    def peek(self):
+        if self.position < len(self.tokens):
+            return self.tokens[self.position]
+        return (None, None, len(self.text))
+
+    def next(self):
+        token = self.peek()
+        if token[0] is None:
+            raise invalid_query('Unexpected end of select expression')
+        self.position += 1
+        return token
+
+    def keyword(self, *words):
+        """ Consume the next token and return it, lower cased, if it's one of
+        words.
+        """
+        kind, value, offset = self.peek()
+        if kind == 'word' and value.lower() in words:
+            self.position += 1
+            return value.lower()
+        return None
+
+    def symbol(self, *symbols):
+        kind, value, offset = self.peek()
+        if kind == 'symbol' and value in symbols:
+            self.position += 1
+            return value
+        return None
+
+    def expect(self, word=None, symbol=None):
+        if (word and not self.keyword(word)) or \
+                (symbol and not self.symbol(symbol)):
+            kind, value, offset = self.peek()
+            raise invalid_query('Expected %s at %r' % (word or symbol,
+                value))
+
+    def parse(self):
+        self.expect('select')
+        output = self.output()
+        self.expect('from')
+        domain_name = self.name()
+        where, where_text = None, ''
+        if self.keyword('where'):
+            start = self.peek()[2]
+            where = self.expression()
+            where_text = self.text[start:self.peek()[2]]
+        order = None
+        if self.keyword('order'):
+            self.expect('by')
+            operand = self.operand()
+            if operand[0] == 'every':
+                raise SimpleDBError(400, 'InvalidSortExpression',
+                    'every() cannot be sorted on')
+            reverse = self.keyword('asc', 'desc') == 'desc'
+            order = (operand, reverse)
+        limit = None
+        if self.keyword('limit'):
+            kind, value, offset = self.next()
+            if kind != 'number':
+                raise invalid_query('Expected a number after limit')
+            limit = int(value)
+        if self.peek()[0] is not None:
+            raise invalid_query('Unexpected %r' % self.peek()[1])
+        if self.comparisons > AWS_MAX_COMPARISONS:
+            raise SimpleDBError(400, 'InvalidNumberPredicates',
+                'Too many predicates in the query expression')
+        return Select(output, domain_name, where, where_text, order, limit)
+
+    def output(self):
+        if self.symbol('*'):
+            return '*'
+        if self.keyword('count'):
+            self.expect(symbol='(')
+            self.expect(symbol='*')
+            self.expect(symbol=')')
+            return 'count(*)'
+        names = []
+        while True:
+            if self.keyword('itemname'):
+                self.expect(symbol='(')
+                self.expect(symbol=')')
+            else:
+                names.append(self.name())
+            if not self.symbol(','):
+                break
+        return names or 'itemName()'
+
+    def name(self):
+        kind, value, offset = self.next()
+        if kind not in ('name', 'word'):
+            raise invalid_query('Expected a name at %r' % value)
+        return value
+
+    def value(self):
+        kind, value, offset = self.next()
+        if kind != 'string':
+            raise invalid_query('Expected a quoted value at %r' % value)
+        return value
+
+    def expression(self):
+        nodes = [self.term()]
+        while self.keyword('or'):
+            nodes.append(self.term())
+        return len(nodes) == 1 and nodes[0] or ('or', nodes)
+
+    def term(self):
+        nodes = [self.factor()]
+        # intersection is and for single valued attributes
+        while self.keyword('and', 'intersection'):
+            nodes.append(self.factor())
+        return len(nodes) == 1 and nodes[0] or ('and', nodes)
+
+    def factor(self):
+        if self.keyword('not'):
+            return ('not', self.factor())
+        if self.symbol('('):
+            node = self.expression()
+            self.expect(symbol=')')
+            return node
+        return self.predicate()
+
+    def operand(self):
+        if self.keyword('itemname'):
+            self.expect(symbol='(')
+            self.expect(symbol=')')
+            return ('item', None)
+        if self.keyword('every'):
+            self.expect(symbol='(')
+            name = self.name()
+            self.expect(symbol=')')
+            return ('every', name)
+        return ('attr', self.name())
+
+    def predicate(self):
+        operand = self.operand()
+        self.comparisons += 1
+        op = self.symbol('=', '!=', '<', '<=', '>', '>=')
+        if op:
+            return ('compare', operand, op, self.value())
+        if self.keyword('like'):
+            return ('like', operand, False, like_pattern(self.value()))
+        if self.keyword('not'):
+            self.expect('like')
+            return ('like', operand, True, like_pattern(self.value()))
+        if self.keyword('between'):
+            low = self.value()
+            self.expect('and')
+            return ('between', operand, low, self.value())
+        if self.keyword('in'):
+            self.expect(symbol='(')
+            values = [self.value()]
+            while self.symbol(','):
+                values.append(self.value())
+            self.expect(symbol=')')
+            self.comparisons += len(values) - 1
+            return ('in', operand, frozenset(values))
+        if self.keyword('is'):
+            is_null = not self.keyword('not')
+            self.expect('null')
+            return ('null', operand, is_null)
+        raise invalid_query('Expected a comparison at %r' % self.peek()[1])
+
+def sortable_names(node):
+    """ Attributes that node requires a value for, which SimpleDB allows
+    sorting on.
+    """
+    kind = node[0]
+    if kind == 'and':
+        return set().union(*[sortable_names(child) for child in node[1]])
+    if kind == 'or':
+        return set.intersection(*[sortable_names(child) for child in node[1]])
+    if kind == 'not' or kind == 'null' and node[2]:
+        return set()
+    if node[1][0] == 'item':
+        return set()
+    return set([node[1][1]])
+
+OPERATORS = {
+    '=': operator.eq,
+    '!=': operator.ne,
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge,
+}
+
+def test_value(node, value):
+    kind = node[0]
+    if kind == 'compare':
+        return OPERATORS[node[2]](value, node[3])
+    if kind == 'like':
+        return (node[3][0].match(value) is None) == node[2]
+    if kind == 'in':
+        return value in node[2]
+    return node[2] <= value <= node[3]
+
+def matches(node, item_name, attrs):
+    """ Whether an item matches a parsed where clause. Comparisons hold if
+    any value of the attribute passes them, or with every(), all of them.
+    """
+    kind = node[0]
+    if kind == 'and':
+        for child in node[1]:
+            if not matches(child, item_name, attrs):
+                return False
+        return True
+    if kind == 'or':
+        for child in node[1]:
+            if matches(child, item_name, attrs):
+                return True
+        return False
+    if kind == 'not':
+        return not matches(node[1], item_name, attrs)
+    operand = node[1]
+    if operand[0] == 'item':
+        values = (item_name,)
+    else:
+        values = attrs.get(operand[1], ())
+    if kind == 'null':
+        return (not values) == node[2]
+    if not values:
+        return False
+    if operand[0] == 'every':
+        for value in values:
+            if not test_value(node, value):
+                return False
+        return True
+    for value in values:
+        if test_value(node, value):
+            return True
+    return False
+
+# Storage
+
+class EmulatedDomain(object):
+    """ A domain's items, with every attribute indexed by value
+    """
+
+    def __init__(self, name):
+        self.name = name
+        # item name => {attribute name: [value, ...]}
+        self.items = {}
+        # Sorted item names
+        self.names = []
+        # attribute name => {value: set of item names}
+        self.index = {}
+        # attribute name => sorted distinct values
+        self.values = {}
+        # Bumped by every write, so cached select results know they're stale
+        self.version = 0
+        self.matches = LRUCache(16)
+
+    def add(self, item_name, attr, value):
+        item = self.items.get(item_name)
+        if item is None:
+            item = self.items[item_name] = {}
+            bisect.insort(self.names, item_name)
+        values = item.setdefault(attr, [])
+        if value in values:
+            return
+        values.append(value)
+        postings = self.index.setdefault(attr, {})
+        if value not in postings:
+            postings[value] = set()
+            bisect.insort(self.values.setdefault(attr, []), value)
+        postings[value].add(item_name)
+
+    def remove(self, item_name, attr, value=None):
+        """ Remove a value of an item's attribute, or if value is None, all
+        of them
+        """
+        item = self.items.get(item_name)
+        if item is None or attr not in item:
+            return
+        values = item[attr]
+        if value is None:
+            removed = list(values)
+        else:
+            removed = value in values and [value] or []
+        for v in removed:
+            values.remove(v)
+            postings = self.index[attr]
+            postings[v].discard(item_name)
+            if not postings[v]:
+                del postings[v]
+                sorted_values = self.values[attr]
+                del sorted_values[bisect.bisect_left(sorted_values, v)]
+        if not values:
+            del item[attr]
+            if not item:
+                del self.items[item_name]
+                del self.names[bisect.bisect_left(self.names, item_name)]
+
+    def check(self, item_name, expected):
+        """ Raise unless the item satisfies a conditional write's expected
+        value, a dict with Name and either Value or Exists.
+        """
+        if not expected:
+            return
+        values = self.items.get(item_name, {}).get(expected['Name'], [])
+        exists = expected.get('Exists', 'true') == 'true'
+        if 'Value' not in expected:
+            if bool(values) != exists:
+                raise SimpleDBError(409, 'ConditionalCheckFailed',
+                    'Conditional check failed')
+            return
+        if not exists:
+            raise SimpleDBError(400, 'IncompleteExpectedExpression',
+                'Exists is false, but a value was given')
+        if not values:
+            raise SimpleDBError(404, 'AttributeDoesNotExist',
+                'Attribute (%s) does not exist' % expected['Name'])
+        if len(values) > 1:
+            raise SimpleDBError(409, 'MultiValuedAttribute',
+                'Attribute (%s) is multi-valued' % expected['Name'])
+        if values[0] != expected['Value']:
+            raise SimpleDBError(409, 'ConditionalCheckFailed',
+                'Conditional check failed. Attribute (%s) value is (%s) '
+                'but was expected (%s)' % (expected['Name'], values[0],
+                    expected['Value']))
+
+    def check_put(self, item_name, attributes):
+        """ Raise if putting attributes, a list of (name, value, replace),
+        would leave the item with too many values
+        """
+        current = self.items.get(item_name, {})
+        replaced = set([attr for attr, value, replace in attributes
+            if replace])
+        values = set([(attr, value) for attr, values in current.items()
+            if attr not in replaced for value in values])
+        values.update([(attr, value) for attr, value, replace in attributes])
+        if len(values) > MAX_ATTRIBUTES:
+            raise SimpleDBError(409, 'NumberItemAttributesExceeded',
+                'Too many attributes in this item')
+
+    def put(self, item_name, attributes):
+        for attr in set([attr for attr, value, replace in attributes
+                if replace]):
+            self.remove(item_name, attr)
+        for attr, value, replace in attributes:
+            self.add(item_name, attr, value)
+        self.version += 1
+
+    def delete(self, item_name, attributes):
+        """ Delete attributes, a list of (name, value) where value may be
+        None, or if there are none, the whole item
+        """
+        if not attributes:
+            attributes = [(attr, None) for attr in self.items.get(item_name,
+                ())]
+        for attr, value in attributes:
+            self.remove(item_name, attr, value)
+        self.version += 1
+
+    def sorted_keys(self, operand):
+        if operand[0] == 'item':
+            return self.names
+        return self.values.get(operand[1], [])
+
+    def postings(self, operand, value):
+        if operand[0] == 'item':
+            return value in self.items and (value,) or ()
+        return self.index.get(operand[1], {}).get(value, ())
+
+    def lookup(self, operand, low=None, high=None, low_inclusive=True,
+            high_inclusive=True):
+        """ Names of the items with a value of operand between low and high,
+        from the index
+        """
+        keys = self.sorted_keys(operand)
+        start, end = 0, len(keys)
+        if low is not None:
+            start = (low_inclusive and bisect.bisect_left or
+                bisect.bisect_right)(keys, low)
+        if high is not None:
+            end = (high_inclusive and bisect.bisect_right or
+                bisect.bisect_left)(keys, high)
+        names = set()
+        for value in keys[start:end]:
+            names.update(self.postings(operand, value))
+        return names
+
+    def lookup_prefix(self, operand, prefix):
+        keys = self.sorted_keys(operand)
+        names = set()
+        for i in xrange(bisect.bisect_left(keys, prefix), len(keys)):
+            if not keys[i].startswith(prefix):
+                break
+            names.update(self.postings(operand, keys[i]))
+        return names
+
+    def candidates(self, node):
+        """ The names of every item that might match node, from the indexes,
+        or None if they can't narrow it down.
+        """
+        kind = node[0]
+        if kind in ('and', 'or'):
+            sets = [self.candidates(child) for child in node[1]]
+            if kind == 'or':
+                if None in sets:
+                    return None
+                return set().union(*sets)
+            sets = sorted([s for s in sets if s is not None], key=len)
+            if not sets:
+                return None
+            return sets[0].intersection(*sets[1:])
+        if kind == 'not':
+            return None
+        operand = node[1]
+        if kind == 'null':
+            if node[2]:
+                return None
+            return self.lookup(operand)
+        if kind == 'compare':
+            op, value = node[2], node[3]
+            if op == '=':
+                return set(self.postings(operand, value))
+            if op in ('<', '<='):
+                return self.lookup(operand, high=value,
+                    high_inclusive=op == '<=')
+            if op in ('>', '>='):
+                return self.lookup(operand, low=value,
+                    low_inclusive=op == '>=')
+            return None
+        if kind == 'like':
+            pattern, prefix, exact = node[3]
+            if node[2]:
+                return None
+            if exact:
+                return set(self.postings(operand, prefix))
+            return self.lookup_prefix(operand, prefix)
+        if kind == 'in':
+            names = set()
+            for value in node[2]:
+                names.update(self.postings(operand, value))
+            return names
+        return self.lookup(operand, node[2], node[3])
+
+    def sort_key(self, operand, item_name):
+        if operand is None or operand[0] == 'item':
+            return item_name
+        values = self.items[item_name].get(operand[1])
+        if not values:
+            return None
+        return min(values)
+
+    def select(self, select):
+        """ The (sort key, item name) of every item matching select, sorted
+        in ascending order
+        """
+        operand = select.order and select.order[0] or None
+        key = (select.where_text, operand)
+        cached = self.matches.get(key)
+        if cached is not None and cached[0] == self.version:
+            return cached[1]
+        names = None
+        if select.where is not None:
+            names = self.candidates(select.where)
+        if names is None:
+            names = self.items
+        entries = []
+        for item_name in names:
+            if select.where is None or matches(select.where, item_name,
+                    self.items[item_name]):
+                entries.append((self.sort_key(operand, item_name), item_name))
+        entries.sort()
+        self.matches.set(key, (self.version, entries))
+        return entries
+
+# Requests
+
+def numbered(params, prefix):
+    """ Group parameters like Attribute.1.Name and Attribute.1.Value into a
+    list of dicts like {'Name': ..., 'Value': ...}, in order of their numbers
+    """
+    groups = {}
+    start = prefix + '.'
+    for key, value in params.items():
+        if key.startswith(start):
+            number, _, field = key[len(start):].partition('.')
+            groups.setdefault(int(number), {})[field] = value
+    return [groups[number] for number in sorted(groups)]
+
+def check_size(kind, value):
+    if len(value.encode('utf-8')) > MAX_VALUE_BYTES:
+        raise SimpleDBError(400, 'InvalidParameterValue',
+            '%s exceeds the maximum length of %d bytes' % (kind,
+                MAX_VALUE_BYTES))
+
+def put_list(params):
+    """ The (name, value, replace) of every attribute in a put
+    """
+    attributes = []
+    for attribute in numbered(params, 'Attribute'):
+        if 'Name' not in attribute or 'Value' not in attribute:
+            raise SimpleDBError(400, 'MissingParameter',
+                'Attribute names and values are required')
+        check_size('Attribute name', attribute['Name'])
+        check_size('Attribute value', attribute['Value'])
+        attributes.append((attribute['Name'], attribute['Value'],
+            attribute.get('Replace') == 'true'))
+    if len(attributes) > MAX_ATTRIBUTES:
+        raise SimpleDBError(409, 'NumberSubmittedAttributesExceeded',
+            'Too many attributes for one request')
+    return attributes
+
+def delete_list(params):
+    """ The (name, value or None) of every attribute in a delete
+    """
+    return [(attribute['Name'], attribute.get('Value'))
+        for attribute in numbered(params, 'Attribute')]
+
+def element(tag, text):
+    if UNSAFE_XML.search(text):
+        return '<%s encoding="base64">%s</%s>' % (tag,
+            base64.b64encode(text.encode('utf-8')), tag)
+    return '<%s>%s</%s>' % (tag, escape(text), tag)
+
+def item_xml(tag, item_name, attrs):
+    parts = ['<%s>' % tag, element('Name', item_name)]
+    for attr in sorted(attrs):
+        for value in attrs[attr]:
+            parts.append('<Attribute>%s%s</Attribute>' % (
+                element('Name', attr), element('Value', value)))
+    parts.append('</%s>' % tag)
+    return ''.join(parts)
+
+def encode_token(entry):
+    return base64.b64encode(json.dumps(entry))
+
+def decode_token(token):
+    try:
+        sort_key, item_name = json.loads(base64.b64decode(token))
+    except (TypeError, ValueError):
+        raise SimpleDBError(400, 'InvalidNextToken',
+            'The specified next token is not valid')
+    return (sort_key, item_name)
+
+class Emulator(object):
+    """ An in-memory SimpleDB, taking requests as boto sends them. Thread
+    safe, running one request at a time.
+    """
+
+    actions = {
+        'CreateDomain': 'create_domain',
+        'DeleteDomain': 'delete_domain',
+        'ListDomains': 'list_domains',
+        'DomainMetadata': 'domain_metadata',
+        'PutAttributes': 'put_attributes',
+        'BatchPutAttributes': 'batch_put_attributes',
+        'GetAttributes': 'get_attributes',
+        'DeleteAttributes': 'delete_attributes',
+        'BatchDeleteAttributes': 'batch_delete_attributes',
+        'Select': 'select',
+    }
+
+    def __init__(self):
+        self.domains = {}
+        # Total box usage, and the number of requests made for each action
+        self.box_usage = 0.0
+        self.requests = {}
+        # (status, code) errors to answer the next requests with
+        self.failures = []
+        self._lock = threading.RLock()
+
+    def reset(self):
+        """ Drop every domain and forget all usage
+        """
+        self._lock.acquire()
+        try:
+            self.domains.clear()
+            self.box_usage = 0.0
+            self.requests.clear()
+            del self.failures[:]
+        finally:
+            self._lock.release()
+
+    def fail(self, status=503, code='ServiceUnavailable', times=1):
+        """ Answer the next times requests with an error, for testing how
+        they're handled
+        """
+        self._lock.acquire()
+        try:
+            self.failures.extend([(status, code)] * times)
+        finally:
+            self._lock.release()
+
+    def request(self, query_string):
+        """ Handle a request's form encoded parameters, returning the
+        response's HTTP status, reason and XML body
+        """
+        params = dict([(key.decode('utf-8'), value.decode('utf-8'))
+            for key, value in urlparse.parse_qsl(query_string, True)])
+        action = params.get('Action')
+        self._lock.acquire()
+        try:
+            self.requests[action] = self.requests.get(action, 0) + 1
+            try:
+                if self.failures:
+                    status, code = self.failures.pop(0)
+                    raise SimpleDBError(status, code, 'Injected failure')
+                if action not in self.actions:
+                    raise SimpleDBError(400, 'InvalidAction',
+                        'The action %s is not valid' % action)
+                result, usage = getattr(self, self.actions[action])(params)
+            except SimpleDBError, e:
+                return e.status, httplib.responses.get(e.status, ''), (
+                    '<?xml version="1.0"?>\n<Response><Errors><Error>'
+                    '<Code>%s</Code><Message>%s</Message>'
+                    '<BoxUsage>0.0000137200</BoxUsage></Error></Errors>'
+                    '<RequestID>%s</RequestID></Response>' % (e.code,
+                        escape(e.message), uuid.uuid4())).encode('utf-8')
+            self.box_usage += usage
+            if result:
+                result = '<%sResult>%s</%sResult>' % (action, result, action)
+            return 200, 'OK', ('<?xml version="1.0"?>\n<%sResponse>%s'
+                '<ResponseMetadata><RequestId>%s</RequestId>'
+                '<BoxUsage>%.10f</BoxUsage></ResponseMetadata></%sResponse>' %
+                (action, result, uuid.uuid4(), usage, action)).encode('utf-8')
+        finally:
+            self._lock.release()
+
+    def param(self, params, name):
+        try:
+            return params[name]
+        except KeyError:
+            raise SimpleDBError(400, 'MissingParameter',
+                'The request must contain the parameter %s' % name)
+
+    def domain(self, params_or_name):
+        if isinstance(params_or_name, dict):
+            params_or_name = self.param(params_or_name, 'DomainName')
+        try:
+            return self.domains[params_or_name]
+        except KeyError:
+            raise no_such_domain(params_or_name)
+
+    def item_name(self, params, name='ItemName'):
+        item_name = self.param(params, name)
+        check_size('Item name', item_name)
+        return item_name
+
+    def expected(self, params):
+        expected = numbered(params, 'Expected')
+        return expected and expected[0] or None
+
+    def create_domain(self, params):
+        domain_name = self.param(params, 'DomainName')
+        if not DOMAIN_NAME.match(domain_name):
+            raise SimpleDBError(400, 'InvalidParameterValue',
+                'Value (%s) for parameter DomainName is invalid' %
+                domain_name)
+        if domain_name not in self.domains:
+            self.domains[domain_name] = EmulatedDomain(domain_name)
+        return '', BOX_USAGE['CreateDomain']
+
+    def delete_domain(self, params):
+        self.domains.pop(self.param(params, 'DomainName'), None)
+        return '', BOX_USAGE['DeleteDomain']
+
+    def list_domains(self, params):
+        names = sorted(self.domains)
+        if 'NextToken' in params:
+            names = names[bisect.bisect_right(names,
+                decode_token(params['NextToken'])[1]):]
+        limit = int(params.get('MaxNumberOfDomains', 100))
+        result = ''.join([element('DomainName', name)
+            for name in names[:limit]])
+        if len(names) > limit:
+            result += element('NextToken',
+                encode_token([None, names[limit - 1]]))
+        return result, BOX_USAGE['ListDomains']
+
+    def domain_metadata(self, params):
+        domain = self.domain(params)
+        names_size = sum([len(name.encode('utf-8'))
+            for name in domain.items])
+        values = [value for values in domain.values.values()
+            for value in values]
+        counts = [
+            ('ItemCount', len(domain.items)),
+            ('ItemNamesSizeBytes', names_size),
+            ('AttributeNameCount', len(domain.index)),
+            ('AttributeNamesSizeBytes', sum([len(name.encode('utf-8'))
+                for name in domain.index])),
+            ('AttributeValueCount', sum([len(values)
+                for item in domain.items.values()
+                for values in item.values()])),
+            ('AttributeValuesSizeBytes', sum([len(value.encode('utf-8'))
+                for value in values])),
+            ('Timestamp', int(time.time())),
+        ]
+        return ''.join(['<%s>%s</%s>' % (name, value, name)
+            for name, value in counts]), BOX_USAGE['DomainMetadata']
+
+    def put_attributes(self, params):
+        domain = self.domain(params)
+        item_name = self.item_name(params)
+        attributes = put_list(params)
+        domain.check(item_name, self.expected(params))
+        domain.check_put(item_name, attributes)
+        domain.put(item_name, attributes)
+        return '', BOX_USAGE['PutAttributes'] + \
+            ATTRIBUTE_BOX_USAGE * len(attributes)
+
+    def batch_put_attributes(self, params):
+        domain = self.domain(params)
+        items = self.batch_items(params)
+        puts = []
+        for item in items:
+            item_name = self.item_name(item)
+            attributes = put_list(item)
+            domain.check_put(item_name, attributes)
+            puts.append((item_name, attributes))
+        usage = 0
+        for item_name, attributes in puts:
+            domain.put(item_name, attributes)
+            usage += BOX_USAGE['BatchPutAttributes'] + \
+                ATTRIBUTE_BOX_USAGE * len(attributes)
+        return '', usage
+
+    def batch_items(self, params):
+        items = numbered(params, 'Item')
+        if len(items) > AWS_MAX_BATCH_ITEMS:
+            raise SimpleDBError(400, 'NumberSubmittedItemsExceeded',
+                'Too many items in a single call. Up to %d items per call '
+                'allowed.' % AWS_MAX_BATCH_ITEMS)
+        names = [item.get('ItemName') for item in items]
+        if len(set(names)) < len(names):
+            raise SimpleDBError(400, 'DuplicateItemName',
+                'Item names must be unique within a batch')
+        return items
+
+    def get_attributes(self, params):
+        domain = self.domain(params)
+        item = domain.items.get(self.item_name(params), {})
+        names = [value for key, value in params.items()
+            if key.startswith('AttributeName.')]
+        if names:
+            item = dict([(name, item[name]) for name in names
+                if name in item])
+        result = ''.join(['<Attribute>%s%s</Attribute>' % (
+                element('Name', attr), element('Value', value))
+            for attr in sorted(item) for value in item[attr]])
+        return result, BOX_USAGE['GetAttributes']
+
+    def delete_attributes(self, params):
+        domain = self.domain(params)
+        item_name = self.item_name(params)
+        domain.check(item_name, self.expected(params))
+        attributes = delete_list(params)
+        domain.delete(item_name, attributes)
+        return '', BOX_USAGE['DeleteAttributes'] + \
+            ATTRIBUTE_BOX_USAGE * len(attributes)
+
+    def batch_delete_attributes(self, params):
+        domain = self.domain(params)
+        usage = 0
+        for item in self.batch_items(params):
+            attributes = delete_list(item)
+            domain.delete(self.item_name(item), attributes)
+            usage += BOX_USAGE['BatchDeleteAttributes'] + \
+                ATTRIBUTE_BOX_USAGE * len(attributes)
+        return '', usage
+
+    def select(self, params):
+        select = SelectParser(self.param(params, 'SelectExpression')).parse()
+        domain = self.domain(select.domain_name)
+        limit = select.limit
+        if limit is not None and not 0 < limit <= AWS_MAX_RESULT_SIZE:
+            raise SimpleDBError(400, 'InvalidParameterValue',
+                'Value (%s) for parameter Limit is invalid' % limit)
+        reverse = False
+        if select.order:
+            operand, reverse = select.order
+            if operand[0] == 'attr' and (select.where is None or
+                    operand[1] not in sortable_names(select.where)):
+                raise SimpleDBError(400, 'InvalidSortExpression',
+                    'The sort attribute must be present in at least one of '
+                    'the predicates, and the predicate cannot contain the '
+                    'is null operator.')
+        entries = domain.select(select)
+
+        # Entries left after the NextToken, in the order they're returned
+        if reverse:
+            end = len(entries)
+            if 'NextToken' in params:
+                end = bisect.bisect_left(entries,
+                    decode_token(params['NextToken']))
+            remaining = end
+            ordered = (entries[i] for i in xrange(end - 1, -1, -1))
+        else:
+            start = 0
+            if 'NextToken' in params:
+                start = bisect.bisect_right(entries,
+                    decode_token(params['NextToken']))
+            remaining = len(entries) - start
+            ordered = (entries[i] for i in xrange(start, len(entries)))
+
+        if select.output == 'count(*)':
+            count = remaining
+            if limit is not None:
+                count = min(count, limit)
+            result = item_xml('Item', u'Domain', {u'Count': [str(count)]})
+            if count < remaining:
+                for i, entry in enumerate(ordered):
+                    if i == count - 1:
+                        result += element('NextToken', encode_token(entry))
+                        break
+            return result, BOX_USAGE['Select'] + ITEM_BOX_USAGE * count
+
+        if limit is None:
+            limit = DEFAULT_LIMIT
+        parts, returned, size, last = [], 0, 0, None
+        for entry in ordered:
+            if returned == limit or size > MAX_RESPONSE_BYTES:
+                parts.append(element('NextToken', encode_token(last)))
+                break
+            item_name = entry[1]
+            attrs = domain.items[item_name]
+            last = entry
+            if select.output == '*':
+                pass
+            elif select.output == 'itemName()':
+                attrs = {}
+            else:
+                attrs = dict([(name, attrs[name]) for name in select.output
+                    if name in attrs])
+                if not attrs:
+                    # Items with none of the attributes asked for are left
+                    # out
+                    continue
+            parts.append(item_xml('Item', item_name, attrs))
+            returned += 1
+            size += attributes_size(item_name, attrs)
+        return ''.join(parts), BOX_USAGE['Select'] + ITEM_BOX_USAGE * returned
+
+_emulators = {}
+_lock = threading.Lock()
+
+def get_emulator(name='default'):
+    """ The Emulator called name, shared by every database using it
+    """
+    _lock.acquire()
+    try:
+        try:
+            return _emulators[name]
+        except KeyError:
+            emulator = _emulators[name] = Emulator()
+            return emulator
+    finally:
+        _lock.release()
+
+# boto plumbing
+
+class EmulatorResponse(object):
+    """ Stands in for httplib's HTTPResponse
+    """
+
+    def __init__(self, status, reason, body):
+        self.status = status
+        self.reason = reason
+        self.body = body
+
+    def read(self):
+        return self.body
+
+    def getheader(self, name, default=None):
+        return default
+
+class EmulatorHTTPConnection(object):
+    """ Stands in for the httplib connection boto sends requests over,
+    handing them to an Emulator
+    """
+
+    def __init__(self, emulator, latency=0):
+        self.emulator = emulator
+        self.latency = latency
+        self.response = None
+
+    def request(self, method, path, body=None, headers=None):
+        if method == 'POST':
+            query_string = body
+        else:
+            query_string = path.partition('?')[2]
+        if self.latency:
+            time.sleep(self.latency)
+        self.response = EmulatorResponse(*self.emulator.request(query_string))
+
+    def getresponse(self):
+        response, self.response = self.response, None
+        return response
+
+    def close(self):
+        pass
+
+class EmulatedSDBConnection(RetryingSDBConnection):
+    """ RetryingSDBConnection sending its requests to an Emulator, each
+    taking latency seconds
+    """
+
+    def __init__(self, emulator, policy, *args, **kwargs):
+        self.emulator = emulator
+        self.latency = kwargs.pop('latency', 0)
+        RetryingSDBConnection.__init__(self, policy, *args, **kwargs)
+
+    def new_http_connection(self, host, is_secure):
+        return EmulatorHTTPConnection(self.emulator, self.latency)
+
+class EmulatedSDBManager(RetryingSDBManager):
+    """ SDBManager connecting with an EmulatedSDBConnection
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.emulator = kwargs.pop('emulator')
+        self.latency = kwargs.pop('latency', 0)
+        RetryingSDBManager.__init__(self, *args, **kwargs)
+
+    def new_connection(self):
+        return EmulatedSDBConnection(self.emulator, self.policy,
+            aws_access_key_id=self.db_user,
+            aws_secret_access_key=self.db_passwd,
+            is_secure=self.enable_ssl, latency=self.latency)
@@ -0,0 +1,123 @@
+""" Encoding of values as the strings SimpleDB stores.
+"""
+import datetime
+
+from decimal import Decimal
+
+DATETIME_ISO8601 = '%Y-%m-%dT%H:%M:%S.%f'
+DATE_ISO8601 = '%Y-%m-%d'
+
+# Dates and datetimes are always written in exactly the DATE_ISO8601 and
+# DATETIME_ISO8601 formats, so they can be parsed by slicing, which is many
+# times quicker than strptime.
+
+def format_date(value):
+    return value.isoformat()
+
+def format_datetime(value):
+    if value.tzinfo is not None:
+        # isoformat() would add the UTC offset
+        value = value.replace(tzinfo=None)
+    if value.microsecond:
+        return value.isoformat()
+    # isoformat() leaves out a zero fraction
+    return value.isoformat() + '.000000'
+
+def parse_date(value):
+    if len(value) != 10 or value[4] != '-' or value[7] != '-':
+        raise ValueError('time data %r does not match format %r' % (
+            value, DATE_ISO8601))
+    return datetime.date(int(value[0:4]), int(value[5:7]), int(value[8:10]))
+
+def parse_datetime(value):
+    # strptime's %f accepts one to six digits of fraction
+    fraction = value[20:]
+    if (len(value) < 21 or value[4] != '-' or value[7] != '-' or
+            value[10] != 'T' or value[13] != ':' or value[16] != ':' or
+            value[19] != '.' or len(fraction) > 6 or not fraction.isdigit()):
+        raise ValueError('time data %r does not match format %r' % (
+            value, DATETIME_ISO8601))
+    return datetime.datetime(int(value[0:4]), int(value[5:7]),
+        int(value[8:10]), int(value[11:13]), int(value[14:16]),
+        int(value[17:19]), int(fraction.ljust(6, '0')))
+
+# Optional cache of parsed values, for data where the same dates come up
+# again and again. Date and datetime strings never look alike, so they can
+# share it. It's a plain dict, emptied when it fills up: taking a lock for
+# every lookup would cost about as much as parsing.
+_date_cache = None
+_date_cache_size = 0
+
+def set_date_cache_size(size):
+    """ Cache up to size parsed dates and datetimes, process wide. Zero
+    turns the cache off. Setting the size it already has keeps the values
+    cached.
+    """
+    global _date_cache, _date_cache_size
+    if size == _date_cache_size:
+        return
+    _date_cache_size = size
+    _date_cache = None
+    if size:
+        _date_cache = {}
+
+def _cached(parse):
+    def decode(value):
+        cache = _date_cache
+        if cache is None:
+            return parse(value)
+        try:
+            return cache[value]
+        except KeyError:
+            if len(cache) >= _date_cache_size:
+                cache.clear()
+            result = cache[value] = parse(value)
+            return result
+    decode.__name__ = parse.__name__
+    return decode
+
+decode_date = _cached(parse_date)
+decode_datetime = _cached(parse_datetime)
+
+
+# Numbers are stored offset to make them non-negative and zero-padded to a
+# fixed width, so SimpleDB's string comparisons order them numerically.
+# Values written before they were encoded are still read: those never have
+# the encoded width, or start with a minus sign.
+
+def integer_codec(width, cast=long):
+    """ Return encode and decode functions for integers of fewer than
+    width - 1 digits.
+    """
+    offset = 10 ** (width - 1)
+    template = u'%%0%dd' % width
+    def encode(value):
+        encoded = long(value) + offset
+        if not 0 <= encoded < offset * 10:
+            raise ValueError('%r is too large to encode in %s digits' % (
+                value, width))
+        return template % encoded
+    def decode(value):
+        if len(value) != width or value[0] == '-':
+            return cast(value)
+        return cast(long(value) - offset)
+    return encode, decode
+
+# Wide enough for the 128 bit ids save_entity generates
+encode_long, decode_long = integer_codec(40)
+encode_int, decode_int = integer_codec(11, int)
+
+def decimal_codec(max_digits, decimal_places):
+    """ Return encode and decode functions for decimals of max_digits digits,
+    decimal_places of them after the point. They're stored as integers.
+    """
+    encode_scaled, decode_scaled = integer_codec(max_digits + 1)
+    scale = Decimal(10) ** decimal_places
+    def encode(value):
+        return encode_scaled(
+            (Decimal(str(value)) * scale).to_integral_value())
+    def decode(value):
+        if len(value) != max_digits + 1 or not value.isdigit():
+            return Decimal(value)
+        return Decimal(decode_scaled(value)).scaleb(-decimal_places)
+    return encode, decode
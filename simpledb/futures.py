@@ -0,0 +1,80 @@
+"""
+Queries and writes run in the background, so one thread can have many
+SimpleDB requests in flight.
+
+boto's calls block, so each database has a pool of worker threads
+(``ASYNC_WORKERS``, 10 by default) that run the usual compiler pipeline.
+Every function here returns a multiprocessing AsyncResult at once; its
+get() waits for the result, re-raising any error, and ready() and wait()
+check on it without blocking.
+"""
+import threading
+
+from multiprocessing.pool import ThreadPool
+
+from django.db import DEFAULT_DB_ALIAS, connections, router
+from django.db.models.sql.subqueries import InsertQuery
+
+from simpledb.utils import domain_for_model
+
+_pools = {}
+_lock = threading.Lock()
+
+def pool(using):
+    """ Return the thread pool for the database alias using, starting it on
+    first use.
+    """
+    _lock.acquire()
+    try:
+        try:
+            return _pools[using]
+        except KeyError:
+            settings = connections[using].settings_dict
+            workers = _pools[using] = ThreadPool(
+                settings.get('ASYNC_WORKERS', 10))
+            return workers
+    finally:
+        _lock.release()
+
+def invalidate(model, using):
+    """ Drop the model's entities from the calling thread's identity map.
+    Writes run on the pool's threads, so they only invalidate those threads'
+    maps themselves.
+    """
+    identity_map = connections[using].identity_map
+    if identity_map is not None:
+        identity_map.invalidate(domain_for_model(model))
+
+def fetch(queryset):
+    """ Fetch the model instances in queryset, as a list
+    """
+    return pool(queryset.db).apply_async(list, (queryset,))
+
+def count(queryset):
+    return pool(queryset.db).apply_async(queryset.count)
+
+def delete(queryset):
+    invalidate(queryset.model, queryset.db)
+    return pool(queryset.db).apply_async(queryset.delete)
+
+def save(obj, using=None, **kwargs):
+    """ Save a model instance, passing kwargs on to save()
+    """
+    using = using or router.db_for_write(obj.__class__, instance=obj)
+    kwargs['using'] = using
+    invalidate(obj.__class__, using)
+    return pool(using).apply_async(obj.save, (), kwargs)
+
+def bulk_insert(objs, using=None):
+    """ Insert model instances of one model with
+    SQLInsertCompiler.bulk_insert(), giving their pks.
+    """
+    objs = list(objs)
+    if not objs:
+        using = using or DEFAULT_DB_ALIAS
+        return pool(using).apply_async(list, ((),))
+    model = objs[0].__class__
+    using = using or router.db_for_write(model)
+    compiler = InsertQuery(model).get_compiler(using=using)
+    invalidate(model, using)
+    return pool(using).apply_async(compiler.bulk_insert, (objs,))
@@ -0,0 +1,29 @@
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+from django.db import DEFAULT_DB_ALIAS, connections, models, router
+
+from simpledb.compiler import reencode
+from simpledb.utils import domain_for_model
+
+
+class Command(NoArgsCommand):
+    option_list = NoArgsCommand.option_list + (
+        make_option('--database', action='store', dest='database',
+            default=DEFAULT_DB_ALIAS, help='Nominates a database to '
+                're-encode. Defaults to the "default" database.'),
+    )
+    help = ("Rewrite the items of every SimpleDB domain whose values were "
+        "stored in an older format, such as unpadded numbers.")
+
+    def handle_noargs(self, **options):
+        database = options.get('database')
+        verbosity = int(options.get('verbosity', 1))
+        connection = connections[database]
+        for model in models.get_models(include_auto_created=True):
+            if not router.allow_syncdb(database, model):
+                continue
+            rewritten = reencode(connection, model)
+            if verbosity >= 1:
+                self.stdout.write('%s: %s items rewritten\n' % (
+                    domain_for_model(model), rewritten))
@@ -0,0 +1,124 @@
+import threading
+import time
+
+from collections import OrderedDict
+
+
+def domain_is_reachable(manager):
+    """ Default health check - a cheap DomainMetadata call against the
+    manager's domain.
+    """
+    manager.sdb.domain_metadata(manager.domain)
+    return True
+
+
+class ManagerPool(object):
+    """ Cache of boto SDBManager instances, keyed by domain name.
+
+    boto connections aren't safe to share between threads, so each thread
+    keeps its own managers. Within a thread, a manager (and the HTTP
+    connections boto keeps open underneath it) is reused for as long as it's
+    in the cache. Counters are shared by all threads.
+    """
+
+    def __init__(self, factory, size=10, max_idle=300, check_interval=0,
+            health_check=domain_is_reachable):
+        # factory is called with a domain name to build a new manager
+        self.factory = factory
+        # Maximum number of managers cached per thread
+        self.size = size
+        # Managers unused for longer than this many seconds get replaced
+        self.max_idle = max_idle
+        # Managers idle for longer than this many seconds are health
+        # checked before reuse. Zero disables health checks.
+        self.check_interval = check_interval
+        self.health_check = health_check
+        self.hits = 0
+        self.misses = 0
+        self.reconnects = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _managers(self):
+        try:
+            return self._local.managers
+        except AttributeError:
+            self._local.managers = OrderedDict()
+            return self._local.managers
+
+    def _count(self, counter):
+        self._lock.acquire()
+        try:
+            setattr(self, counter, getattr(self, counter) + 1)
+        finally:
+            self._lock.release()
+
+    def _usable(self, manager, last_used, now):
+        if last_used is None:
+            # Explicitly invalidated
+            return False
+        idle = now - last_used
+        if self.max_idle and idle > self.max_idle:
+            return False
+        if self.check_interval and idle > self.check_interval:
+            try:
+                return self.health_check(manager)
+            except Exception:
+                return False
+        return True
+
+    def get(self, domain_name):
+        """ Return this thread's manager for domain_name, creating one if
+        there isn't a usable one cached.
+        """
+        managers = self._managers()
+        now = time.time()
+        entry = managers.pop(domain_name, None)
+        if entry is None:
+            self._count('misses')
+            manager = self.factory(domain_name)
+        else:
+            manager, last_used = entry
+            if self._usable(manager, last_used, now):
+                self._count('hits')
+            else:
+                self._count('reconnects')
+                self._close(manager)
+                manager = self.factory(domain_name)
+
+        # Re-inserting keeps the cache in least-recently-used order
+        managers[domain_name] = (manager, now)
+        while len(managers) > self.size:
+            _, (old, _) = managers.popitem(last=False)
+            self._close(old)
+        return manager
+
+    def invalidate(self, domain_name):
+        """ Mark this thread's manager for domain_name as broken, so the next
+        get() reconnects.
+        """
+        managers = self._managers()
+        if domain_name in managers:
+            manager, last_used = managers[domain_name]
+            managers[domain_name] = (manager, None)
+
+    def clear(self):
+        """ Drop all managers cached by the current thread.
+        """
+        managers = self._managers()
+        while managers:
+            domain_name, (manager, _) = managers.popitem()
+            self._close(manager)
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'reconnects': self.reconnects,
+        }
+
+    def _close(self, manager):
+        # Don't connect just to close again
+        sdb = getattr(manager, '_sdb', None)
+        if sdb is not None:
+            sdb.close()
@@ -1,8 +1,16 @@
+import copy
+import heapq
+import itertools
+
+from django.db.models.signals import class_prepared
+
 from boto.sdb.db.query import Query as BotoQuery
 from boto.sdb.db.property import Property
 from boto.sdb.domain import Domain
-from boto.sdb.item import Item
-from simpledb.utils import domain_for_model
+from simpledb.utils import AWS_MAX_BATCH_ITEMS, AWS_MAX_RESULT_SIZE, \
+    chunks, concurrent_map, domain_for_item, domain_for_model, \
+    group_by_domain, interleave, quote, quote_name, read_ahead, \
+    shard_domains, uuid_split_points
 
 def property_from_field(field):
     default = field.default
@@ -19,21 +27,66 @@ def property_from_field(field):
     )
 
 
-def model_adapter(django_model, manager):
-    """ Return a generated subclass of django_model that conforms to the
-    API that boto expects of its own models.
+class Entity(dict):
+    """ What boto gets back when it instantiates a ModelAdapter - the item's
+    attributes, plus its name as _id. Being a dict subclass lets boto set
+    attributes like _loaded on it.
+    """
+
+
+class ModelInfo(object):
+    """ Per-model lookups the adapter needs, worked out once per model
+    """
+
+    def __init__(self, django_model):
+        self.pk = django_model._meta.pk
+        self.fields = list(django_model._meta.fields)
+        self.by_name = dict((f.name, f) for f in self.fields)
+        # Properties are built once, except for fields with callable
+        # defaults - those need the default evaluating on every call.
+        self._properties = {}
+        for field in self.fields + [self.pk]:
+            if not callable(field.default):
+                self._properties[field] = property_from_field(field)
+
+    def property(self, field):
+        try:
+            return self._properties[field]
+        except KeyError:
+            return property_from_field(field)
+
+
+_adapters = {}
+
+def clear_adapters(**kwargs):
+    """ Forget every cached adapter. Connected to class_prepared, so models
+    registered after an adapter was built can't leave it stale.
     """
+    _adapters.clear()
+
+class_prepared.connect(clear_adapters)
+
+def model_adapter(django_model):
+    """ Return a generated class for django_model that conforms to the
+    API that boto expects of its own models. Adapters are cached per model.
+    """
+    try:
+        return _adapters[django_model]
+    except KeyError:
+        adapter = _adapters[django_model] = _build_adapter(django_model)
+        return adapter
+
+def _build_adapter(django_model):
+    info = ModelInfo(django_model)
+
     class ModelAdapter(object):
         """ Adapter to provide the API that boto expects its models to have for
         normal Django models
         """
         def __new__(self, id, **params):
-            domain_name = domain_for_model(self.model_class)
-            domain = Domain(name=domain_name, connection=manager.sdb)
-            item = Item(domain, id)
-            params['_id'] = id
-            item.update(params)
-            return item
+            entity = Entity(params)
+            entity['_id'] = id
+            return entity
             #return self.model_class(**attrs)
 
         # Used by SDBManager._get_all_descendents. Might need to implement
@@ -52,64 +105,646 @@ def model_adapter(django_model, manager):
             """
             # Special-case - _id always maps to the primary key
             if prop_name == '_id':
-                return property_from_field(django_model._meta.pk)
+                return info.property(info.pk)
 
-            # Otherwise, look through the Django model fields for a field
-            # of the correct name. XXX should this be name or column?
-            result = None
-            for field in django_model._meta.fields:
-                if field.name == prop_name:
-                    result = property_from_field(field)
-                    break
-            return result
+            # Otherwise, look up the Django model field of the correct name.
+            # XXX should this be name or column?
+            field = info.by_name.get(prop_name)
+            if field is None:
+                return None
+            return info.property(field)
 
         @classmethod
         def properties(cls, hidden=True):
-            return [property_from_field(f) for f in django_model._meta.fields]
+            return [info.property(f) for f in info.fields]
 
     ModelAdapter.model_class = django_model
     ModelAdapter.__name__ =  domain_for_model(django_model)
     return ModelAdapter
 
 
+def unique(entities):
+    """ Generate entities, skipping any with an item name seen before
+    """
+    seen = set()
+    for entity in entities:
+        if entity['_id'] not in seen:
+            seen.add(entity['_id'])
+            yield entity
+
+
+def unique_names(names):
+    """ Generate names, skipping any seen before
+    """
+    seen = set()
+    for name in names:
+        if name not in seen:
+            seen.add(name)
+            yield name
+
+
+class SortKey(object):
+    """ Sort key for merging ordered results, which can be reversed for
+    descending orders. Missing values sort first, as in SimpleDB.
+    """
+    __slots__ = ('value', 'reverse')
+
+    def __init__(self, value, reverse=False):
+        self.value = value
+        self.reverse = reverse
+
+    def __lt__(self, other):
+        if self.reverse:
+            return other.value < self.value
+        return self.value < other.value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+
 class SimpleDBQuery(BotoQuery):
 
-    def __init__(self, manager, model, limit=None, next_token=None):
+    def __init__(self, manager, model, limit=None, next_token=None,
+            manager_factory=None, workers=1, offset_cache=None,
+            read_ahead=0, count_cache=None, columns=None,
+            result_cache=None, identity_map=None, shards=1):
         self.manager = manager
-        self.model_class = model_adapter(model, manager)
+        # Called with a domain name to get a manager for the current thread.
+        # Without one, everything runs on self.manager in a single thread.
+        self.manager_factory = manager_factory
+        self.workers = workers
+        # Maps count expressions to {offset: NextToken} dicts, so repeated
+        # pages of the same query don't need to walk from the start again.
+        self.offset_cache = offset_cache
+        # Maps (count expression, limit) to recent counts
+        self.count_cache = count_cache
+        # A simpledb.cache.ResultCache for fetched entities
+        self.result_cache = result_cache
+        # A simpledb.cache.IdentityMap for entities fetched by pk
+        self.identity_map = identity_map
+        # Number of pages to fetch ahead of the consumer, on a background
+        # thread. Needs a manager_factory, so the thread has its own manager.
+        self.read_ahead = read_ahead
+        self.model_class = model_adapter(model)
         self.model = model
+        # Number of domains the model's items are spread over, by a hash of
+        # their names. Sharded queries run once for every domain, and the
+        # results are merged.
+        self.shards = shards
+        # The domain selected from, for queries that aren't sharded
+        self.domain_name = domain_for_model(model)
+        # The columns to fetch, defaulting to all of them. The pk is the item
+        # name rather than an attribute, so it's always there.
+        all_columns = [f.column for f in model._meta.fields
+            if not f.primary_key]
+        if columns is None:
+            columns = all_columns
+        self.columns = [c for c in columns if c in all_columns]
+        self.all_columns = len(self.columns) == len(all_columns)
         self.limit = limit
         self.offset = 0
         self.filters = []
+        # Select expression predicates, ANDed together
+        self.predicates = []
+        # Lists of alternative predicates, too big for a single select. The
+        # query is run once for every combination, and the results merged.
+        self.splits = []
+        # Whether split alternatives can match the same items, rather than
+        # being chunks of one in list
+        self.overlapping = False
+        # The item names wanted, for queries that only filter on pk. These
+        # are fetched with GetAttributes rather than selected.
+        self.keys = None
         self.select = None
         self.sort_by = None
+        # Orderings after the first, (column, reverse) pairs. SimpleDB only
+        # sorts on one attribute, so these are applied here.
+        self.then_by = []
         self.rs = None
         self.next_token = next_token
 
     def fetch_infinite(self, offset):
-        # XXX todo self.offset = offset
-        if offset:
-            raise NotImplementedError
-        return self.manager.query(self)
+        """ Generate every matching entity, skipping the first offset.
+        """
+        return self.fetch_range(None, offset)
 
     def fetch_range(self, count, low_mark):
-        self.fetch(offset=low_mark, limit=low_mark+count)
-        return self.manager.query(self)
+        """ Generate count matching entities (or all of them, if count is
+        None), starting at low_mark. Results are cached if there's a
+        result_cache.
+        """
+        if self.keys is not None or self.result_cache is None:
+            return self._fetch_range(count, low_mark)
+        key = self.result_cache.key(domain_for_model(self.model),
+            '%s|%s|%s' % (self.signature(), count, low_mark))
+        entities = self.result_cache.get(key)
+        if entities is not None:
+            return iter([dict(entity) for entity in entities])
+        return self._cache_results(key, self._fetch_range(count, low_mark))
 
-    def add_ordering(self, column, direction):
-        if direction.lower() == 'desc':
-            sort_by = '-%s' % column
+    def _cache_results(self, key, entities):
+        """ Yield entities, caching copies of them once they've all been
+        read, unless there are too many.
+        """
+        cached = []
+        for entity in entities:
+            if cached is not None:
+                if len(cached) < self.result_cache.max_rows:
+                    cached.append(dict(entity))
+                else:
+                    cached = None
+            yield entity
+        if cached is not None:
+            self.result_cache.set(key, cached)
+
+    def _fetch_range(self, count, low_mark):
+        if self.keys is not None:
+            high_mark = None
+            if count is not None:
+                high_mark = low_mark + count
+            entities = self.get_entities()
+            if self.sort_by:
+                entities.sort(key=self.sort_key)
+            return iter(entities[low_mark:high_mark])
+        if self.fanned_out() or self.then_by:
+            # Results come from several branches, or need sorting here, so
+            # the offset can't be skipped in SimpleDB.
+            high_mark = None
+            if count is not None:
+                high_mark = low_mark + count
+            # Sorting on later keys needs every item that ties with the last
+            # one wanted on the first key, so no limit can be set.
+            limit = high_mark
+            if self.then_by:
+                limit = None
+            if self.fanned_out():
+                # An item with several values for the split attribute can
+                # turn up in more than one branch.
+                results = unique(self.merge([branch.iterate(limit)
+                    for branch in self.branches()], bool(self.sort_by)))
+            else:
+                results = self.iterate(limit)
+            if self.then_by:
+                results = self.sort_ties(results, high_mark)
+            return itertools.islice(results, low_mark, high_mark)
+        if low_mark:
+            next_token = self.skip(low_mark)
+            if next_token is None:
+                return iter(())
         else:
-            sort_by = column
+            next_token = None
+        return self.iterate(count, next_token)
+
+    def skip(self, offset):
+        """ Return a NextToken positioned after the first offset matching
+        items, or None if there aren't that many. Only item counts are
+        requested, so no attributes are downloaded on the way.
+        """
+        query = self.select_expression('count(*)')
+        tokens = None
+        position, next_token = 0, None
+        if self.offset_cache is not None:
+            key = self.offset_cache.key(domain_for_model(self.model), query)
+            tokens = self.offset_cache.get(key)
+            if tokens is None:
+                tokens = {}
+                self.offset_cache.set(key, tokens)
+            known = [o for o in tokens if o <= offset]
+            if known:
+                position = max(known)
+                next_token = tokens[position]
+
+        while position < offset:
+            page_size = min(offset - position, AWS_MAX_RESULT_SIZE)
+            rs = self.select_page('%s limit %s' % (query, page_size),
+                next_token)
+            # SimpleDB may return a partial count if it runs out of time,
+            # so go by what it reports rather than what was asked for.
+            for item in rs:
+                position += int(item['Count'])
+            next_token = rs.next_token
+            if not next_token:
+                return None
+            if tokens is not None:
+                tokens[position] = next_token
+        return next_token
+
+    def count(self, limit=None):
+        """ Count matching items, up to limit, with select count(*). SimpleDB
+        returns a partial count and a NextToken when a count takes too long,
+        so those are followed and summed.
+        """
+        if self.keys is not None:
+            count = len(self.get_entities())
+            if limit is not None:
+                count = min(count, limit)
+            return count
+        if self.splits and self.overlapping:
+            # Branches can match the same items, so count distinct names
+            return len(list(itertools.islice(self.item_names(), limit)))
+        if self.fanned_out():
+            # Shards never share items, and branches split on an attribute
+            # with one value never share items either, so their counts add up
+            counts = concurrent_map(lambda branch: branch.count(limit),
+                self.branches(), self.concurrency())
+            count = sum(counts)
+            if limit is not None:
+                count = min(count, limit)
+            return count
+
+        query = self.select_expression('count(*)')
+        if self.count_cache is not None:
+            count = self.count_cache.get((query, limit))
+            if count is not None:
+                return count
+
+        count, next_token = 0, None
+        while limit is None or count < limit:
+            page_size = AWS_MAX_RESULT_SIZE
+            if limit is not None:
+                page_size = min(limit - count, page_size)
+            rs = self.select_page('%s limit %s' % (query, page_size),
+                next_token)
+            for item in rs:
+                count += int(item['Count'])
+            next_token = rs.next_token
+            if not next_token:
+                break
+        if limit is not None:
+            count = min(count, limit)
+        if self.count_cache is not None:
+            self.count_cache.set((query, limit), count)
+        return count
+
+    def iterate(self, limit=None, next_token=None):
+        """ Generate matching entities, requesting pages from SimpleDB only as
+        they're needed. No more than limit entities are requested. Only one
+        page is held in memory at a time, plus any being read ahead.
+        """
+        pages = self.pages(self.select_expression(self.output()), limit,
+            next_token)
+        if self.read_ahead and self.manager_factory is not None:
+            pages = read_ahead(pages, self.read_ahead)
+        for rs in pages:
+            for item in rs:
+                yield self.entity(item)
+
+    def pages(self, query, limit=None, next_token=None):
+        """ Generate pages of results for query, each a boto ResultSet, until
+        limit items have been returned or there are no more.
+        """
+        remaining = limit
+        while remaining is None or remaining > 0:
+            page_size = AWS_MAX_RESULT_SIZE
+            if remaining is not None:
+                page_size = min(remaining, page_size)
+            rs = self.select_page('%s limit %s' % (query, page_size),
+                next_token)
+            yield rs
+            if remaining is not None:
+                remaining -= len(rs)
+            next_token = rs.next_token
+            if not next_token:
+                break
+
+    def parallel_scan(self, segments=16, ordered=False, points=None):
+        """ Generate every matching entity, splitting the domain into
+        itemName() ranges that are scanned concurrently, up to self.workers
+        at a time.
 
-        if self.sort_by and self.sort_by != sort_by:
-            # XXX What should we do here? Order in software?
-            raise NotImplementedError
+        Ranges are split at points, which default to evenly spaced item
+        names of the form save_entity generates. If ordered is true, results
+        come back in the query's order (or item name order, if it has none),
+        merged from every range as they arrive. Otherwise they're yielded as
+        soon as any range produces them.
+        """
+        if self.fanned_out() or self.keys is not None:
+            # Split and sharded queries already run their branches
+            # concurrently, and items fetched by pk don't need scanning for
+            return self.fetch_range(None, 0)
+        if points is None:
+            points = uuid_split_points(segments)
+        bounds = [None] + list(points) + [None]
+        scans = [self.scan_range(lower, upper, ordered)
+            for lower, upper in zip(bounds[:-1], bounds[1:])]
+        if ordered and self.then_by:
+            return self.sort_ties(self.merge(scans, ordered))
+        return self.merge(scans, ordered)
+
+    def sort_key(self, entity):
+        """ Key for sorting entities on every ordering column
+        """
+        key = [SortKey(entity.get(self.sort_by.lstrip('-')),
+            self.sort_by.startswith('-'))]
+        for column, reverse in self.then_by:
+            key.append(SortKey(entity.get(column), reverse))
+        return tuple(key)
+
+    def get_entities(self):
+        """ Return a list of the entities named by self.keys that exist, in
+        the same order, fetched with GetAttributes - up to self.workers at a
+        time - or from the identity map. Reads are consistent, so an item
+        saved just before is found.
+        """
+        domain_name = domain_for_model(self.model)
+        names = list(unique_names(self.keys))
+        def get(index):
+            item_name = names[index]
+            if self.identity_map is not None:
+                found, entity = self.identity_map.get(domain_name, item_name)
+                if found:
+                    return index, entity and self.project(entity)
+            sdb = self.thread_manager().sdb
+            domain = Domain(name=domain_for_item(domain_name, item_name,
+                self.shards), connection=sdb)
+            attribute_names = None
+            if not self.all_columns:
+                # Every item has a __type__, so an empty result means there's
+                # no such item
+                attribute_names = self.selected_columns() + ['__type__']
+            item = sdb.get_attributes(domain, item_name, attribute_names,
+                consistent_read=True)
+            entity = None
+            if item:
+                entity = self.entity(item)
+            if self.identity_map is not None and self.all_columns:
+                self.identity_map.set(domain_name, item_name, entity)
+            return index, entity
+        results = sorted(concurrent_map(get, range(len(names)),
+            self.concurrency()))
+        return [dict(entity) for index, entity in results if entity]
+
+    def project(self, entity):
+        """ Copy of an entity with only the selected columns
+        """
+        projected = dict((column, entity[column])
+            for column in self.selected_columns() if column in entity)
+        projected['_id'] = entity['_id']
+        return projected
+
+    def sort_ties(self, entities, limit=None):
+        """ Apply the orderings after the first to entities already sorted on
+        it, one run of equal first values at a time. With a limit, only that
+        many entities are ever held, in a heap.
+        """
+        column = self.sort_by.lstrip('-')
+        def key(entity):
+            return tuple([SortKey(entity.get(c), reverse)
+                for c, reverse in self.then_by])
+        remaining = limit
+        for value, ties in itertools.groupby(entities,
+                lambda entity: entity.get(column)):
+            if remaining is None:
+                ordered = sorted(ties, key=key)
+            else:
+                ordered = heapq.nsmallest(remaining, ties, key=key)
+                remaining -= len(ordered)
+            for entity in ordered:
+                yield entity
+            if remaining == 0:
+                break
+
+    def merge(self, scans, ordered):
+        """ Combine the entities generated by several scans. Up to
+        self.workers scans run at once. If ordered is true, each scan must be
+        in the query's order (or item name order, if it has none), and so are
+        the merged results.
+        """
+        concurrent = self.manager_factory is not None
+        if not ordered:
+            if concurrent:
+                return interleave(scans, self.workers)
+            return itertools.chain(*scans)
+
+        # Every scan is already sorted, so a merge of them is too. When
+        # running concurrently, each scan keeps a couple of pages buffered
+        # on its own thread.
+        column, reverse = '_id', False
+        if self.sort_by:
+            column = self.sort_by.lstrip('-')
+            reverse = self.sort_by.startswith('-')
+        def keyed(scan):
+            if concurrent:
+                scan = read_ahead(scan, 2)
+            for entity in scan:
+                # Item names break ties, so entities are never compared
+                yield (SortKey(entity.get(column), reverse), entity['_id'],
+                    entity)
+        return (entity for key, item_name, entity in
+            heapq.merge(*[keyed(scan) for scan in scans]))
 
-        self.sort_by = sort_by
+    def fanned_out(self):
+        """ Whether this query runs as several selects, for its shards or
+        split alternatives.
+        """
+        return bool(self.splits) or self.shards > 1
+
+    def shard_queries(self):
+        """ Return a copy of this query for each of its domains. Queries for
+        keys get each item from its own domain, so aren't copied.
+        """
+        if self.shards <= 1 or self.keys is not None:
+            return [self]
+        queries = []
+        for domain_name in shard_domains(domain_for_model(self.model),
+                self.shards):
+            query = copy.copy(self)
+            query.domain_name = domain_name
+            query.shards = 1
+            queries.append(query)
+        return queries
+
+    def branches(self):
+        """ Generate a copy of this query for every domain and combination of
+        split alternatives, each selecting from one domain without splits.
+        """
+        for query in self.shard_queries():
+            for alternatives in itertools.product(*self.splits):
+                branch = copy.copy(query)
+                branch.predicates = self.predicates + list(alternatives)
+                branch.splits = []
+                yield branch
+
+    def concurrency(self):
+        """ Number of requests to run at once - one, unless there's a
+        manager_factory to give each thread its own manager.
+        """
+        if self.manager_factory is None:
+            return 1
+        return self.workers
+
+    def scan_range(self, lower=None, upper=None, ordered=False):
+        """ Generate matching entities whose item names fall in the range
+        [lower, upper). Either bound can be None, for an open range.
+        """
+        where = ['itemName() >= %s' % quote(lower or '')]
+        if upper is not None:
+            where.append('itemName() < %s' % quote(upper))
+        query = self.select_expression(self.output(), ' and '.join(where))
+        if ordered and not self.sort_by:
+            query += ' order by itemName()'
+        for rs in self.pages(query):
+            for item in rs:
+                yield self.entity(item)
+
+    def entity(self, item):
+        """ Convert a boto Item into the entity dict the compiler expects,
+        holding the requested columns and the item name as _id.
+        """
+        entity = {}
+        for column in self.selected_columns():
+            if column in item:
+                entity[column] = item[column]
+        entity['_id'] = item.name
+        return entity
+
+    def selected_columns(self):
+        """ The requested columns, plus the ones being sorted on, which
+        merging and sorting results needs.
+        """
+        columns = list(self.columns)
+        if self.sort_by:
+            sorted_on = [self.sort_by.lstrip('-')]
+            sorted_on += [column for column, reverse in self.then_by]
+            for column in sorted_on:
+                if column != '_id' and column not in columns:
+                    columns.append(column)
+        return columns
+
+    def output(self):
+        """ The output list for selects, naming only the columns needed
+        """
+        if self.all_columns:
+            return '*'
+        columns = self.selected_columns()
+        if not columns:
+            return 'itemName()'
+        # Every item has a __type__, so asking for it too means items
+        # without any of the other columns still come back.
+        return ', '.join([quote_name(column) for column in columns] +
+            ['`__type__`'])
+
+    def select_page(self, query, next_token=None):
+        """ Run a single select request, returning boto's ResultSet
+        """
+        sdb = self.thread_manager().sdb
+        domain = Domain(name=self.domain_name, connection=sdb)
+        return sdb.select(domain, query, next_token=next_token)
+
+    def add_ordering(self, column, direction):
+        reverse = direction.lower() == 'desc'
+        if not self.sort_by:
+            # SimpleDB sorts on the first column
+            self.sort_by = reverse and '-%s' % column or column
+        elif column != self.sort_by.lstrip('-') and \
+                column not in [c for c, r in self.then_by]:
+            self.then_by.append((column, reverse))
+
+    def add_predicate(self, predicate):
+        self.predicates.append(predicate)
+
+    def add_split(self, alternatives, overlapping=False):
+        """ Match any of several predicates, which have to be run as separate
+        selects. overlapping says whether an item can match more than one.
+        """
+        if len(alternatives) == 1:
+            self.add_predicate(alternatives[0])
+        elif alternatives:
+            self.splits.append(alternatives)
+            self.overlapping = self.overlapping or overlapping
+
+    def signature(self):
+        """ A string identifying what this query returns
+        """
+        branches = self.fanned_out() and self.branches() or [self]
+        return '|'.join([branch.select_expression(branch.output())
+            for branch in branches] + [repr(self.then_by)])
+
+    def select_expression(self, output='*', where=None):
+        """ Build a select expression for this query's filters and ordering,
+        optionally ANDed with an extra where clause.
+        """
+        assert not self.fanned_out(), \
+            'Split and sharded queries have no single expression'
+        parts = list(self.predicates)
+        if self.select:
+            parts.insert(0, '(%s)' % self.select)
+        if where:
+            parts.append(where)
+        select = ' and '.join(parts) or None
+        sort_by = self.sort_by
+        if sort_by:
+            # boto backquotes the sort column without escaping it
+            sort_by = sort_by.replace('`', '``')
+        return 'select %s from %s %s' % (output, quote_name(self.domain_name),
+            self.manager._build_filter_part(self.model_class, self.filters,
+                sort_by, select))
+
+    def item_names(self):
+        """ Generate the name of every item matching this query, a page at a
+        time, without fetching any attributes.
+        """
+        if self.keys is not None:
+            for entity in self.get_entities():
+                yield entity['_id']
+            return
+        if self.fanned_out():
+            seen = set()
+            for branch in self.branches():
+                for item_name in branch.item_names():
+                    if item_name not in seen:
+                        seen.add(item_name)
+                        yield item_name
+            return
+        query = self.select_expression('itemName()')
+        next_token = None
+        while True:
+            rs = self.select_page(query, next_token)
+            for item in rs:
+                yield item.name
+            next_token = rs.next_token
+            if not next_token:
+                break
+
+    def thread_manager(self):
+        """ Return a manager that's safe to use on the current thread
+        """
+        if self.manager_factory is None:
+            return self.manager
+        return self.manager_factory(domain_for_model(self.model))
 
     def delete(self):
-        items = dict([(e['_id'], None) for e in self.fetch_infinite(0)])
-        domain = Domain(name=domain_for_model(self.model),
-            connection=self.manager.sdb)
-        return domain.batch_delete_attributes(items)
+        """ Delete every matching item, in batches of 25, running up to
+        self.workers batches at once. Item names are streamed from SimpleDB
+        a page at a time, so memory use doesn't grow with the number of
+        items deleted. Queries for keys delete them without getting them
+        first, as deleting a missing item does nothing.
+        """
+        def delete_batch((domain_name, batch)):
+            domain = Domain(name=domain_name,
+                connection=self.thread_manager().sdb)
+            return domain.batch_delete_attributes(
+                dict([(item_name, None) for item_name in batch]))
+
+        def names(query):
+            if query.keys is not None:
+                return unique_names(query.keys)
+            return query.item_names()
+
+        # Batches from a shard's select all belong to that shard
+        batches = (group
+            for query in self.shard_queries()
+            for batch in chunks(names(query), AWS_MAX_BATCH_ITEMS)
+            for group in group_by_domain(domain_for_model(self.model), batch,
+                self.shards))
+        try:
+            for result in concurrent_map(delete_batch, batches,
+                    self.concurrency()):
+                pass
+        finally:
+            if self.result_cache is not None:
+                self.result_cache.invalidate(domain_for_model(self.model))
+            if self.offset_cache is not None:
+                self.offset_cache.invalidate(domain_for_model(self.model))
+            if self.identity_map is not None:
+                self.identity_map.invalidate(domain_for_model(self.model))
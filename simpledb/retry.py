@@ -0,0 +1,238 @@
+"""
+Retrying requests that SimpleDB failed to serve, and rate limiting requests
+to each domain.
+
+SimpleDB answers with 503 ServiceUnavailable when a domain is getting more
+requests than it can take. Retrying straight away only adds to the load, so
+retries back off exponentially, with random jitter so that many workers
+don't all retry at once. Each domain also has a token bucket, whose rate is
+halved whenever SimpleDB throttles a request, and grows back slowly as
+requests succeed. Rate limiting is off unless a RATE_LIMIT is set.
+"""
+import logging
+import random
+import re
+import threading
+import time
+import urlparse
+
+from boto.exception import BotoServerError
+from boto.sdb.connection import SDBConnection
+# Imported before SDBManager to avoid a cyclic import - see simpledb.base
+from boto.sdb.db import model
+from boto.sdb.db.manager.sdbmanager import SDBManager
+
+logger = logging.getLogger('simpledb')
+
+# HTTP statuses worth retrying: RequestTimeout, InternalError and
+# ServiceUnavailable
+RETRY_STATUSES = set([408, 500, 503])
+# Statuses meaning the domain is getting too many requests
+THROTTLE_STATUSES = set([503])
+# The domain a select expression reads from
+SELECT_DOMAIN = re.compile(r'\bfrom\s+`((?:[^`]|``)*)`', re.I)
+
+
+def request_domain(request):
+    """ The name of the domain a request is for. Selects name theirs in the
+    select expression rather than with a DomainName parameter.
+    """
+    domain_name = request.params.get('DomainName')
+    if domain_name is None and request.params.get('Action') == 'Select':
+        match = SELECT_DOMAIN.search(request.params.get('SelectExpression',
+            ''))
+        if match:
+            domain_name = match.group(1).replace('``', '`')
+    return domain_name
+
+
+class TokenBucket(object):
+    """ Thread safe rate limiter, allowing rate requests a second on average,
+    in bursts of up to a second's worth. Each throttling response halves the
+    rate, down to min_rate; each successful request adds increase to it, up
+    to the rate it started at.
+    """
+
+    def __init__(self, rate, min_rate=1.0, increase=0.1):
+        self.max_rate = self.rate = float(rate)
+        self.min_rate = min_rate
+        self.increase = increase
+        self.tokens = self.rate
+        self.updated = time.time()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """ Take a token, first waiting for one if there are none left
+        """
+        while True:
+            self._lock.acquire()
+            try:
+                now = time.time()
+                self.tokens = min(max(self.rate, 1),
+                    self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            finally:
+                self._lock.release()
+            time.sleep(wait)
+
+    def throttled(self):
+        self._lock.acquire()
+        try:
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.tokens = min(self.tokens, 0)
+        finally:
+            self._lock.release()
+
+    def succeeded(self):
+        self._lock.acquire()
+        try:
+            self.rate = min(self.max_rate, self.rate + self.increase)
+        finally:
+            self._lock.release()
+
+
+class RetryPolicy(object):
+    """ How failed requests are retried, and the rate limits for every
+    domain, shared by all the connections of a database.
+    """
+
+    def __init__(self, retries=5, base_delay=0.05, max_delay=5.0,
+            rate_limit=None):
+        # Number of times a request is retried before giving up
+        self.retries = retries
+        # The nth retry waits for a random time up to base_delay * 2 ** n
+        # seconds, and never more than max_delay
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        # Initial requests a second allowed for each domain. None turns rate
+        # limiting off.
+        self.rate_limit = rate_limit
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def bucket(self, domain_name):
+        """ The token bucket for a domain, or None if there's no rate limit
+        """
+        if not self.rate_limit:
+            return None
+        self._lock.acquire()
+        try:
+            try:
+                return self._buckets[domain_name]
+            except KeyError:
+                bucket = self._buckets[domain_name] = TokenBucket(
+                    self.rate_limit)
+                return bucket
+        finally:
+            self._lock.release()
+
+    def delay(self, attempt):
+        """ Seconds to wait before retrying after attempt failed, with full
+        jitter.
+        """
+        return random.uniform(0,
+            min(self.max_delay, self.base_delay * 2 ** attempt))
+
+
+def retry_policy(settings):
+    """ Build the RetryPolicy for a database's settings
+    """
+    return RetryPolicy(
+        retries=settings.get('RETRIES', 5),
+        base_delay=settings.get('RETRY_BASE_DELAY', 0.05),
+        max_delay=settings.get('RETRY_MAX_DELAY', 5.0),
+        rate_limit=settings.get('RATE_LIMIT'))
+
+
+class RetryingSDBConnection(SDBConnection):
+    """ SDBConnection sending requests according to a RetryPolicy. This
+    replaces boto's own retries, which wait 1, 2, 4... seconds between
+    attempts whatever the error, and limit nothing. Redirects are followed
+    as boto does, and override_num_retries still overrides the policy.
+    """
+
+    def __init__(self, policy, *args, **kwargs):
+        SDBConnection.__init__(self, *args, **kwargs)
+        self.policy = policy
+
+    def _mexe(self, request, sender=None, override_num_retries=None):
+        domain_name = request_domain(request)
+        bucket = self.policy.bucket(domain_name)
+        retries = self.policy.retries
+        if override_num_retries is not None:
+            retries = override_num_retries
+        connection = self.get_http_connection(request.host, self.is_secure)
+        attempt = 0
+        while True:
+            if bucket is not None:
+                bucket.acquire()
+            try:
+                # Requests are signed again for each attempt
+                request.authorize(connection=self)
+                if callable(sender):
+                    response = sender(connection, request.method,
+                        request.path, request.body, request.headers)
+                else:
+                    connection.request(request.method, request.path,
+                        request.body, request.headers)
+                    response = connection.getresponse()
+            except self.http_exceptions, e:
+                for unretryable in self.http_unretryable_exceptions:
+                    if isinstance(e, unretryable):
+                        raise
+                error = e
+                connection = self.new_http_connection(request.host,
+                    self.is_secure)
+            else:
+                location = response.getheader('location')
+                if 300 <= response.status < 400 and location:
+                    scheme, request.host, request.path, params, query, \
+                        fragment = urlparse.urlparse(location)
+                    if query:
+                        request.path += '?' + query
+                    connection = self.get_http_connection(request.host,
+                        scheme == 'https')
+                    continue
+                if response.status not in RETRY_STATUSES:
+                    self.put_http_connection(request.host, self.is_secure,
+                        connection)
+                    if bucket is not None:
+                        bucket.succeeded()
+                    return response
+                error = BotoServerError(response.status, response.reason,
+                    response.read())
+                if bucket is not None and response.status in THROTTLE_STATUSES:
+                    bucket.throttled()
+            if attempt >= retries:
+                raise error
+            delay = self.policy.delay(attempt)
+            logger.debug('%s %s failed with %r, retrying in %.2fs',
+                request.params.get('Action'), domain_name, error, delay)
+            time.sleep(delay)
+            attempt += 1
+
+
+class RetryingSDBManager(SDBManager):
+    """ SDBManager connecting with a RetryingSDBConnection
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.policy = kwargs.pop('policy')
+        SDBManager.__init__(self, *args, **kwargs)
+
+    def _connect(self):
+        self._sdb = self.new_connection()
+        # As in SDBManager, assume the domain exists rather than checking
+        self._domain = self._sdb.lookup(self.db_name, validate=False)
+        if not self._domain:
+            self._domain = self._sdb.create_domain(self.db_name)
+
+    def new_connection(self):
+        return RetryingSDBConnection(self.policy,
+            aws_access_key_id=self.db_user,
+            aws_secret_access_key=self.db_passwd,
+            is_secure=self.enable_ssl)
@@ -17,12 +17,7 @@ class ModelAdapterTests(unittest.TestCase):
 
     def adapt(self, model):
         from simpledb.query import model_adapter
-        from boto.sdb.db import model as boto_model
-        from boto.sdb.db.manager.sdbmanager import SDBManager
-
-        manager = mock.Mock(spec=SDBManager)
-        manager.sdb = self.sdb = mock.Mock(name='sdb')
-        return model_adapter(model, manager)
+        return model_adapter(model)
 
     def test_find_property_ok(self):
         """ find_property should return a boto Property object for fields
@@ -64,6 +59,30 @@ class ModelAdapterTests(unittest.TestCase):
         self.assertEqual(1, m.find_property('counter').default)
         self.assertEqual(2, m.find_property('counter').default)
 
+    def test_cached(self):
+        """ Adapters and their properties are built once per model
+        """
+        self.assertTrue(self.adapt(M) is self.adapt(M))
+        m = self.adapt(M)
+        self.assertTrue(m.find_property('name') is m.find_property('name'))
+        self.assertEqual(['id', 'name'], [p.name for p in m.properties()])
+
+    def test_cache_cleared(self):
+        """ Registering a new model clears the adapter cache
+        """
+        m = self.adapt(M)
+        class O(models.Model):
+            pass
+        self.assertFalse(m is self.adapt(M))
+
+    def test_instantiate(self):
+        """ boto instantiates adapters to get at query results, which just
+        gives back the attributes and item name
+        """
+        entity = self.adapt(M)('1', name='foo')
+        self.assertEqual({'_id': '1', 'name': 'foo'}, entity)
+        entity._loaded = True
+
     def test_missing_property_none(self):
         """ If the property is missing, we should get None back.
         """
@@ -76,10 +95,13 @@ class SaveEntityTests(unittest.TestCase):
     def setUp(self):
         from boto.sdb.db import model
         from boto.sdb.db.manager.sdbmanager import SDBManager
+        from simpledb.cache import IdentityMap
         self.manager = mock.Mock(spec=SDBManager)
         self.manager.sdb = self.sdb = mock.Mock(name='sdb')
         self.connection = mock.Mock()
+        self.connection.settings_dict = {}
         self.connection.create_manager.return_value = self.manager
+        self.connection.identity_map = IdentityMap()
 
     def save_entity(self, *args, **kwargs):
         from simpledb.compiler import save_entity
@@ -103,8 +125,11 @@ class SaveEntityTests(unittest.TestCase):
             'simpledb_m',
             'name': 'foo',
         }, data)
-        self.assertTrue(replace)
+        # The item is new, so there's nothing to replace
+        self.assertFalse(replace)
         self.assertEqual(None, expected)
+        self.connection.result_cache.invalidate.assert_called_with(
+            'simpledb_m')
 
     def test_save_entity_with_id(self):
         """ Check that the appropriate methods are invoked on the boto
@@ -131,6 +156,734 @@ class SaveEntityTests(unittest.TestCase):
         self.assertTrue(replace)
         self.assertEqual(None, expected)
 
+    def test_save_entity_nulls(self):
+        """ Columns set to None are deleted rather than stored, unless the
+        item is new.
+        """
+        self.save_entity(self.connection, M, {'name': None, 'fk_id': u'1'})
+        attrs = self.sdb.put_attributes.call_args[0][2]
+        self.assertFalse('name' in attrs)
+        self.assertEqual(u'1', attrs['fk_id'])
+        self.assertFalse(self.sdb.delete_attributes.called)
+        self.save_entity(self.connection, M, {'name': None, '_id': u'x'})
+        self.assertEqual({'_id': u'x', '__type__': 'simpledb_m'},
+            self.sdb.put_attributes.call_args[0][2])
+        args = self.sdb.delete_attributes.call_args[0]
+        self.assertEqual((u'x', ['name']), args[1:3])
+
+    def test_save_entity_changed(self):
+        """ Items fetched earlier in the request only have their changed
+        attributes written.
+        """
+        identity_map = self.connection.identity_map
+        identity_map.start()
+        try:
+            identity_map.set('simpledb_m', u'x',
+                {'_id': u'x', 'name': u'foo', 'a': u'1', 'b': u'2'})
+            self.assertEqual(u'x', self.save_entity(self.connection, M,
+                {'_id': u'x', 'name': u'bar', 'a': u'1', 'b': None,
+                'c': None}))
+            args = self.sdb.batch_put_attributes.call_args[0]
+            self.assertEqual({u'x': {'name': u'bar'}}, args[1])
+            args = self.sdb.get_status.call_args[0]
+            self.assertEqual({'DomainName': 'simpledb_m',
+                'Item.0.ItemName': u'x', 'Item.0.Attribute.0.Name': 'b'},
+                args[1])
+            self.assertFalse(self.sdb.put_attributes.called)
+            # Saves drop the domain's items from the map
+            self.assertEqual((False, None), identity_map.get('simpledb_m', u'x'))
+        finally:
+            identity_map.finish()
+
+
+class SaveEntitiesTests(unittest.TestCase):
+
+    def setUp(self):
+        from boto.sdb.db.manager.sdbmanager import SDBManager
+        self.manager = mock.Mock(spec=SDBManager)
+        self.manager.sdb = self.sdb = mock.Mock(name='sdb')
+        self.connection = mock.Mock()
+        self.connection.settings_dict = {}
+        self.connection.create_manager.return_value = self.manager
+
+    def save_entities(self, *args, **kwargs):
+        from simpledb.compiler import save_entities
+        return save_entities(*args, **kwargs)
+
+    def test_batches(self):
+        """ Rows are sent 25 at a time with BatchPutAttributes, and their ids
+        returned in order.
+        """
+        rows = [{'_id': str(i), 'name': u'foo'} for i in range(30)]
+        r = self.save_entities(self.connection, M, rows)
+        self.assertEqual([str(i) for i in range(30)], r)
+        self.assertEqual(2, self.sdb.batch_put_attributes.call_count)
+        sizes = []
+        for args, kwargs in self.sdb.batch_put_attributes.call_args_list:
+            domain, items, replace = args
+            self.assertEqual('simpledb_m', domain.name)
+            self.assertTrue(replace)
+            sizes.append(len(items))
+        self.assertEqual([25, 5], sizes)
+        self.assertEqual({
+            '_id': '0',
+            '__type__': 'simpledb_m',
+            'name': 'foo'
+        }, self.sdb.batch_put_attributes.call_args_list[0][0][1]['0'])
+        self.assertFalse(self.sdb.put_attributes.called)
+
+    def test_new_ids(self):
+        r = self.save_entities(self.connection, M, [{'name': u'foo'}] * 2)
+        self.assertEqual(2, len(set(r)))
+
+    def test_delete_none(self):
+        """ Attributes set to None are deleted from items that might already
+        exist, but not from new ones
+        """
+        rows = [{'_id': 'a', 'name': None}, {'_id': 'b', 'name': u'foo'},
+            {'name': None}]
+        self.save_entities(self.connection, M, rows)
+        [(args, kwargs)] = self.sdb.get_status.call_args_list
+        self.assertEqual(('BatchDeleteAttributes', {
+            'DomainName': 'simpledb_m',
+            'Item.0.ItemName': 'a',
+            'Item.0.Attribute.0.Name': 'name',
+        }), args)
+
+    def test_duplicate_names(self):
+        """ SimpleDB rejects batches naming the same item twice, so those
+        get split.
+        """
+        rows = [{'_id': 'a'}, {'_id': 'b'}, {'_id': 'a'}]
+        self.save_entities(self.connection, M, rows)
+        self.assertEqual(2, self.sdb.batch_put_attributes.call_count)
+
+    def test_shards(self):
+        """ Items are saved to the shard their name hashes to
+        """
+        from simpledb.utils import domain_for_item
+        self.connection.settings_dict = {'SHARDS': {'simpledb_m': 3}}
+        rows = [{'_id': str(i)} for i in range(30)]
+        r = self.save_entities(self.connection, M, rows)
+        self.assertEqual([str(i) for i in range(30)], r)
+        saved = []
+        for args, kwargs in self.sdb.batch_put_attributes.call_args_list:
+            domain, items, replace = args
+            for name in items:
+                self.assertEqual(domain_for_item('simpledb_m', name, 3),
+                    domain.name)
+            saved.extend(items)
+        self.assertEqual(sorted(r), sorted(saved))
+
+    def test_shards_failures(self):
+        """ Failed rows are reported by their index in the rows saved
+        """
+        from boto.exception import BotoServerError
+        from simpledb.compiler import BatchPutError
+        from simpledb.utils import domain_for_item
+        self.connection.settings_dict = {'SHARDS': {'simpledb_m': 3}}
+        error = BotoServerError(400, 'Bad Request')
+        self.sdb.batch_put_attributes.side_effect = error
+        def put(domain, item_name, attrs, replace, expected):
+            if item_name in ('1', '5'):
+                raise error
+        self.sdb.put_attributes.side_effect = put
+        try:
+            self.save_entities(self.connection, M,
+                [{'_id': str(i)} for i in range(6)])
+        except BatchPutError, e:
+            self.assertEqual({1: error, 5: error}, e.errors)
+        else:
+            self.fail('BatchPutError not raised')
+
+    def test_failures(self):
+        """ When a batch fails, its items are retried individually so the
+        failing rows can be reported.
+        """
+        from boto.exception import BotoServerError
+        from simpledb.compiler import BatchPutError
+        error = BotoServerError(400, 'Bad Request')
+        self.sdb.batch_put_attributes.side_effect = error
+        def put(domain, item_name, attrs, replace, expected):
+            if item_name == '1':
+                raise error
+        self.sdb.put_attributes.side_effect = put
+        rows = [{'_id': str(i)} for i in range(3)]
+        try:
+            self.save_entities(self.connection, M, rows)
+        except BatchPutError, e:
+            self.assertEqual(['0', '1', '2'], e.ids)
+            self.assertEqual({1: error}, e.errors)
+        else:
+            self.fail('BatchPutError not raised')
+        self.assertEqual(3, self.sdb.put_attributes.call_count)
+
+
+class UpdateEntitiesTests(unittest.TestCase):
+
+    def setUp(self):
+        from boto.sdb.db.manager.sdbmanager import SDBManager
+        self.manager = mock.Mock(spec=SDBManager)
+        self.manager.sdb = self.sdb = mock.Mock(name='sdb')
+        self.connection = mock.Mock()
+        self.connection.settings_dict = {}
+        self.connection.create_manager.return_value = self.manager
+
+    def update_entities(self, *args, **kwargs):
+        from simpledb.compiler import update_entities
+        return update_entities(self.connection, M, *args, **kwargs)
+
+    def test_batches(self):
+        """ Only the updated attributes are put, 25 items at a time, and
+        attributes set to None are deleted.
+        """
+        names = [str(i) for i in range(30)]
+        self.assertEqual(30, self.update_entities(names,
+            {'name': u'foo', 'other': None}))
+        sizes = []
+        for args, kwargs in self.sdb.batch_put_attributes.call_args_list:
+            domain, items, replace = args
+            self.assertTrue(replace)
+            self.assertEqual({'name': u'foo'}, items.values()[0])
+            sizes.append(len(items))
+        self.assertEqual([25, 5], sizes)
+        self.assertFalse(self.sdb.delete_attributes.called)
+        self.assertEqual(2, self.sdb.get_status.call_count)
+        args, kwargs = self.sdb.get_status.call_args
+        self.assertEqual('BatchDeleteAttributes', args[0])
+        self.assertEqual('other', args[1]['Item.4.Attribute.0.Name'])
+        self.assertFalse('Item.4.Attribute.0.Value' in args[1])
+        self.assertFalse('Item.5.ItemName' in args[1])
+        self.assertFalse(self.sdb.put_attributes.called)
+        self.connection.identity_map.invalidate.assert_called_with(
+            'simpledb_m')
+
+    def test_expected(self):
+        """ With an expected value, items are put one at a time, and those
+        that no longer match aren't counted.
+        """
+        from boto.exception import BotoServerError
+        error = BotoServerError(409, 'Conflict')
+        error.error_code = 'ConditionalCheckFailed'
+        def put(domain, item_name, attrs, replace, expected):
+            self.assertEqual(('name', u'bar'), expected)
+            if item_name == '1':
+                raise error
+        self.sdb.put_attributes.side_effect = put
+        self.assertEqual(2, self.update_entities(['0', '1', '2'],
+            {'name': u'foo'}, ('name', u'bar')))
+        self.assertEqual(3, self.sdb.put_attributes.call_count)
+        self.assertFalse(self.sdb.batch_put_attributes.called)
+
+    def test_errors(self):
+        from boto.exception import BotoServerError
+        self.sdb.put_attributes.side_effect = BotoServerError(500, 'Error')
+        self.assertRaises(BotoServerError, self.update_entities, ['0'],
+            {'name': u'foo'}, ('name', u'bar'))
+
+
+class ReencodeTests(unittest.TestCase):
+
+    def setUp(self):
+        from django.db import connection
+        from boto.sdb.db.manager.sdbmanager import SDBManager
+        self.manager = mock.Mock(spec=SDBManager)
+        self.manager.sdb = self.sdb = mock.Mock(name='sdb')
+        self.connection = connection
+        self.patch = mock.patch.object(connection, 'create_manager')
+        self.patch.start().return_value = self.manager
+
+    def tearDown(self):
+        self.patch.stop()
+
+    def item(self, name, attrs):
+        from boto.sdb.item import Item
+        item = Item(mock.Mock(), name)
+        item.update(attrs)
+        return item
+
+    def test_reencode(self):
+        """ Numbers stored before they were encoded get rewritten, and items
+        named after them renamed.
+        """
+        from boto.resultset import ResultSet
+        from simpledb.compiler import reencode
+        from simpledb.encoding import encode_long
+        old = self.item('12', {'_id': '12', 'fk_id': '3',
+            '__type__': 'simpledb_x'})
+        current = self.item(encode_long(13), {'_id': encode_long(13),
+            'fk_id': encode_long(3), '__type__': 'simpledb_x'})
+        partial = self.item(encode_long(14), {'_id': encode_long(14),
+            'fk_id': '4', '__type__': 'simpledb_x'})
+        rs = ResultSet()
+        rs.extend([old, current, partial])
+        self.sdb.select.return_value = rs
+        self.assertEqual(2, reencode(self.connection, X))
+        args, kwargs = self.sdb.batch_put_attributes.call_args
+        self.assertEqual({
+            encode_long(12): {'_id': encode_long(12), 'fk_id': encode_long(3),
+                '__type__': 'simpledb_x'},
+            encode_long(14): {'fk_id': encode_long(4)},
+        }, args[1])
+        args, kwargs = self.sdb.batch_delete_attributes.call_args
+        self.assertEqual({'12': None}, args[1])
+
+
+class ResultCacheTests(unittest.TestCase):
+
+    def check_cache(self, cache):
+        key = cache.key('d', 'select *')
+        self.assertEqual(None, cache.get(key))
+        cache.set(key, [{'_id': '1'}])
+        self.assertEqual([{'_id': '1'}], cache.get(cache.key('d', 'select *')))
+        # Writes to another domain don't matter
+        cache.invalidate('e')
+        self.assertEqual(key, cache.key('d', 'select *'))
+        cache.invalidate('d')
+        self.assertEqual(None, cache.get(cache.key('d', 'select *')))
+
+    def test_local(self):
+        from simpledb.cache import LocalResultCache
+        self.check_cache(LocalResultCache())
+
+    def test_django(self):
+        from simpledb.cache import DjangoResultCache
+        self.check_cache(DjangoResultCache('locmem://'))
+
+    def test_settings(self):
+        from simpledb.cache import LocalResultCache, result_cache
+        self.assertEqual(None, result_cache({}))
+        cache = result_cache({'RESULT_CACHE': 'local', 'RESULT_CACHE_TTL': 5,
+            'RESULT_CACHE_SIZE': 10})
+        self.assertTrue(isinstance(cache, LocalResultCache))
+        self.assertEqual(5, cache.ttl)
+        self.assertEqual(10, cache._cache.size)
+        cache = result_cache(
+            {'RESULT_CACHE': 'simpledb.cache.LocalResultCache'})
+        self.assertTrue(isinstance(cache, LocalResultCache))
+
+
+class IdentityMapTests(unittest.TestCase):
+
+    def test_request(self):
+        """ Entities are only kept during a request
+        """
+        from django.core.signals import request_finished, request_started
+        from simpledb.cache import IdentityMap
+        identity_map = IdentityMap()
+        identity_map.set('d', '1', {'_id': '1'})
+        self.assertEqual((False, None), identity_map.get('d', '1'))
+        request_started.send(sender=None)
+        try:
+            identity_map.set('d', '1', {'_id': '1'})
+            identity_map.set('d', '2', None)
+            identity_map.set('e', '1', {'_id': '1'})
+            self.assertEqual((True, {'_id': '1'}), identity_map.get('d', '1'))
+            self.assertEqual((True, None), identity_map.get('d', '2'))
+            identity_map.invalidate('d')
+            self.assertEqual((False, None), identity_map.get('d', '1'))
+            self.assertEqual((True, {'_id': '1'}), identity_map.get('e', '1'))
+        finally:
+            request_finished.send(sender=None)
+        self.assertEqual((False, None), identity_map.get('e', '1'))
+
+
+class RetryTests(unittest.TestCase):
+
+    def connection(self, statuses, **kwargs):
+        """ Return a RetryingSDBConnection whose requests get responses with
+        the given statuses in turn, and a select to send with it.
+        """
+        from simpledb.retry import RetryingSDBConnection, RetryPolicy
+        conn = RetryingSDBConnection(RetryPolicy(**kwargs), 'key', 'secret')
+        http = mock.Mock()
+        responses = []
+        for status in statuses:
+            response = mock.Mock()
+            response.status = status
+            response.read.return_value = ''
+            response.getheader.return_value = None
+            responses.append(response)
+        http.getresponse.side_effect = lambda: responses.pop(0)
+        conn.get_http_connection = mock.Mock(return_value=http)
+        conn.put_http_connection = mock.Mock()
+        expression = "select * from `d` where `x` = 'from `y`'"
+        request = conn.build_base_http_request('GET', '/', None,
+            {'Action': 'Select', 'SelectExpression': expression}, {}, '',
+            conn.server_name())
+        return conn, request
+
+    @mock.patch('simpledb.retry.time')
+    def test_retry(self, mock_time):
+        """ Failed requests are retried after a jittered backoff
+        """
+        mock_sleep = mock_time.sleep
+        conn, request = self.connection([503, 500, 200], base_delay=1,
+            rate_limit=None)
+        self.assertEqual(200, conn._mexe(request).status)
+        self.assertEqual(2, mock_sleep.call_count)
+        first, second = [args[0] for args, kwargs in mock_sleep.call_args_list]
+        self.assertTrue(0 <= first <= 1 and 0 <= second <= 2)
+
+    @mock.patch('simpledb.retry.time')
+    def test_throttled(self, mock_time):
+        """ Throttling slows requests to the domain down
+        """
+        mock_sleep = mock_time.sleep
+        mock_time.time.return_value = 0
+        def sleep(seconds):
+            mock_time.time.return_value += seconds
+        mock_sleep.side_effect = sleep
+        conn, request = self.connection([503, 200], base_delay=0,
+            rate_limit=100)
+        conn._mexe(request)
+        self.assertEqual(50.1, conn.policy.bucket('d').rate)
+        # Waiting for a token after the throttled request used the last one
+        self.assertEqual(1 / 50.0, mock_sleep.call_args[0][0])
+
+    @mock.patch('simpledb.retry.time')
+    def test_give_up(self, mock_time):
+        from boto.exception import BotoServerError
+        mock_sleep = mock_time.sleep
+        conn, request = self.connection([503] * 3, retries=2,
+            rate_limit=None)
+        try:
+            conn._mexe(request)
+        except BotoServerError, e:
+            self.assertEqual(503, e.status)
+        else:
+            self.fail('BotoServerError not raised')
+        self.assertEqual(2, mock_sleep.call_count)
+
+    @mock.patch('simpledb.retry.time')
+    def test_override_num_retries(self, mock_time):
+        from boto.exception import BotoServerError
+        mock_sleep = mock_time.sleep
+        conn, request = self.connection([503] * 2, rate_limit=None)
+        self.assertRaises(BotoServerError, conn._mexe, request,
+            override_num_retries=1)
+        self.assertEqual(1, mock_sleep.call_count)
+
+    def test_redirect(self):
+        """ Redirects are followed without counting as attempts
+        """
+        conn, request = self.connection([307, 200], retries=0,
+            rate_limit=None)
+        http = conn.get_http_connection.return_value
+        redirect = http.getresponse.side_effect()
+        redirect.getheader.return_value = 'https://elsewhere/path?x=1'
+        responses = [redirect, http.getresponse.side_effect()]
+        http.getresponse.side_effect = lambda: responses.pop(0)
+        self.assertEqual(200, conn._mexe(request).status)
+        self.assertEqual('elsewhere', request.host)
+        self.assertTrue(request.path.startswith('/path?'))
+        conn.get_http_connection.assert_called_with('elsewhere', True)
+
+    def test_request_domain(self):
+        """ Requests are rate limited by domain, which selects only name in
+        their expression
+        """
+        from simpledb.retry import request_domain
+        conn, request = self.connection([])
+        self.assertEqual('d', request_domain(request))
+        request.params['SelectExpression'] = 'select count(*) FROM `a``b`'
+        self.assertEqual('a`b', request_domain(request))
+        request = conn.build_base_http_request('GET', '/', None,
+            {'Action': 'GetAttributes', 'DomainName': 'e'}, {}, '',
+            conn.server_name())
+        self.assertEqual('e', request_domain(request))
+
+    @mock.patch('simpledb.retry.time')
+    def test_not_retried(self, mock_time):
+        mock_sleep = mock_time.sleep
+        conn, request = self.connection([400], rate_limit=None)
+        self.assertEqual(400, conn._mexe(request).status)
+        self.assertFalse(mock_sleep.called)
+
+    @mock.patch('simpledb.retry.time')
+    def test_token_bucket(self, mock_time):
+        """ Requests beyond the rate wait for tokens, and the rate adapts to
+        throttling
+        """
+        from simpledb.retry import TokenBucket
+        mock_sleep = mock_time.sleep
+        mock_time.time.return_value = 0
+        bucket = TokenBucket(2)
+        bucket.acquire()
+        bucket.acquire()
+        self.assertFalse(mock_sleep.called)
+        def sleep(seconds):
+            mock_time.time.return_value += seconds
+        mock_sleep.side_effect = sleep
+        bucket.acquire()
+        self.assertEqual(0.5, mock_sleep.call_args[0][0])
+        bucket.throttled()
+        bucket.throttled()
+        self.assertEqual(1, bucket.rate)
+        bucket.throttled()
+        self.assertEqual(1, bucket.rate)
+        for i in range(20):
+            bucket.succeeded()
+        self.assertEqual(2, bucket.rate)
+
+
+class ShardTests(unittest.TestCase):
+
+    def test_domain_for_item(self):
+        from simpledb.utils import domain_for_item, shard_domains
+        self.assertEqual('d', domain_for_item('d', 'x'))
+        self.assertEqual(['d'], shard_domains('d'))
+        domains = shard_domains('d', 4)
+        self.assertEqual(['d_0', 'd_1', 'd_2', 'd_3'], domains)
+        counts = dict([(domain, 0) for domain in domains])
+        for i in range(1000):
+            counts[domain_for_item('d', str(i), 4)] += 1
+        self.assertTrue(min(counts.values()) > 200, counts)
+        self.assertEqual(domain_for_item('d', u'x', 4),
+            domain_for_item('d', 'x', 4))
+
+    def test_group_by_domain(self):
+        from simpledb.utils import domain_for_item, group_by_domain
+        self.assertEqual([('d', ['1', '2'])], group_by_domain('d', ['1', '2']))
+        names = [str(i) for i in range(10)]
+        groups = group_by_domain('d', names, 2)
+        self.assertEqual(names, sorted(sum([g for d, g in groups], [])))
+        for domain, group in groups:
+            for name in group:
+                self.assertEqual(domain, domain_for_item('d', name, 2))
+
+
+class ManagerPoolTests(unittest.TestCase):
+
+    def pool(self, **kwargs):
+        from simpledb.pool import ManagerPool
+        self.factory = mock.Mock()
+        self.factory.side_effect = lambda domain_name: mock.Mock(
+            name=domain_name)
+        return ManagerPool(self.factory, **kwargs)
+
+    def test_reuse(self):
+        """ Asking for the same domain twice should hand back the same
+        manager, rather than creating a new connection.
+        """
+        pool = self.pool()
+        first = pool.get('a')
+        self.assertTrue(first is pool.get('a'))
+        self.assertFalse(first is pool.get('b'))
+        self.assertEqual({'hits': 1, 'misses': 2, 'reconnects': 0},
+            pool.stats())
+
+    def test_per_thread(self):
+        """ boto connections aren't thread safe, so each thread gets its
+        own manager.
+        """
+        import threading
+        pool = self.pool()
+        mine = pool.get('a')
+        theirs = []
+        t = threading.Thread(target=lambda: theirs.append(pool.get('a')))
+        t.start()
+        t.join()
+        self.assertFalse(mine is theirs[0])
+
+    def test_size(self):
+        """ The least recently used manager is evicted once the pool is full
+        """
+        pool = self.pool(size=2)
+        a = pool.get('a')
+        pool.get('b')
+        pool.get('a')
+        pool.get('c')
+        self.assertTrue(a is pool.get('a'))
+        self.assertEqual(3, pool.misses)
+        # 'b' was evicted to make room for 'c'
+        pool.get('b')
+        self.assertEqual(4, pool.misses)
+
+    @mock.patch('time.time')
+    def test_idle_eviction(self, mock_time):
+        """ Managers idle for longer than max_idle are replaced
+        """
+        pool = self.pool(max_idle=10)
+        mock_time.return_value = 100
+        first = pool.get('a')
+        mock_time.return_value = 111
+        self.assertFalse(first is pool.get('a'))
+        self.assertEqual(1, pool.reconnects)
+
+    @mock.patch('time.time')
+    def test_health_check(self, mock_time):
+        """ Managers failing their health check are replaced
+        """
+        pool = self.pool(check_interval=5)
+        pool.health_check = mock.Mock(return_value=False)
+        mock_time.return_value = 100
+        first = pool.get('a')
+        mock_time.return_value = 103
+        self.assertTrue(first is pool.get('a'))
+        mock_time.return_value = 110
+        self.assertFalse(first is pool.get('a'))
+        pool.health_check.assert_called_with(first)
+        self.assertEqual(1, pool.reconnects)
+
+    def test_invalidate(self):
+        pool = self.pool()
+        first = pool.get('a')
+        pool.invalidate('a')
+        self.assertFalse(first is pool.get('a'))
+        self.assertEqual(1, pool.reconnects)
+
+
+class LRUCacheTests(unittest.TestCase):
+
+    def test_size(self):
+        from simpledb.utils import LRUCache
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertEqual(1, cache.get('a'))
+        self.assertEqual(None, cache.get('b'))
+        self.assertEqual(3, cache.get('c'))
+
+    @mock.patch('time.time')
+    def test_ttl(self, mock_time):
+        from simpledb.utils import LRUCache
+        cache = LRUCache(ttl=10)
+        mock_time.return_value = 100
+        cache.set('a', 1)
+        mock_time.return_value = 110
+        self.assertEqual(1, cache.get('a'))
+        mock_time.return_value = 111
+        self.assertEqual(None, cache.get('a'))
+
+
+def join_threads(threads):
+    """ Wait for every thread started since threads were listed, so none
+    outlive the test that started them
+    """
+    import threading
+    for thread in threading.enumerate():
+        if thread not in threads:
+            thread.join(5)
+
+
+class ReadAheadTests(unittest.TestCase):
+
+    def setUp(self):
+        import threading
+        self.threads = threading.enumerate()
+
+    def tearDown(self):
+        join_threads(self.threads)
+
+    def test_order(self):
+        from simpledb.utils import read_ahead
+        self.assertEqual(range(10), list(read_ahead(iter(range(10)), 2)))
+
+    def test_bounded(self):
+        """ The producer never gets more than depth items ahead
+        """
+        import time
+        from simpledb.utils import read_ahead
+        produced = []
+        def source():
+            for i in range(10):
+                produced.append(i)
+                yield i
+        results = read_ahead(source(), 2)
+        results.next()
+        time.sleep(0.05)
+        # One consumed, two queued and one waiting to be queued
+        self.assertTrue(len(produced) <= 4)
+        results.close()
+
+    def test_errors(self):
+        """ Errors raised by the producer are re-raised in the consumer
+        """
+        from simpledb.utils import read_ahead
+        def source():
+            yield 1
+            raise ValueError
+        results = read_ahead(source(), 2)
+        self.assertEqual(1, results.next())
+        self.assertRaises(ValueError, results.next)
+        results.close()
+
+
+class EncodingTests(unittest.TestCase):
+
+    def tearDown(self):
+        from simpledb.encoding import set_date_cache_size
+        set_date_cache_size(0)
+
+    def test_round_trip(self):
+        """ The fast codec agrees with strftime and strptime
+        """
+        from simpledb.encoding import DATETIME_ISO8601, DATE_ISO8601, \
+            format_date, format_datetime, parse_date, parse_datetime
+        for dt in [datetime.datetime(2008, 6, 10, 14, 2, 36, 250000),
+                   datetime.datetime(2011, 12, 31, 23, 59, 59, 999999),
+                   datetime.datetime(2011, 1, 1),
+                   datetime.datetime(1999, 1, 1, 0, 0, 0, 1)]:
+            encoded = format_datetime(dt)
+            self.assertEqual(dt.strftime(DATETIME_ISO8601), encoded)
+            self.assertEqual(dt, parse_datetime(encoded))
+            self.assertEqual(
+                datetime.datetime.strptime(encoded, DATETIME_ISO8601),
+                parse_datetime(encoded))
+            encoded = format_date(dt.date())
+            self.assertEqual(dt.strftime(DATE_ISO8601), encoded)
+            self.assertEqual(dt.date(), parse_date(encoded))
+
+    def test_fraction(self):
+        from simpledb.encoding import parse_datetime
+        self.assertEqual(500000,
+            parse_datetime('2008-06-10T14:02:36.5').microsecond)
+        self.assertEqual(123,
+            parse_datetime('2008-06-10T14:02:36.000123').microsecond)
+
+    def test_invalid(self):
+        from simpledb.encoding import parse_date, parse_datetime
+        for value in ['2008-06-10', '2008-06-10 14:02:36.25',
+                      '2008-06-10T14:02:36', '2008-06-10T14:02:36.1234567',
+                      '2008-06-10T14:02:36.x']:
+            self.assertRaises(ValueError, parse_datetime, value)
+        for value in ['2008-6-10', '2008/06/10', '2008-13-10']:
+            self.assertRaises(ValueError, parse_date, value)
+
+    def test_cache(self):
+        from simpledb import encoding
+        encoding.set_date_cache_size(10)
+        first = encoding.decode_datetime('2008-06-10T14:02:36.25')
+        self.assertTrue(
+            first is encoding.decode_datetime('2008-06-10T14:02:36.25'))
+        self.assertEqual(datetime.date(2008, 6, 10),
+            encoding.decode_date('2008-06-10'))
+        for i in range(10):
+            encoding.decode_date('2008-06-%02d' % (i + 1))
+        self.assertTrue(len(encoding._date_cache) <= 10)
+        encoding.set_date_cache_size(0)
+        self.assertFalse(
+            first is encoding.decode_datetime('2008-06-10T14:02:36.25'))
+
+    def test_cache_settings(self):
+        """ Only databases with DATE_CACHE_SIZE configure the cache, and
+        opening another connection keeps what's cached
+        """
+        from simpledb import encoding
+        from simpledb.base import DatabaseWrapper
+        settings = {'AWS_ACCESS_KEY_ID': 'key',
+            'AWS_SECRET_ACCESS_KEY': 'secret', 'DATE_CACHE_SIZE': 10}
+        DatabaseWrapper(dict(settings), 'a')
+        first = encoding.decode_datetime('2008-06-10T14:02:36.25')
+        DatabaseWrapper(dict(settings), 'a')
+        del settings['DATE_CACHE_SIZE']
+        DatabaseWrapper(settings, 'b')
+        self.assertTrue(
+            first is encoding.decode_datetime('2008-06-10T14:02:36.25'))
+
 
 class ConnectionTests(unittest.TestCase):
 
@@ -140,6 +893,7 @@ class ConnectionTests(unittest.TestCase):
         meta = mock.Mock()
         self.query.get_meta.return_value = meta
         meta.pk.column = 'id_col'
+        meta.pk.db_type.return_value = 'unicode'
         self.connection = mock.Mock()
 
 
@@ -182,6 +936,35 @@ class InsertConnectionTests(ConnectionTests):
             '_id': 'fizz'
         }, data)
 
+    @mock.patch('simpledb.compiler.save_entity')
+    def test_insert_compiler_decodes_id(self, mock_save):
+        """ Generated item names are encoded longs, but the pk handed back
+        to Django is a number.
+        """
+        from simpledb.encoding import encode_long
+        self.query.get_meta().pk.db_type.return_value = 'long'
+        mock_save.return_value = encode_long(1234)
+        self.assertEqual(1234, self.compiler().insert({'name': 'foo'}))
+
+    @mock.patch('simpledb.compiler.save_entities')
+    def test_insert_many(self, mock_save):
+        """ insert_many hands every row to save_entities at once, with the
+        pk column renamed to _id.
+        """
+        mock_save.return_value = ['fizz', 'new']
+        pks = self.compiler().insert_many([
+            {'name': 'foo', 'id_col': 'fizz'},
+            {'name': 'bar'},
+        ])
+        self.assertEqual(['fizz', 'new'], pks)
+        args, kwargs = mock_save.call_args
+        conn, m, rows = args
+        self.assertEqual(self.model, m)
+        self.assertEqual([
+            {'name': 'foo', '_id': 'fizz'},
+            {'name': 'bar'},
+        ], rows)
+
 
 class SQLConnectionTests(ConnectionTests):
 
@@ -227,11 +1010,59 @@ class SQLConnectionTests(ConnectionTests):
 
     def test_convert_long_to_db(self):
         actual = self.compiler().convert_value_for_db('long', 1L)
-        self.assertEqual('1', actual)
+        self.assertEqual('1' + '0' * 38 + '1', actual)
+        self.assertEqual(None,
+            self.compiler().convert_value_for_db('long', None))
 
     def test_convert_long_from_db(self):
+        actual = self.compiler().convert_value_from_db('long',
+            '1' + '0' * 38 + '1')
+        self.assertEqual(1L, actual)
+        actual = self.compiler().convert_value_from_db('long',
+            '0' + '9' * 39)
+        self.assertEqual(-1L, actual)
+        # Values stored before numbers were encoded
         actual = self.compiler().convert_value_from_db('long', '1')
         self.assertEqual(1L, actual)
+        actual = self.compiler().convert_value_from_db('long', '-12')
+        self.assertEqual(-12L, actual)
+
+    def test_numbers_sort(self):
+        """ Encoded numbers sort as strings in numeric order
+        """
+        compiler = self.compiler()
+        for db_type, values in [
+                ('long', [-2 ** 63, -10, -9, -1, 0, 1, 9, 10, 2 ** 128]),
+                ('int', [-2 ** 31, -10, -1, 0, 2, 10, 2 ** 31]),
+                ('decimal:5,2', ['-999.99', '-1.5', '0', '0.01', '1.10',
+                    '10.00', '999.99'])]:
+            encoded = [compiler.convert_value_for_db(db_type, v)
+                for v in values]
+            self.assertEqual(encoded, sorted(encoded))
+            self.assertEqual(1, len(set(len(e) for e in encoded)))
+
+    def test_convert_int(self):
+        compiler = self.compiler()
+        encoded = compiler.convert_value_for_db('int', -5)
+        self.assertEqual('09999999995', encoded)
+        self.assertEqual(-5, compiler.convert_value_from_db('int', encoded))
+        self.assertEqual(12, compiler.convert_value_from_db('int', '12'))
+        self.assertRaises(ValueError, compiler.convert_value_for_db, 'int',
+            -10 ** 10 - 1)
+
+    def test_convert_decimal(self):
+        from decimal import Decimal
+        compiler = self.compiler()
+        encoded = compiler.convert_value_for_db('decimal:5,2', '12.50')
+        self.assertEqual('101250', encoded)
+        self.assertEqual(Decimal('12.50'),
+            compiler.convert_value_from_db('decimal:5,2', encoded))
+        self.assertEqual(Decimal('-0.01'), compiler.convert_value_from_db(
+            'decimal:5,2', compiler.convert_value_for_db('decimal:5,2',
+                Decimal('-0.01'))))
+        # Values stored before decimals were encoded
+        self.assertEqual(Decimal('12.50'),
+            compiler.convert_value_from_db('decimal:5,2', '12.50'))
 
     def test_convert_bool_to_db(self):
         actual = self.compiler().convert_value_for_db('bool', True)
@@ -245,6 +1076,48 @@ class SQLConnectionTests(ConnectionTests):
         actual = self.compiler().convert_value_from_db('bool', '0')
         self.assertFalse(actual)
 
+    def test_convert_list_from_db(self):
+        """ List values are converted item by item, using the sub type
+        """
+        actual = self.compiler().convert_value_from_db('ListField:long',
+            ['1' + '0' * 38 + '1', '2'])
+        self.assertEqual([1L, 2L], actual)
+        # Empty lists and non-list values fall back to string handling
+        self.assertEqual([], self.compiler().convert_value_from_db(
+            'ListField:long', []))
+
+    def test_convert_list_to_db(self):
+        actual = self.compiler().convert_value_for_db('ListField:bool',
+            [True, False])
+        self.assertEqual([u'1', u'0'], actual)
+
+    def test_convert_str(self):
+        """ Strings come back as unicode, whatever the type
+        """
+        actual = self.compiler().convert_value_from_db('unicode', 'caf\xc3\xa9')
+        self.assertEqual(u'caf\xe9', actual)
+        actual = self.compiler().convert_value_for_db('unicode', 'caf\xc3\xa9')
+        self.assertEqual(u'caf\xe9', actual)
+
+    def test_converters_cached(self):
+        """ Converters are built once per db_type
+        """
+        from simpledb.compiler import for_db_converter, from_db_converter
+        self.assertTrue(from_db_converter('ListField:date') is
+            from_db_converter('ListField:date'))
+        self.assertTrue(for_db_converter('ListField:date') is
+            for_db_converter('ListField:date'))
+
+    def test_make_result(self):
+        """ Entities are turned into rows with each field's converter, and
+        defaults for missing columns.
+        """
+        from django.db import connection
+        self.connection = connection
+        row = self.compiler()._make_result({'id': '5'}, M._meta.fields)
+        self.assertEqual([5L, 'hi'], row)
+
+
 class SimpleDBQueryTests(unittest.TestCase):
 
     def query(self):
@@ -263,43 +1136,666 @@ class SimpleDBQueryTests(unittest.TestCase):
         self.assertEqual('-foo', query.sort_by)
 
     def test_ordering_reset(self):
+        """ Ordering on a column again has no effect
+        """
         query = self.query()
         query.add_ordering('foo', 'DESC')
+        query.add_ordering('foo', 'ASC')
+        self.assertEqual('-foo', query.sort_by)
+        self.assertEqual([], query.then_by)
 
-        # Change ordering isn't implemented
-        self.assertRaises(
-            NotImplementedError,
-            query.add_ordering,
-            'foo',
-            'ASC'
-        )
-
-        # Not changing, should be OK
+    def test_ordering_then_by(self):
+        """ SimpleDB sorts on the first column, the rest are kept for sorting
+        here.
+        """
+        query = self.query()
         query.add_ordering('foo', 'DESC')
+        query.add_ordering('bar', 'ASC')
+        query.add_ordering('baz', 'DESC')
+        query.add_ordering('bar', 'DESC')
+        self.assertEqual('-foo', query.sort_by)
+        self.assertEqual([('bar', False), ('baz', True)], query.then_by)
 
-        # Change order field also not allowed
-        self.assertRaises(
-            NotImplementedError,
-            query.add_ordering,
-            'bar',
-            'DESC'
-        )
+    def test_sort_ties(self):
+        query = self.query()
+        query.add_ordering('a', 'ASC')
+        query.add_ordering('b', 'DESC')
+        entities = [{'_id': '1', 'a': '1', 'b': '1'},
+                    {'_id': '2', 'a': '1', 'b': '2'},
+                    {'_id': '3', 'a': '2', 'b': '1'},
+                    {'_id': '4', 'a': '2', 'b': '3'},
+                    {'_id': '5', 'a': '3', 'b': '1'},
+                    {'_id': '6', 'a': '3', 'b': '2'}]
+        self.assertEqual(['2', '1', '4', '3', '6', '5'],
+            [e['_id'] for e in query.sort_ties(iter(entities))])
+        # With a limit, reading stops at the start of the next run
+        results = iter(entities)
+        self.assertEqual(['2', '1', '4'],
+            [e['_id'] for e in query.sort_ties(results, 3)])
+        self.assertEqual('6', results.next()['_id'])
 
-    @mock.patch('simpledb.query.SimpleDBQuery.fetch_infinite')
+    def test_fetch_range_then_by(self):
+        """ Secondary orderings are applied before the offset and limit
+        """
+        query = self.query()
+        query.manager._build_filter_part.return_value = 'WHERE x'
+        query.add_ordering('a', 'ASC')
+        query.add_ordering('b', 'DESC')
+        rs = self.result_set(['1', '2', '3'])
+        for item, (a, b) in zip(rs, [('1', '1'), ('1', '2'), ('2', '1')]):
+            item['a'], item['b'] = a, b
+        query.manager.sdb.select.return_value = rs
+        self.assertEqual(['1', '3'],
+            [e['_id'] for e in query.fetch_range(2, 1)])
+        args, kwargs = query.manager.sdb.select.call_args
+        self.assertTrue(args[1].endswith(' limit 2500'))
+
+    @mock.patch('simpledb.query.SimpleDBQuery.item_names')
     @mock.patch('boto.sdb.domain.Domain.batch_delete_attributes')
-    def test_delete(self, mock_boto_delete, mock_fetch):
-        """ Delete should fetch all items in the current query, and end up
-        calling boto's Domain.batch_delete_attributes with a dict - all item
-        names as keys, and None as values. This will cause SimpleDB to delete
-        the item completely.
-        """
-        fake_results = [{'_id': 1}, {'_id': 2}]
-        mock_fetch.return_value = iter(fake_results)
+    def test_delete(self, mock_boto_delete, mock_names):
+        """ Delete should stream the names of all items in the current query,
+        and end up calling boto's Domain.batch_delete_attributes with a dict -
+        all item names as keys, and None as values. This will cause SimpleDB
+        to delete the item completely.
+        """
+        mock_names.return_value = iter([1, 2])
         query = self.query()
         query.delete()
-        mock_fetch.assert_called_with(0)
+        mock_names.assert_called_with()
         mock_boto_delete.assert_called_with({1: None, 2: None})
 
+    @mock.patch('simpledb.query.SimpleDBQuery.item_names')
+    @mock.patch('boto.sdb.domain.Domain.batch_delete_attributes')
+    def test_delete_batches(self, mock_boto_delete, mock_names):
+        """ SimpleDB deletes at most 25 items per request
+        """
+        mock_names.return_value = iter(range(60))
+        self.query().delete()
+        sizes = [len(args[0])
+            for args, kwargs in mock_boto_delete.call_args_list]
+        self.assertEqual([25, 25, 10], sizes)
+
+    @mock.patch('simpledb.query.SimpleDBQuery.item_names')
+    def test_delete_concurrent(self, mock_names):
+        """ With a manager factory, batches are deleted on worker threads,
+        each using its own manager.
+        """
+        import threading
+        from simpledb.query import SimpleDBQuery
+        mock_names.return_value = iter(range(100))
+        managers = {}
+        deleted = []
+        shared = threading.Event()
+        def delete(domain, items):
+            # Batches wait for a second worker to start, so one thread can't
+            # take every batch
+            if len(managers) > 1:
+                shared.set()
+            shared.wait(5)
+            deleted.extend(items)
+        def factory(domain_name):
+            thread = threading.currentThread()
+            if thread not in managers:
+                managers[thread] = mock.Mock()
+                managers[thread].sdb.batch_delete_attributes.side_effect = \
+                    delete
+            return managers[thread]
+        query = SimpleDBQuery(mock.Mock(), M, manager_factory=factory,
+            workers=3)
+        query.delete()
+        self.assertEqual(range(100), sorted(deleted))
+        self.assertTrue(len(managers) > 1)
+
+    def result_set(self, names, next_token=None):
+        from boto.resultset import ResultSet
+        from boto.sdb.item import Item
+        rs = ResultSet()
+        for name in names:
+            rs.append(Item(mock.Mock(), name))
+        rs.next_token = next_token
+        return rs
+
+    def test_item_names(self):
+        """ item_names selects only itemName(), following NextTokens until
+        there are no more pages.
+        """
+        query = self.query()
+        pages = [self.result_set(['a'], 'token'), self.result_set(['b'])]
+        query.manager.sdb.select.side_effect = lambda *args, **kwargs: \
+            pages.pop(0)
+        query.manager._build_filter_part.return_value = 'WHERE x'
+        self.assertEqual(['a', 'b'], list(query.item_names()))
+        calls = query.manager.sdb.select.call_args_list
+        self.assertEqual('select itemName() from `simpledb_m` WHERE x',
+            calls[0][0][1])
+        self.assertEqual(None, calls[0][1]['next_token'])
+        self.assertEqual('token', calls[1][1]['next_token'])
+
+    def paged_query(self, *pages):
+        """ Return a query whose select requests return the given pages of
+        item names in turn, each page but the last having a NextToken.
+        """
+        query = self.query()
+        pages = list(pages)
+        def select(domain, expression, next_token=None):
+            names = pages.pop(0)
+            token = pages and 'token%s' % len(pages) or None
+            return self.result_set(names, token)
+        query.manager.sdb.select.side_effect = select
+        query.manager._build_filter_part.return_value = 'WHERE x'
+        return query
+
+    def test_iterate(self):
+        """ iterate() follows NextTokens, converting items to entity dicts
+        """
+        query = self.paged_query(['1', '2'], ['3'])
+        self.assertEqual([{'_id': '1'}, {'_id': '2'}, {'_id': '3'}],
+            list(query.iterate()))
+        calls = query.manager.sdb.select.call_args_list
+        self.assertEqual('select * from `simpledb_m` WHERE x limit 2500',
+            calls[0][0][1])
+        self.assertEqual('token1', calls[1][1]['next_token'])
+
+    def test_iterate_lazy(self):
+        """ Pages are only requested as they're needed
+        """
+        query = self.paged_query(['1', '2'], ['3'])
+        results = query.iterate()
+        results.next()
+        results.next()
+        self.assertEqual(1, query.manager.sdb.select.call_count)
+
+    def test_iterate_limit(self):
+        """ No more pages are requested once the limit is reached, and the
+        last page only asks for as many items as are still needed.
+        """
+        query = self.paged_query(['%s' % i for i in range(2500)],
+            ['a', 'b'], ['c'])
+        results = list(query.iterate(2502))
+        self.assertEqual(2502, len(results))
+        calls = query.manager.sdb.select.call_args_list
+        self.assertEqual(2, len(calls))
+        self.assertTrue(calls[1][0][1].endswith(' limit 2'))
+
+    def count_set(self, count, next_token=None):
+        rs = self.result_set(['Domain'], next_token)
+        rs[0]['Count'] = str(count)
+        return rs
+
+    def test_fetch_range(self):
+        """ Offsets are skipped by counting, which returns a NextToken for
+        the offset without fetching any attributes.
+        """
+        query = self.query()
+        query.manager._build_filter_part.return_value = 'WHERE x'
+        pages = [self.count_set(1, 'skipped'), self.result_set(['2', '3'])]
+        query.manager.sdb.select.side_effect = lambda *args, **kwargs: \
+            pages.pop(0)
+        self.assertEqual([{'_id': '2'}, {'_id': '3'}],
+            list(query.fetch_range(2, 1)))
+        calls = query.manager.sdb.select.call_args_list
+        self.assertEqual('select count(*) from `simpledb_m` WHERE x limit 1',
+            calls[0][0][1])
+        self.assertEqual('select * from `simpledb_m` WHERE x limit 2',
+            calls[1][0][1])
+        self.assertEqual('skipped', calls[1][1]['next_token'])
+
+    def test_skip_partial_counts(self):
+        """ SimpleDB can return partial counts, so skipping carries on until
+        the whole offset has been counted.
+        """
+        query = self.query()
+        pages = [self.count_set(2000, 'a'), self.count_set(900, 'b'),
+            self.count_set(100, 'c')]
+        query.manager.sdb.select.side_effect = lambda *args, **kwargs: \
+            pages.pop(0)
+        self.assertEqual('c', query.skip(3000))
+        calls = query.manager.sdb.select.call_args_list
+        self.assertTrue(calls[0][0][1].endswith(' limit 2500'))
+        self.assertTrue(calls[1][0][1].endswith(' limit 1000'))
+        self.assertTrue(calls[2][0][1].endswith(' limit 100'))
+
+    def test_skip_past_end(self):
+        """ If there are fewer items than the offset, there's nothing to
+        fetch.
+        """
+        query = self.query()
+        query.manager.sdb.select.return_value = self.count_set(3)
+        self.assertEqual(None, query.skip(10))
+        self.assertEqual([], list(query.fetch_range(5, 10)))
+
+    def test_skip_cache(self):
+        """ Tokens found while skipping are cached per query, so later pages
+        start from the nearest known offset.
+        """
+        from simpledb.cache import LocalResultCache
+        query = self.query()
+        query.offset_cache = LocalResultCache()
+        query.manager.sdb.select.return_value = self.count_set(50, 'fifty')
+        self.assertEqual('fifty', query.skip(50))
+        query.manager.sdb.select.return_value = self.count_set(50, 'hundred')
+        self.assertEqual('hundred', query.skip(100))
+        args, kwargs = query.manager.sdb.select.call_args
+        self.assertEqual('fifty', kwargs['next_token'])
+        self.assertTrue(args[1].endswith(' limit 50'))
+        # Skipping to a known offset needs no requests at all
+        query.manager.sdb.select.reset_mock()
+        self.assertEqual('fifty', query.skip(50))
+        self.assertFalse(query.manager.sdb.select.called)
+
+    def test_count(self):
+        """ Partial counts are summed across NextTokens
+        """
+        query = self.query()
+        query.manager._build_filter_part.return_value = 'WHERE x'
+        pages = [self.count_set(1000, 'more'), self.count_set(234)]
+        query.manager.sdb.select.side_effect = lambda *args, **kwargs: \
+            pages.pop(0)
+        self.assertEqual(1234, query.count())
+        calls = query.manager.sdb.select.call_args_list
+        self.assertEqual(
+            'select count(*) from `simpledb_m` WHERE x limit 2500',
+            calls[0][0][1])
+        self.assertEqual('more', calls[1][1]['next_token'])
+
+    def test_count_limit(self):
+        """ Counting stops at the limit, asking for no more than is left
+        """
+        query = self.query()
+        pages = [self.count_set(30, 'more'), self.count_set(20, 'more')]
+        query.manager.sdb.select.side_effect = lambda *args, **kwargs: \
+            pages.pop(0)
+        self.assertEqual(50, query.count(50))
+        calls = query.manager.sdb.select.call_args_list
+        self.assertEqual(2, len(calls))
+        self.assertTrue(calls[1][0][1].endswith(' limit 20'))
+
+    def test_count_cache(self):
+        from simpledb.utils import LRUCache
+        query = self.query()
+        query.count_cache = LRUCache(ttl=10)
+        query.manager.sdb.select.return_value = self.count_set(5)
+        self.assertEqual(5, query.count())
+        self.assertEqual(5, query.count())
+        self.assertEqual(1, query.manager.sdb.select.call_count)
+        # Different limits are counted separately
+        self.assertEqual(1, query.count(1))
+        self.assertEqual(2, query.manager.sdb.select.call_count)
+
+    def split_query(self, items):
+        """ Return a query split on two in predicates, whose selects return
+        the items (name, value) with a value in their in list.
+        """
+        import re
+        query = self.query()
+        query.manager._build_filter_part.side_effect = \
+            lambda cls, filters, order_by, select: 'WHERE %s' % select
+        def select(domain, expression, next_token=None):
+            values = re.findall(r"'(\w+)'",
+                re.search(r"in \((.*)\)", expression).group(1))
+            rs = self.result_set([name for name, value in items
+                if value in values])
+            if expression.startswith('select count(*)'):
+                return self.count_set(len(rs))
+            return rs
+        query.manager.sdb.select.side_effect = select
+        query.add_split(["`name` in ('a', 'b')", "`name` in ('c')"])
+        return query
+
+    def sharded_query(self, names):
+        """ Return a query over two shards, whose selects return the given
+        item names that hash to the shard selected from, in order.
+        """
+        from simpledb.utils import domain_for_item
+        query = self.query()
+        query.shards = 2
+        def select(domain, expression, next_token=None):
+            self.assertTrue(' from `%s` ' % domain.name in expression)
+            rs = self.result_set([name for name in names
+                if domain_for_item('simpledb_m', name, 2) == domain.name])
+            if expression.startswith('select count(*)'):
+                return self.count_set(len(rs))
+            return rs
+        query.manager.sdb.select.side_effect = select
+        return query
+
+    def test_sharded_fetch(self):
+        """ Sharded queries select from every shard, and merge the results
+        """
+        from simpledb.utils import domain_for_item
+        names = [str(i) for i in range(10)]
+        self.assertEqual(2, len(set([domain_for_item('simpledb_m', name, 2)
+            for name in names])))
+        query = self.sharded_query(names)
+        query.sort_by = '_id'
+        self.assertEqual(names, [e['_id'] for e in query.fetch_range(None, 0)])
+        self.assertEqual(names[3:5],
+            [e['_id'] for e in query.fetch_range(2, 3)])
+        self.assertEqual(10, query.count())
+        self.assertEqual(4, query.count(4))
+        self.assertEqual(names, sorted(query.item_names()))
+
+    def test_sharded_delete(self):
+        """ Items are deleted from the shard they were selected from
+        """
+        from simpledb.utils import domain_for_item
+        query = self.sharded_query([str(i) for i in range(10)])
+        query.delete()
+        calls = query.manager.sdb.batch_delete_attributes.call_args_list
+        self.assertEqual(2, len(calls))
+        for args, kwargs in calls:
+            domain, items = args
+            for name in items:
+                self.assertEqual(domain.name,
+                    domain_for_item('simpledb_m', name, 2))
+
+    def test_sharded_keys(self):
+        """ Items are got from the shard their name hashes to
+        """
+        from simpledb.utils import domain_for_item
+        query = self.query()
+        query.shards = 4
+        query.keys = [str(i) for i in range(10)]
+        query.manager.sdb.get_attributes.return_value = {}
+        query.count()
+        for args, kwargs in query.manager.sdb.get_attributes.call_args_list:
+            domain, name = args[:2]
+            self.assertEqual(domain_for_item('simpledb_m', name, 4),
+                domain.name)
+
+    def test_split_fetch(self):
+        """ Split queries run a select per alternative, and return each item
+        once.
+        """
+        query = self.split_query([('1', 'a'), ('2', 'c'), ('3', 'b'),
+            ('1', 'c')])
+        self.assertEqual(['1', '3', '2'],
+            [e['_id'] for e in query.fetch_range(None, 0)])
+        self.assertEqual(['3'], [e['_id'] for e in query.fetch_range(1, 1)])
+
+    def test_split_ordered(self):
+        query = self.split_query([('1', 'a'), ('3', 'b'), ('2', 'c')])
+        query.sort_by = '_id'
+        self.assertEqual(['1', '2', '3'],
+            [e['_id'] for e in query.fetch_range(None, 0)])
+
+    def test_split_count(self):
+        query = self.split_query([('1', 'a'), ('2', 'c'), ('3', 'b')])
+        self.assertEqual(3, query.count())
+        self.assertEqual(2, query.count(2))
+
+    def test_result_cache(self):
+        """ Fetched results are cached until the domain is written to
+        """
+        from simpledb.cache import LocalResultCache
+        query = self.paged_query(['1', '2'], ['3'])
+        query.result_cache = LocalResultCache()
+        self.assertEqual(['1', '2', '3'],
+            [e['_id'] for e in query.fetch_range(None, 0)])
+        self.assertEqual(2, query.manager.sdb.select.call_count)
+        entities = list(query.fetch_range(None, 0))
+        self.assertEqual(['1', '2', '3'], [e['_id'] for e in entities])
+        self.assertEqual(2, query.manager.sdb.select.call_count)
+        # Callers get copies they can change
+        entities[0]['_id'] = 'x'
+        self.assertEqual('1', query.fetch_range(None, 0).next()['_id'])
+        query.result_cache.invalidate('simpledb_m')
+        query.manager.sdb.select.side_effect = None
+        query.manager.sdb.select.return_value = self.result_set(['4'])
+        self.assertEqual(['4'], [e['_id'] for e in query.fetch_range(None, 0)])
+
+    def test_result_cache_max_rows(self):
+        from simpledb.cache import LocalResultCache
+        query = self.paged_query(['1', '2'], ['3'])
+        query.result_cache = LocalResultCache(max_rows=2)
+        list(query.fetch_range(None, 0))
+        query.manager.sdb.select.side_effect = None
+        query.manager.sdb.select.return_value = self.result_set(['4'])
+        self.assertEqual(['4'], [e['_id'] for e in query.fetch_range(None, 0)])
+
+    @mock.patch('simpledb.query.SimpleDBQuery.item_names')
+    def test_delete_invalidates(self, mock_names):
+        mock_names.return_value = iter(['1'])
+        query = self.query()
+        query.result_cache = mock.Mock()
+        query.delete()
+        query.result_cache.invalidate.assert_called_with('simpledb_m')
+
+    def test_iterate_read_ahead(self):
+        """ With read-ahead, pages are requested on a background thread with
+        its own manager, ahead of the consumer.
+        """
+        import threading
+        running = threading.enumerate()
+        query = self.paged_query(['1', '2'], ['3'], ['4'])
+        threads = []
+        def factory(domain_name):
+            threads.append(threading.currentThread())
+            return query.manager
+        query.manager_factory = factory
+        query.read_ahead = 2
+        results = query.iterate()
+        self.assertEqual({'_id': '1'}, results.next())
+        self.assertEqual(['2', '3', '4'], [e['_id'] for e in results])
+        results.close()
+        join_threads(running)
+        self.assertFalse(threading.currentThread() in threads)
+
+    def scan_query(self, names):
+        """ Return a query over the given item names, answering each select
+        with the names in the requested itemName() range, in order.
+        """
+        import re
+        query = self.query()
+        query.manager._build_filter_part.side_effect = \
+            lambda cls, filters, order_by, select: 'WHERE %s' % select
+        def select(domain, expression, next_token=None):
+            lower = re.search(r"itemName\(\) >= '(\w*)'", expression)
+            upper = re.search(r"itemName\(\) < '(\w*)'", expression)
+            return self.result_set(sorted([n for n in names
+                if n >= lower.group(1) and
+                    (upper is None or n < upper.group(1))]))
+        query.manager.sdb.select.side_effect = select
+        query.manager_factory = lambda domain_name: query.manager
+        query.workers = 3
+        return query
+
+    def test_parallel_scan(self):
+        """ Each itemName() range is scanned separately, and every item is
+        returned exactly once.
+        """
+        import threading
+        running = threading.enumerate()
+        names = ['%02d' % i for i in range(100)]
+        query = self.scan_query(names)
+        scan = query.parallel_scan(points=['25', '50'])
+        results = [e['_id'] for e in scan]
+        scan.close()
+        join_threads(running)
+        self.assertEqual(names, sorted(results))
+        expressions = sorted(args[1] for args, kwargs in
+            query.manager.sdb.select.call_args_list)
+        self.assertEqual([
+            "select * from `simpledb_m` WHERE itemName() >= '' and "
+                "itemName() < '25' limit 2500",
+            "select * from `simpledb_m` WHERE itemName() >= '25' and "
+                "itemName() < '50' limit 2500",
+            "select * from `simpledb_m` WHERE itemName() >= '50' "
+                "limit 2500",
+        ], expressions)
+
+    def test_parallel_scan_ordered(self):
+        """ Ordered scans sort each range by item name, and merge them
+        """
+        names = ['%02d' % i for i in range(100)]
+        query = self.scan_query(names)
+        results = [e['_id'] for e in
+            query.parallel_scan(segments=4, ordered=True)]
+        self.assertEqual(names, results)
+        args, kwargs = query.manager.sdb.select.call_args
+        self.assertTrue(args[1].endswith(' order by itemName() limit 2500'))
+
+    def test_uuid_split_points(self):
+        """ The default split points divide generated ids evenly
+        """
+        import uuid
+        from simpledb.encoding import encode_long
+        from simpledb.utils import uuid_split_points
+        points = uuid_split_points(4)
+        self.assertEqual(3, len(points))
+        counts = [0] * 4
+        for i in range(2000):
+            name = encode_long(uuid.uuid4().int)
+            counts[len([p for p in points if p <= name])] += 1
+        self.assertTrue(min(counts) > 300, counts)
+
+    def test_entity(self):
+        """ Only attributes for the model's columns make it into entities
+        """
+        from boto.sdb.item import Item
+        item = Item(mock.Mock(), '1')
+        item.update({'name': 'foo', '__type__': 'simpledb_m', '_id': '1'})
+        self.assertEqual({'_id': '1', 'name': 'foo'},
+            self.query().entity(item))
+
+    def test_projection(self):
+        """ Only the requested columns are selected, or just item names if
+        only the pk is wanted.
+        """
+        from simpledb.query import SimpleDBQuery
+        query = SimpleDBQuery(mock.Mock(), M, columns=['id', 'name'])
+        self.assertEqual('*', query.output())
+        query = SimpleDBQuery(mock.Mock(), M, columns=['id'])
+        self.assertEqual('itemName()', query.output())
+        # The sort column is fetched too, for merging ordered results
+        query = SimpleDBQuery(mock.Mock(), X, columns=[])
+        query.add_ordering('fk_id', 'ASC')
+        self.assertEqual('`fk_id`, `__type__`', query.output())
+
+    def test_quoted_names(self):
+        """ Backquotes in attribute names are escaped
+        """
+        from simpledb.query import SimpleDBQuery
+        query = SimpleDBQuery(mock.Mock(), X, columns=[])
+        query.add_ordering('a`b', 'DESC')
+        self.assertEqual('`a``b`, `__type__`', query.output())
+        query.select_expression()
+        self.assertEqual('-a``b',
+            query.manager._build_filter_part.call_args[0][2])
+
+    def test_projected_entity(self):
+        from boto.sdb.item import Item
+        from simpledb.query import SimpleDBQuery
+        query = SimpleDBQuery(mock.Mock(), M, columns=['id'])
+        item = Item(mock.Mock(), '1')
+        self.assertEqual({'_id': '1'}, query.entity(item))
+
+    def keys_query(self, items):
+        """ Return a query for the given keys, whose GetAttributes requests
+        find the items in the dict items.
+        """
+        from boto.sdb.item import Item
+        query = self.query()
+        def get_attributes(domain, item_name, attribute_names=None,
+                consistent_read=False):
+            item = Item(domain, item_name)
+            item.update(items.get(item_name, {}))
+            return item
+        query.manager.sdb.get_attributes.side_effect = get_attributes
+        return query
+
+    @mock.patch('boto.sdb.domain.Domain.batch_delete_attributes')
+    def test_delete_keys(self, mock_boto_delete):
+        """ Keys are deleted without getting their items first
+        """
+        query = self.keys_query({})
+        query.keys = ['2', '3', '2']
+        query.delete()
+        mock_boto_delete.assert_called_with({'2': None, '3': None})
+        self.assertFalse(query.manager.sdb.get_attributes.called)
+
+    def test_get_entities(self):
+        """ Queries on pks get each item once, in order, skipping missing
+        ones
+        """
+        query = self.keys_query({'1': {'name': 'a', '__type__': 'M'},
+            '2': {'name': 'b', '__type__': 'M'}})
+        query.keys = ['2', '3', '1', '2']
+        self.assertEqual([{'_id': '2', 'name': 'b'}, {'_id': '1', 'name': 'a'}],
+            list(query.fetch_range(None, 0)))
+        self.assertEqual(3, query.manager.sdb.get_attributes.call_count)
+        self.assertEqual(['1'], [e['_id'] for e in query.fetch_range(1, 1)])
+        self.assertEqual(2, query.count())
+        self.assertEqual(1, query.count(1))
+        self.assertEqual(['2', '1'], list(query.item_names()))
+        self.assertFalse(query.manager.sdb.select.called)
+
+    def test_get_entities_ordered(self):
+        query = self.keys_query({'1': {'name': 'a'}, '2': {'name': 'b'}})
+        query.keys = ['1', '2']
+        query.add_ordering('name', 'DESC')
+        self.assertEqual(['2', '1'],
+            [e['_id'] for e in query.fetch_range(None, 0)])
+
+    def test_get_entities_projected(self):
+        """ Only the selected columns are requested
+        """
+        from simpledb.query import SimpleDBQuery
+        query = SimpleDBQuery(mock.Mock(), M, columns=['id'])
+        query.keys = ['1']
+        query.manager.sdb.get_attributes.return_value = {}
+        self.assertEqual([], list(query.fetch_range(None, 0)))
+        args, kwargs = query.manager.sdb.get_attributes.call_args
+        self.assertEqual(('1', ['__type__']), args[1:])
+        self.assertEqual({'consistent_read': True}, kwargs)
+
+    def test_get_entities_concurrent(self):
+        """ With a manager factory, items are fetched on several threads
+        """
+        import threading
+        import time
+        query = self.keys_query({})
+        threads = set()
+        # Mock's call_count isn't updated atomically, so calls are listed
+        fetched = []
+        def get_attributes(domain, item_name, attribute_names=None,
+                consistent_read=False):
+            threads.add(threading.current_thread())
+            fetched.append(item_name)
+            time.sleep(0.01)
+            return {}
+        manager = mock.Mock()
+        manager.sdb.get_attributes.side_effect = get_attributes
+        query.manager_factory = lambda domain_name: manager
+        query.workers = 4
+        query.keys = [str(i) for i in range(8)]
+        self.assertEqual(0, query.count())
+        self.assertEqual(query.keys, sorted(fetched))
+        self.assertTrue(len(threads) > 1)
+
+    def test_get_entities_identity_map(self):
+        """ Items fetched during a request, even missing ones, aren't
+        fetched again until the domain is written to
+        """
+        from simpledb.cache import IdentityMap
+        query = self.keys_query({'1': {'name': 'a'}})
+        query.identity_map = IdentityMap()
+        query.identity_map.start()
+        try:
+            query.keys = ['1', '2']
+            self.assertEqual(1, query.count())
+            entities = list(query.fetch_range(None, 0))
+            self.assertEqual([{'_id': '1', 'name': 'a'}], entities)
+            self.assertEqual(2, query.manager.sdb.get_attributes.call_count)
+            # Callers get copies they can change
+            entities[0]['name'] = 'x'
+            self.assertEqual('a', query.fetch_range(None, 0).next()['name'])
+            query.identity_map.invalidate('simpledb_m')
+            self.assertEqual(1, query.count())
+            self.assertEqual(4, query.manager.sdb.get_attributes.call_count)
+        finally:
+            query.identity_map.finish()
+
 
 class BackendQueryTests(unittest.TestCase):
 
@@ -308,6 +1804,8 @@ class BackendQueryTests(unittest.TestCase):
         from simpledb.compiler import BackendQuery
         mock_domain.return_value = 'some_name'
         compiler = mock.Mock()
+        compiler.query.model = M
+        compiler.connection.settings_dict = {}
         def f(db_type, value):
             return value
         compiler.convert_value_for_db.side_effect = f
@@ -321,16 +1819,257 @@ class BackendQueryTests(unittest.TestCase):
         self.backend_query().delete()
         mock_delete.assert_called_with()
 
+    @mock.patch('simpledb.query.SimpleDBQuery.fetch_range')
+    def test_fetch_large_slice(self, mock_fetch):
+        """ Slices larger than a single SimpleDB page are still fetched as a
+        range, rather than by reading every result.
+        """
+        mock_fetch.return_value = iter([{'_id': '1'}])
+        query = self.backend_query()
+        query.query.get_meta.return_value.pk.column = 'id'
+        self.assertEqual([{'id': '1'}], list(query.fetch(10, 5010)))
+        mock_fetch.assert_called_with(5000, 10)
+
+    def test_fields(self):
+        """ The fields Django asks for become the query's columns
+        """
+        from simpledb.compiler import BackendQuery
+        compiler = mock.Mock()
+        compiler.query.model = M
+        compiler.connection.settings_dict = {}
+        query = BackendQuery(compiler, [M._meta.pk])
+        self.assertEqual('itemName()', query.db_query.output())
+
     def test_add_filter_in(self):
-        """ 'in' queries are passed to boto like regular equals queries, but
-        with a list of values rather than a single value. boto will OR them.
+        """ 'in' queries use SimpleDB's in operator
         """
         query = self.backend_query()
         query.add_filter('name', 'in', False, 'unicode', ['x', 'y'])
-        self.assertEqual([('name =', [['x'], ['y']])], query.db_query.filters)
+        self.assertEqual(["`name` in ('x', 'y')"], query.db_query.predicates)
+
+    def test_add_filter_not_in(self):
+        query = self.backend_query()
+        query.add_filter('name', 'in', True, 'unicode', ['x', "y'"])
+        self.assertEqual(["not (`name` in ('x', 'y'''))"],
+            query.db_query.predicates)
+
+    def test_add_filter_in_chunks(self):
+        """ Long in lists are split into chunks, each run as its own select
+        """
+        query = self.backend_query()
+        query.add_filter('name', 'in', False, 'unicode',
+            [str(i) for i in range(45)])
+        self.assertEqual([], query.db_query.predicates)
+        [alternatives] = query.db_query.splits
+        self.assertEqual(3, len(alternatives))
+        self.assertTrue(alternatives[2].startswith("`name` in ('40', "))
+        self.assertFalse(query.db_query.overlapping)
+        # Lists can match several chunks, so they're counted by item name
+        query = self.backend_query()
+        query.add_filter('tags', 'in', False, 'ListField:unicode',
+            [str(i) for i in range(45)])
+        self.assertTrue(query.db_query.overlapping)
+        # Negated, every value has to go in one select
+        from django.db.utils import DatabaseError
+        query = self.backend_query()
+        self.assertRaises(DatabaseError, query.add_filter, 'name', 'in',
+            True, 'unicode', [str(i) for i in range(45)])
+        query.add_filter('name', 'in', True, 'unicode',
+            [str(i) for i in range(16)])
+        self.assertEqual(1, len(query.db_query.predicates))
+
+    def test_add_filter_lookups(self):
+        query = self.backend_query()
+        query.add_filter('name', 'startswith', False, 'unicode', '50%')
+        query.add_filter('name', 'startswith', True, 'unicode', 'x')
+        query.add_filter('name', 'range', False, 'unicode', ['a', 'b'])
+        query.add_filter('name', 'range', True, 'unicode', ['a', 'b'])
+        query.add_filter('name', 'isnull', False, 'unicode', True)
+        query.add_filter('name', 'gt', True, 'unicode', 'a')
+        self.assertEqual([
+            "`name` like '50\\%%'",
+            "`name` not like 'x%'",
+            "`name` between 'a' and 'b'",
+            "not (`name` between 'a' and 'b')",
+            "`name` is null",
+            "`name` <= 'a'",
+        ], query.db_query.predicates)
+
+    def test_add_filter_year(self):
+        """ Year lookups on dates compare with dates, not datetimes
+        """
+        from simpledb.compiler import for_db_converter
+        query = self.backend_query()
+        query.compiler.convert_value_for_db.side_effect = \
+            lambda db_type, value: for_db_converter(db_type)(value)
+        query.add_filter('name', 'year', False, 'date',
+            [datetime.datetime(2008, 1, 1), datetime.datetime(2009, 1, 1)])
+        self.assertEqual(
+            ["(`name` >= '2008-01-01' and `name` < '2009-01-01')"],
+            query.db_query.predicates)
+
+    def test_add_filter_pk(self):
+        query = self.backend_query()
+        query.query.get_meta.return_value.pk.column = 'id'
+        query.add_filter('id', 'exact', False, 'long', 'x')
+        self.assertEqual(["itemName() = 'x'"], query.db_query.predicates)
+
+    def test_add_filter_list(self):
+        """ Negated lookups on lists must hold for every item
+        """
+        query = self.backend_query()
+        query.add_filter('tags', 'exact', False, 'ListField:unicode', 'x')
+        query.add_filter('tags', 'exact', True, 'ListField:unicode', 'x')
+        self.assertEqual(["`tags` = 'x'", "every(`tags`) != 'x'"],
+            query.db_query.predicates)
+
+
+class FuturesTests(unittest.TestCase):
+
+    @mock.patch('simpledb.query.SimpleDBQuery.count')
+    @mock.patch('simpledb.query.SimpleDBQuery.fetch_infinite')
+    def test_queries(self, mock_fetch, mock_count):
+        """ Queries run on the pool's threads, and their results are got
+        from the AsyncResults
+        """
+        import threading
+        from simpledb import futures
+        threads = []
+        def fetch(offset):
+            threads.append(threading.current_thread())
+            return [{'_id': u'1', 'name': u'a'}]
+        mock_fetch.side_effect = fetch
+        mock_count.return_value = 3
+        result = futures.fetch(M.objects.all())
+        [m] = result.get(5)
+        self.assertEqual(u'a', m.name)
+        self.assertNotEqual(threading.current_thread(), threads[0])
+        self.assertEqual(3, futures.count(M.objects.all()).get(5))
+
+    @mock.patch('simpledb.compiler.save_entities')
+    @mock.patch('simpledb.compiler.save_entity')
+    def test_writes(self, mock_save, mock_save_many):
+        from simpledb import futures
+        from simpledb.encoding import encode_long
+        mock_save.return_value = encode_long(7)
+        m = M(name=u'a')
+        futures.save(m).get(5)
+        self.assertEqual(7, m.pk)
+        mock_save_many.return_value = [encode_long(8), encode_long(9)]
+        objs = [M(name=u'b'), M(name=u'c')]
+        self.assertEqual([8, 9], futures.bulk_insert(objs).get(5))
+        self.assertEqual([8, 9], [obj.pk for obj in objs])
+        self.assertEqual([], futures.bulk_insert([]).get(5))
+
+    @mock.patch('simpledb.compiler.save_entity')
+    def test_errors(self, mock_save):
+        """ Errors are raised by get()
+        """
+        from django.db.utils import DatabaseError
+        from boto.exception import BotoServerError
+        from simpledb import futures
+        mock_save.side_effect = BotoServerError(400, 'Bad Request')
+        result = futures.save(M(name=u'a'))
+        self.assertRaises(DatabaseError, result.get, 5)
+
 
 class IntegrationTests(unittest.TestCase):
 
+    def predicates(self, queryset):
+        compiler = queryset.query.get_compiler(using=queryset.db)
+        return compiler.build_query().db_query.predicates
+
+    def test_or_filters(self):
+        """ ORed filters become a single parenthesized predicate
+        """
+        from django.db.models import Q
+        self.assertEqual(["(`name` = 'a' or `name` = 'b')"], self.predicates(
+            M.objects.filter(Q(name='a') | Q(name='b'))))
+
+    def test_negated_or_filters(self):
+        """ Negated groups have the negation pushed down to their lookups
+        """
+        from django.db.models import Q
+        self.assertEqual(["(`name` != 'a' and `name` != 'b')"],
+            self.predicates(M.objects.exclude(Q(name='a') | Q(name='b'))))
+
+    def test_nested_filters(self):
+        from django.db.models import Q
+        from simpledb.encoding import encode_long
+        self.assertEqual(["`name` = 'a'",
+            "(`name` = 'b' or (itemName() != '%s' or `name` != 'c'))" %
+                encode_long(3)],
+            self.predicates(M.objects.filter(name='a').filter(
+                Q(name='b') | ~Q(name='c', pk=3))))
+
+    def test_or_long_in(self):
+        """ Long in lists inside a group are split into separate selects
+        """
+        from django.db.models import Q
+        from simpledb.encoding import encode_long
+        names = [str(i) for i in range(30)]
+        query = M.objects.filter(Q(name__in=names) | Q(name='x'), name__gt='')
+        db_query = query.query.get_compiler(using=query.db).build_query(
+            ).db_query
+        self.assertEqual(["`name` > ''"], db_query.predicates)
+        [alternatives] = db_query.splits
+        self.assertEqual("`name` = 'x'", alternatives[0])
+        # Chunks leave room for the select's other comparisons
+        self.assertEqual(4, len(alternatives))
+        self.assertTrue(alternatives[1].startswith("`name` in ('0', "))
+        self.assertTrue(alternatives[2].startswith("`name` in ('14', "))
+        self.assertTrue(db_query.overlapping)
+        # Nested in lists are split too, ANDed with the rest of their group
+        query = M.objects.filter(Q(name__in=names, pk__gt=1) | Q(name='x'))
+        db_query = query.query.get_compiler(using=query.db).build_query(
+            ).db_query
+        [alternatives] = db_query.splits
+        self.assertEqual(4, len(alternatives))
+        self.assertEqual("(itemName() > '%s' and `name` in ('28', '29'))"
+            % encode_long(1), alternatives[3])
+
+    def test_get_by_pk(self):
+        """ Queries on nothing but the pk get items by name instead of
+        selecting them
+        """
+        from simpledb.encoding import encode_long
+        query = M.objects.filter(pk=3)
+        db_query = query.query.get_compiler(using=query.db).build_query(
+            ).db_query
+        self.assertEqual([encode_long(3)], db_query.keys)
+        self.assertEqual([], db_query.predicates)
+        query = M.objects.filter(pk__in=[3, 4])
+        db_query = query.query.get_compiler(using=query.db).build_query(
+            ).db_query
+        self.assertEqual([encode_long(3), encode_long(4)], db_query.keys)
+        self.assertEqual(["itemName() != '%s'" % encode_long(3)],
+            self.predicates(M.objects.exclude(pk=3)))
+        self.assertEqual(["itemName() = '%s'" % encode_long(3),
+            "`name` = 'a'"], self.predicates(M.objects.filter(pk=3, name='a')))
+
+    @mock.patch('simpledb.compiler.update_entities')
+    @mock.patch('simpledb.query.SimpleDBQuery.item_names')
+    def test_update(self, mock_names, mock_update):
+        """ Updates select item names, then write only the changed columns
+        """
+        from django.db import connection
+        from django.db.utils import DatabaseError
+        mock_names.return_value = iter(['1', '2'])
+        mock_update.return_value = 2
+        self.assertEqual(2, M.objects.filter(name='a').update(name='b'))
+        args = mock_update.call_args[0]
+        self.assertEqual((M, ['1', '2'], {'name': u'b'}, None), args[1:])
+        self.assertRaises(DatabaseError, M.objects.update,
+            name=models.F('name'))
+        settings = dict(connection.settings_dict, CONDITIONAL_UPDATES=True)
+        with mock.patch.object(connection, 'settings_dict', settings):
+            mock_names.return_value = iter(['1'])
+            M.objects.filter(name='a').update(name='b')
+            self.assertEqual(('name', u'a'), mock_update.call_args[0][4])
+            mock_names.return_value = iter(['1'])
+            M.objects.filter(pk=1).update(name='b')
+            self.assertEqual(None, mock_update.call_args[0][4])
+
     @mock.patch('simpledb.query.SimpleDBQuery.fetch_infinite')
     def test_fetch(self, mock_fetch):
         """
@@ -355,3 +2094,287 @@ class IntegrationTests(unittest.TestCase):
         x = xs[0]
         self.assertEqual(123456, x.fk_id)
         self.assertEqual(u'name for m', x.fk.name)
+
+
+class EmulatorTests(unittest.TestCase):
+    """ Requests answered by simpledb.emulator
+    """
+
+    def setUp(self):
+        from simpledb.emulator import Emulator, EmulatedSDBConnection
+        from simpledb.retry import RetryPolicy
+        self.emulator = Emulator()
+        self.sdb = EmulatedSDBConnection(self.emulator,
+            RetryPolicy(rate_limit=None), 'key', 'secret')
+        self.domain = self.sdb.create_domain('things')
+        self.domain.batch_put_attributes({
+            'a': {'size': '1', 'tags': ['red', 'blue'], 'name': 'x%y'},
+            'b': {'size': '2', 'tags': ['red']},
+            'c': {'size': '3', 'name': "it's"},
+            'd': {'size': '4', 'tags': ['green', 'blue']},
+        })
+
+    def names(self, where, **kwargs):
+        rs = self.sdb.select(self.domain,
+            'select itemName() from `things` where %s' % where, **kwargs)
+        return sorted([item.name for item in rs])
+
+    def test_attributes(self):
+        item = self.sdb.get_attributes(self.domain, 'a')
+        self.assertEqual({'size': '1', 'tags': ['red', 'blue'],
+            'name': 'x%y'}, item)
+        self.assertEqual({'size': '1'},
+            self.sdb.get_attributes(self.domain, 'a', ['size']))
+        self.assertEqual({}, self.sdb.get_attributes(self.domain, 'z'))
+        self.domain.put_attributes('a', {'size': '5', 'tags': 'pink'},
+            replace=False)
+        item = self.sdb.get_attributes(self.domain, 'a')
+        self.assertEqual(['1', '5'], sorted(item['size']))
+        self.domain.put_attributes('a', {'size': '6'})
+        self.assertEqual('6', self.sdb.get_attributes(self.domain, 'a')['size'])
+        self.domain.delete_attributes('a', {'tags': 'red'})
+        self.assertEqual(['blue', 'pink'],
+            sorted(self.sdb.get_attributes(self.domain, 'a')['tags']))
+        self.domain.delete_attributes('a', ['tags', 'name'])
+        self.assertEqual({'size': '6'},
+            self.sdb.get_attributes(self.domain, 'a'))
+        self.domain.delete_attributes('a')
+        self.assertEqual({}, self.sdb.get_attributes(self.domain, 'a'))
+        self.domain.batch_delete_attributes({'b': None, 'c': None})
+        self.assertEqual(['d'], self.names('`size` is not null'))
+
+    def test_batch_delete_names(self):
+        """ Attributes named without values lose all of them
+        """
+        from simpledb.compiler import batch_delete_names
+        batch_delete_names(self.domain, [('a', ['tags', 'name']),
+            ('d', ['tags'])])
+        self.assertEqual({'size': '1'},
+            self.sdb.get_attributes(self.domain, 'a'))
+        self.assertEqual({'size': '4'},
+            self.sdb.get_attributes(self.domain, 'd'))
+
+    def test_predicates(self):
+        self.assertEqual(['a', 'b'], self.names("`tags` = 'red'"))
+        self.assertEqual(['a', 'b', 'd'], self.names("`tags` != 'green'"))
+        self.assertEqual(['b'], self.names("every(`tags`) = 'red'"))
+        self.assertEqual(['b', 'c'], self.names("`size` between '2' and '3'"))
+        self.assertEqual(['c', 'd'], self.names("`size` >= '3'"))
+        self.assertEqual(['a', 'd'], self.names("`size` in ('1', '4', '9')"))
+        self.assertEqual(['b', 'd'], self.names("`name` is null"))
+        self.assertEqual(['a'], self.names(r"`name` like 'x\%%'"))
+        self.assertEqual(['c'], self.names("`name` = 'it''s'"))
+        self.assertEqual(['c'], self.names("`name` not like 'x%'"))
+        self.assertEqual(['a', 'c', 'd'],
+            self.names("not (`tags` = 'red' and `size` = '2')"))
+        self.assertEqual(['a', 'd'],
+            self.names("(`size` = '1' or `size` > '3') AND `tags` LIKE '%'"))
+        self.assertEqual(['b'], self.names("itemName() = 'b'"))
+        self.assertEqual(['c', 'd'], self.names("itemName() > 'b'"))
+
+    def test_paging(self):
+        """ NextTokens carry on after the last item returned, even when
+        items are deleted in between
+        """
+        query = ("select * from `things` where `size` > '0' "
+            "order by `size` desc limit 2")
+        rs = self.sdb.select(self.domain, query)
+        self.assertEqual(['d', 'c'], [item.name for item in rs])
+        self.domain.delete_attributes('b')
+        rs = self.sdb.select(self.domain, query, next_token=rs.next_token)
+        self.assertEqual(['a'], [item.name for item in rs])
+        self.assertEqual(None, rs.next_token)
+        rs = self.sdb.select(self.domain,
+            "select count(*) from `things` limit 2")
+        self.assertEqual('2', rs[0]['Count'])
+        rs = self.sdb.select(self.domain,
+            "select count(*) from `things`", next_token=rs.next_token)
+        self.assertEqual('1', rs[0]['Count'])
+
+    def test_errors(self):
+        from boto.exception import SDBResponseError
+        def error_code(func, *args, **kwargs):
+            try:
+                func(*args, **kwargs)
+            except SDBResponseError, e:
+                return e.error_code
+        self.assertEqual('InvalidSortExpression', error_code(self.sdb.select,
+            self.domain, "select * from `things` order by `size`"))
+        self.assertEqual('InvalidQueryExpression', error_code(self.sdb.select,
+            self.domain, "select * from `things` where `size` = 1"))
+        self.assertEqual('InvalidParameterValue', error_code(self.sdb.select,
+            self.domain, "select * from `things` limit 2501"))
+        self.assertEqual('NoSuchDomain', error_code(self.sdb.select,
+            self.domain, "select * from `nothing`"))
+        self.assertEqual('NumberSubmittedItemsExceeded', error_code(
+            self.domain.batch_put_attributes,
+            dict([(str(i), {'a': 'b'}) for i in range(26)])))
+        self.assertEqual('ConditionalCheckFailed', error_code(
+            self.domain.put_attributes, 'a', {'size': '2'},
+            expected_value=['size', '2']))
+        self.assertEqual('AttributeDoesNotExist', error_code(
+            self.domain.put_attributes, 'b', {'size': '2'},
+            expected_value=['name', 'x']))
+        self.assertEqual(None, error_code(self.domain.put_attributes, 'a',
+            {'size': '2'}, expected_value=['size', '1']))
+
+    def test_box_usage(self):
+        from simpledb.emulator import BOX_USAGE
+        self.emulator.box_usage = 0
+        self.sdb.get_attributes(self.domain, 'a')
+        self.assertEqual(BOX_USAGE['GetAttributes'], self.emulator.box_usage)
+        self.assertEqual(1, self.emulator.requests['GetAttributes'])
+
+    def test_retries(self):
+        """ Failures can be injected, and are retried by the connection
+        """
+        self.emulator.fail(503, times=2)
+        self.assertEqual('1', self.sdb.get_attributes(self.domain, 'a')['size'])
+        self.assertEqual(3, self.emulator.requests['GetAttributes'])
+
+
+class EmulatedDatabaseTests(unittest.TestCase):
+    """ Querysets run against a database with the EMULATOR setting
+    """
+
+    def setUp(self):
+        from django.db import connections
+        from simpledb.emulator import get_emulator
+        from simpledb.query import clear_adapters
+        # Other tests build adapters with a mocked domain name
+        clear_adapters()
+        connections.databases['emulated'] = {
+            'ENGINE': 'simpledb',
+            'AWS_ACCESS_KEY_ID': 'key',
+            'AWS_SECRET_ACCESS_KEY': 'secret',
+            'EMULATOR': 'tests',
+            'RATE_LIMIT': None,
+        }
+        self.emulator = get_emulator('tests')
+        self.emulator.reset()
+        self.connection = connections['emulated']
+        for model in (M, X):
+            self.connection.creation.sql_create_model(model, None)
+        self.objects = M.objects.using('emulated')
+
+    def tearDown(self):
+        from django.db import connections
+        del connections.databases['emulated']
+        connections._connections.pop('emulated', None)
+
+    def test_queries(self):
+        for name in ['c', 'a', 'd', 'b']:
+            self.objects.create(name=name)
+        self.assertEqual(4, self.objects.count())
+        self.assertEqual(['a', 'b', 'c', 'd'],
+            [m.name for m in self.objects.order_by('name')])
+        self.assertEqual(['d', 'c'],
+            [m.name for m in self.objects.order_by('-name')[:2]])
+        self.assertEqual(['b', 'c'],
+            [m.name for m in self.objects.order_by('name')[1:3]])
+        self.assertEqual(['a', 'c'], sorted([m.name for m in
+            self.objects.filter(name__in=['a', 'c', 'x'])]))
+        self.assertEqual(['b', 'c', 'd'], sorted([m.name for m in
+            self.objects.exclude(name='a')]))
+        self.assertEqual(['c', 'd'], sorted([m.name for m in
+            self.objects.filter(name__gt='b')]))
+        m = self.objects.get(name='c')
+        self.assertEqual('c', self.objects.get(pk=m.pk).name)
+        self.assertEqual(1, self.objects.filter(pk__in=[m.pk, 0]).count())
+
+    def test_paging(self):
+        """ Offsets and results span several pages of selects
+        """
+        from django.db.models.sql.subqueries import InsertQuery
+        compiler = InsertQuery(M).get_compiler(using='emulated')
+        compiler.bulk_insert([M(name='%04d' % i) for i in range(300)])
+        self.assertEqual(300, self.objects.count())
+        self.assertEqual(300, len(list(self.objects.all())))
+        self.assertEqual(['0250', '0251'], [m.name for m in
+            self.objects.order_by('name')[250:252]])
+        self.assertEqual(100, self.objects.filter(name__lt='0100').count())
+
+    def test_slice_after_write(self):
+        """ Offsets cached before a write aren't used after it
+        """
+        for i in range(10):
+            self.objects.create(name='%02d' % i)
+        query = self.objects.order_by('name')
+        self.assertEqual(['03', '04'], [m.name for m in query[3:5]])
+        self.objects.filter(name__in=['00', '01']).delete()
+        self.assertEqual(['05', '06'], [m.name for m in query[3:5]])
+        self.objects.get(name='02').delete()
+        self.assertEqual(['06', '07'], [m.name for m in query[3:5]])
+        self.objects.create(name='000')
+        self.assertEqual(['05', '06'], [m.name for m in query[3:5]])
+
+    def test_long_not_in(self):
+        """ Excluding more values than fit in one select is an error, rather
+        than a select SimpleDB rejects
+        """
+        from django.db.utils import DatabaseError
+        for i in range(30):
+            self.objects.create(name='%02d' % i)
+        names = ['%02d' % i for i in range(25)]
+        self.assertRaises(DatabaseError, list,
+            self.objects.exclude(name__in=names))
+        self.assertEqual(14, self.objects.exclude(name__in=names[:16]).count())
+        # Negated in groups too
+        from django.db.models import Q
+        self.assertRaises(DatabaseError, list,
+            self.objects.filter(~Q(name__in=names) | Q(name='00')))
+        self.assertEqual(15, self.objects.filter(~Q(name__in=names[:16]) |
+            Q(name='00')).count())
+
+    def test_long_in_groups(self):
+        """ Groups with long in lists run as several selects, each within
+        SimpleDB's limit on comparisons
+        """
+        from django.db.models import Q
+        for i in range(30):
+            self.objects.create(name='%02d' % i)
+        query = self.objects.filter(Q(name__in=['%02d' % i
+            for i in range(25)]) | Q(name__gte='20'))
+        self.assertEqual(30, query.count())
+        self.assertEqual(30, len(list(query)))
+        self.assertEqual(['21', '20'], [m.name for m in
+            query.order_by('-name')[8:10]])
+
+    def test_delete_related(self):
+        """ Deleting cascades through foreign keys with fk__in lookups on
+        more pks than fit in one select
+        """
+        for i in range(30):
+            X.objects.using('emulated').create(
+                fk=self.objects.create(name='%02d' % i))
+        self.objects.all().delete()
+        self.assertEqual(0, self.objects.count())
+        self.assertEqual(0, X.objects.using('emulated').count())
+
+    def test_future_write_by_pk(self):
+        """ Background writes drop the calling thread's entities from the
+        identity map, so fetching by pk afterwards sees the change
+        """
+        from django.core.signals import request_started, request_finished
+        from simpledb import futures
+        pk = self.objects.create(name='a').pk
+        request_started.send(sender=None)
+        try:
+            m = self.objects.get(pk=pk)
+            m.name = 'b'
+            futures.save(m, using='emulated', force_update=True).get(5)
+            self.assertEqual('b', self.objects.get(pk=pk).name)
+            futures.delete(self.objects.filter(name='b')).get(5)
+            self.assertRaises(M.DoesNotExist, self.objects.get, pk=pk)
+        finally:
+            request_finished.send(sender=None)
+
+    def test_writes(self):
+        for name in ['a', 'b', 'c']:
+            self.objects.create(name=name)
+        self.assertEqual(1, self.objects.filter(name='a').update(name='z'))
+        self.assertEqual(['b', 'c', 'z'],
+            sorted([m.name for m in self.objects.all()]))
+        self.objects.filter(name__in=['b', 'z']).delete()
+        self.assertEqual(['c'], [m.name for m in self.objects.all()])
+        self.assertTrue(self.emulator.box_usage > 0)
@@ -1,2 +1,309 @@
+import Queue
+import hashlib
+import random
+import sys
+import threading
+import time
+import uuid
+
+from collections import OrderedDict
+
+from simpledb.encoding import encode_long
+
+# SimpleDB request limits
+AWS_MAX_RESULT_SIZE = 2500
+AWS_MAX_BATCH_ITEMS = 25
+AWS_MAX_BATCH_BYTES = 1024 * 1024
+# Comparisons allowed in a single select expression. Each value of an IN
+# counts as one.
+AWS_MAX_COMPARISONS = 20
+
 def domain_for_model(model):
-    return model._meta.db_table
\ No newline at end of file
+    return model._meta.db_table
+
+def shard_count(connection, domain_name):
+    """ Number of domains a model's items are spread over, from the SHARDS
+    setting, which maps db_table names to numbers of shards.
+    """
+    return connection.settings_dict.get('SHARDS', {}).get(domain_name, 1)
+
+def shard_domains(domain_name, shards=1):
+    """ The domains a model's items are spread over, when it's split into
+    shards domains.
+    """
+    if shards <= 1:
+        return [domain_name]
+    return ['%s_%d' % (domain_name, i) for i in range(shards)]
+
+def domain_for_item(domain_name, item_name, shards=1):
+    """ The domain holding item_name, chosen by a hash of the name when the
+    model is split into shards domains.
+    """
+    if shards <= 1:
+        return domain_name
+    digest = hashlib.md5(unicode(item_name).encode('utf-8')).hexdigest()
+    return '%s_%d' % (domain_name, int(digest, 16) % shards)
+
+def group_by_domain(domain_name, item_names, shards=1):
+    """ Split item names into (domain, [item_name, ...]) pairs, one for
+    every shard that has any of them, keeping the names in order.
+    """
+    if shards <= 1:
+        return [(domain_name, list(item_names))]
+    groups = OrderedDict()
+    for item_name in item_names:
+        groups.setdefault(domain_for_item(domain_name, item_name, shards),
+            []).append(item_name)
+    return groups.items()
+
+def attributes_size(item_name, attrs):
+    """ Rough size in bytes of an item's name and attributes, as they'll be
+    sent to SimpleDB.
+    """
+    size = len(unicode(item_name).encode('utf-8'))
+    for name, value in attrs.items():
+        if not isinstance(value, (list, tuple)):
+            value = [value]
+        for v in value:
+            size += len(name) + len(unicode(v).encode('utf-8'))
+    return size
+
+def batches(items, max_items=AWS_MAX_BATCH_ITEMS,
+        max_bytes=AWS_MAX_BATCH_BYTES):
+    """ Split an iterable of (item_name, attrs) pairs into lists that fit
+    into a single batch request. An item name never appears twice in the
+    same batch, as SimpleDB rejects those.
+    """
+    batch, names, size = [], set(), 0
+    for item_name, attrs in items:
+        item_size = attributes_size(item_name, attrs)
+        if batch and (len(batch) == max_items or item_name in names or
+                size + item_size > max_bytes):
+            yield batch
+            batch, names, size = [], set(), 0
+        batch.append((item_name, attrs))
+        names.add(item_name)
+        size += item_size
+    if batch:
+        yield batch
+
+def chunks(iterable, size):
+    """ Split an iterable into lists of at most size items, lazily.
+    """
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+class LRUCache(object):
+    """ Thread safe least-recently-used cache, holding at most size entries.
+    If ttl is given, entries expire that many seconds after they're set.
+    """
+
+    def __init__(self, size=1000, ttl=None):
+        self.size = size
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        self._lock.acquire()
+        try:
+            try:
+                value, expires = self._data.pop(key)
+            except KeyError:
+                return default
+            if expires is not None and expires < time.time():
+                return default
+            self._data[key] = (value, expires)
+            return value
+        finally:
+            self._lock.release()
+
+    def set(self, key, value):
+        expires = None
+        if self.ttl:
+            expires = time.time() + self.ttl
+        self._lock.acquire()
+        try:
+            self._data.pop(key, None)
+            self._data[key] = (value, expires)
+            while len(self._data) > self.size:
+                self._data.popitem(last=False)
+        finally:
+            self._lock.release()
+
+    def delete(self, key):
+        self._lock.acquire()
+        try:
+            self._data.pop(key, None)
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._data.clear()
+        finally:
+            self._lock.release()
+
+    def __len__(self):
+        return len(self._data)
+
+_STOP = object()
+
+def concurrent_map(func, iterable, workers=1):
+    """ Yield func(item) for each item in iterable, in completion order,
+    calling func on up to `workers` threads at once. The iterable is consumed
+    lazily, so no more than 2 * workers items are ever in flight. If func
+    raises, no further items are started and the exception is re-raised
+    once the in-flight calls have finished.
+    """
+    if workers <= 1:
+        for item in iterable:
+            yield func(item)
+        return
+
+    tasks = Queue.Queue()
+    results = Queue.Queue()
+
+    def work():
+        while True:
+            item = tasks.get()
+            if item is _STOP:
+                return
+            try:
+                results.put((True, func(item)))
+            except Exception:
+                results.put((False, sys.exc_info()))
+
+    for i in range(workers):
+        thread = threading.Thread(target=work)
+        thread.daemon = True
+        thread.start()
+
+    pending = 0
+    error = None
+    try:
+        for item in iterable:
+            if pending == workers * 2:
+                ok, result = results.get()
+                pending -= 1
+                if not ok:
+                    error = result
+                    break
+                yield result
+            tasks.put(item)
+            pending += 1
+        while pending:
+            ok, result = results.get()
+            pending -= 1
+            if not ok:
+                error = error or result
+            elif not error:
+                yield result
+        if error:
+            raise error[0], error[1], error[2]
+    finally:
+        for i in range(workers):
+            tasks.put(_STOP)
+
+def read_ahead(iterable, depth):
+    """ Iterate over iterable on a background thread, keeping up to depth
+    items ready ahead of the consumer. Exceptions are re-raised in the
+    consumer, and the background thread stops if the consumer does.
+    """
+    return interleave([iterable], 1, depth)
+
+def interleave(iterables, workers, depth=2):
+    """ Yield the items of every iterable, in whatever order they arrive,
+    running up to workers of the iterables at once on background threads.
+    At most workers * depth items are buffered. Exceptions are re-raised in
+    the consumer, and the threads stop if the consumer does.
+    """
+    queue = Queue.Queue(workers * depth)
+    sources = iter(iterables)
+    lock = threading.Lock()
+    stopped = threading.Event()
+
+    def put(entry):
+        while not stopped.isSet():
+            try:
+                queue.put(entry, timeout=0.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            while True:
+                lock.acquire()
+                try:
+                    iterable = next(sources, _STOP)
+                finally:
+                    lock.release()
+                if iterable is _STOP:
+                    break
+                for item in iterable:
+                    if not put((True, item)):
+                        return
+        except Exception:
+            put((False, sys.exc_info()))
+        else:
+            put((True, _STOP))
+
+    for i in range(workers):
+        thread = threading.Thread(target=produce)
+        thread.daemon = True
+        thread.start()
+    finished = 0
+    try:
+        while finished < workers:
+            ok, item = queue.get()
+            if not ok:
+                raise item[0], item[1], item[2]
+            if item is _STOP:
+                finished += 1
+            else:
+                yield item
+    finally:
+        stopped.set()
+
+def quote(value):
+    """ Quote a string for use in a select expression
+    """
+    return "'%s'" % unicode(value).replace("'", "''")
+
+def quote_name(name):
+    """ Backquote an attribute name for use in a select expression
+    """
+    return '`%s`' % name.replace('`', '``')
+
+def attribute_name(column):
+    """ How column is named in select expressions
+    """
+    if column == '_id':
+        return 'itemName()'
+    return quote_name(column)
+
+def split_points(sample, segments):
+    """ Return the segments - 1 values that split a sample of item names
+    into evenly sized, ordered ranges.
+    """
+    sample = sorted(sample)
+    return [sample[len(sample) * i // segments] for i in range(1, segments)]
+
+def uuid_split_points(segments):
+    """ split_points() for the item names save_entity generates - encoded
+    uuid4 integers. They're not evenly spread across leading digits, so this
+    works from a (repeatable) random sample.
+    """
+    rng = random.Random(segments)
+    sample = [encode_long(uuid.UUID(int=rng.getrandbits(128), version=4).int)
+        for i in xrange(max(1000, segments * 100))]
+    return split_points(sample, segments)